@@ -6,27 +6,50 @@ import librosa
 import sounddevice as sd
 import numpy as np
 import scipy
+import scipy.io.wavfile
+import scipy.signal
+import collections
+import hashlib
+import io
+import json
 import os
+import queue
 import re
+import subprocess
 
 VOICE_SAMPLERATE = 16000
 
 
+# probed in order: integer multiples of the voice rate first, they are
+# resampled by plain decimation, then the usual USB microphone rates
+SAMPLE_RATES = (16000, 48000, 32000, 96000, 44100)
+DEVICE_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "blackboard", "input_devices.json")
+
+
 def select_sample_rate(dev):
-    rates_to_test = [16000, 32000, 44100, 48000, 96000, 128000]
-    supported_rates = []
-    for rate in rates_to_test:
+    """The first rate of SAMPLE_RATES the input device `dev` supports."""
+    for rate in SAMPLE_RATES:
         try:
             sd.check_input_settings(samplerate=rate, device=dev)
-            supported_rates.append(rate)
+            return rate
         except sd.PortAudioError:
             pass
-    return min(supported_rates) if supported_rates else None
+    return None
+
 
+def device_fingerprint(devices):
+    """A digest of the device list, it changes when the hardware does."""
+    keys = [(d["name"], d["hostapi"], d["max_input_channels"],
+             d["max_output_channels"], d["default_samplerate"])
+            for d in devices]
+    return hashlib.sha1(json.dumps(keys).encode("utf-8")).hexdigest()
 
-def select_input_device():
+
+def probe_input_devices(devices):
     result = []
-    for i, dev in enumerate(sd.query_devices()):
+    for i, dev in enumerate(devices):
         if dev["max_input_channels"] == 0:
             continue
         if dev["max_output_channels"] != 0:
@@ -38,6 +61,42 @@ def select_input_device():
     return result
 
 
+def select_input_device(cache_file=DEVICE_CACHE, refresh=False):
+    """The (index, channels, sample rate) of the usable input devices.
+
+    Probing the rates is slow with USB microphones, the result is cached
+    in `cache_file` and reused until the device list changes, or on
+    `refresh`.
+    """
+    devices = sd.query_devices()
+    fingerprint = device_fingerprint(devices)
+    if cache_file and not refresh:
+        try:
+            with open(cache_file, encoding="utf8") as f:
+                cache = json.load(f)
+            if (cache["fingerprint"] == fingerprint and
+                    tuple(cache["rates"]) == SAMPLE_RATES):
+                return [tuple(d) for d in cache["devices"]]
+        except (OSError, ValueError, KeyError):
+            pass
+    result = probe_input_devices(devices)
+    if cache_file:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp = cache_file + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                json.dump(
+                    {
+                        "fingerprint": fingerprint,
+                        "rates": SAMPLE_RATES,
+                        "devices": result
+                    }, f)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass  # e.g. a read-only home, probe again next time
+    return result
+
+
 def record_voice(dev, duration, samplerate, downsample=True):
     rec = sd.rec(int(duration * samplerate),
                  samplerate=samplerate,
@@ -47,12 +106,189 @@ def record_voice(dev, duration, samplerate, downsample=True):
     sd.wait()
     rec = rec.flatten()
     if downsample and samplerate > VOICE_SAMPLERATE:
-        rec = librosa.resample(rec,
-                               orig_sr=samplerate,
-                               target_sr=VOICE_SAMPLERATE)
+        rec = resample_voice(rec, samplerate)
     return rec
 
 
+def resample_voice(rec, samplerate):
+    """Resample `rec` to VOICE_SAMPLERATE, decimating integer multiples."""
+    if samplerate % VOICE_SAMPLERATE == 0:
+        rec = scipy.signal.resample_poly(rec, 1,
+                                         samplerate // VOICE_SAMPLERATE)
+        return rec.astype(np.float32)
+    return librosa.resample(rec,
+                            orig_sr=samplerate,
+                            target_sr=VOICE_SAMPLERATE)
+
+
+def stream_voice(dev, samplerate, block=0.1):
+    """Yield float32 blocks of `block` secs recorded on `dev`, endlessly."""
+    blocks = queue.Queue()
+
+    def callback(indata, frames, time_info, status):
+        blocks.put(indata[:, 0].copy())
+
+    with sd.InputStream(device=dev,
+                        channels=1,
+                        samplerate=samplerate,
+                        dtype="float32",
+                        blocksize=int(samplerate * block),
+                        callback=callback):
+        while True:
+            yield blocks.get()
+
+
+class UtteranceSegmenter(object):
+    """Cuts the utterances out of an audio stream with an energy VAD.
+
+    A frame of `frame` secs is speech when its energy is `threshold_db`
+    over the noise floor. The floor follows a quieter room at once and a
+    louder one slowly, never below `min_floor_db`. An utterance starts
+    `preroll` secs before its first speech frame and ends after `hangover`
+    secs of silence. Those with less than `min_speech` secs of speech are
+    dropped as clicks, those longer than twice `duration` as room noise, the
+    others are trimmed around their energy centroid or zero padded to
+    `duration` secs.
+    """
+
+    def __init__(self,
+                 sr,
+                 duration,
+                 threshold_db=12.0,
+                 frame=0.02,
+                 preroll=0.1,
+                 hangover=0.3,
+                 min_speech=0.1,
+                 min_floor_db=-60.0,
+                 floor_rise=0.02):
+        self.clip_len = int(sr * duration)
+        self.frame_len = int(sr * frame)
+        self.threshold_db = threshold_db
+        self.preroll = collections.deque(maxlen=round(preroll / frame))
+        self.hangover = max(1, round(hangover / frame))
+        self.min_speech = max(1, round(min_speech / frame))
+        # a sound this long is the new room noise, not an utterance
+        self.max_frames = 2 * self.clip_len // self.frame_len
+        self.min_floor_db = min_floor_db
+        self.floor_rise = floor_rise
+        self.floor = None
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.frames = None  # of the utterance in progress
+        self.speech = 0  # its speech frames
+        self.silence = 0  # its trailing silent frames
+
+    def feed(self, samples):
+        """Add samples, returns the clips of the utterances that ended."""
+        self.pending = np.concatenate(
+            [self.pending, np.asarray(samples, dtype=np.float32)])
+        n = len(self.pending) // self.frame_len
+        frames = self.pending[:n * self.frame_len].reshape(n, self.frame_len)
+        self.pending = self.pending[n * self.frame_len:]
+        energy = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+        clips = []
+        for frame, e in zip(frames, energy):
+            clip = self.add_frame(frame, e)
+            if clip is not None:
+                clips.append(clip)
+        return clips
+
+    def flush(self):
+        """End the stream, returns the clip of the utterance in progress."""
+        clip = self.end() if self.frames is not None else None
+        return [] if clip is None else [clip]
+
+    def add_frame(self, frame, energy):
+        if self.floor is None:
+            self.floor = max(energy, self.min_floor_db)
+        voiced = energy > self.floor + self.threshold_db
+        if not voiced:
+            self.floor = max(
+                self.min_floor_db,
+                min(energy, self.floor + self.floor_rise *
+                    (energy - self.floor)))
+        if self.frames is None:
+            if not voiced:
+                self.preroll.append(frame)
+                return None
+            self.frames = list(self.preroll)
+            self.preroll.clear()
+            self.speech = self.silence = 0
+        self.frames.append(frame)
+        if voiced:
+            self.speech += 1
+            self.silence = 0
+        else:
+            self.silence += 1
+        if len(self.frames) >= self.max_frames:
+            # the room got louder, drop the sound instead of a clip of it
+            self.floor = energy
+            self.frames = None
+            return None
+        if self.silence < self.hangover:
+            return None
+        return self.end()
+
+    def end(self):
+        frames, self.frames = self.frames, None
+        if self.speech < self.min_speech:
+            return None
+        return self.fit(np.concatenate(frames))
+
+    def fit(self, audio):
+        if len(audio) > self.clip_len:
+            power = audio.astype(np.float64)**2
+            center = int(
+                np.sum(np.arange(len(audio)) * power) /
+                max(np.sum(power), 1e-10))
+            start = min(max(0, center - self.clip_len // 2),
+                        len(audio) - self.clip_len)
+            return audio[start:start + self.clip_len]
+        pad = self.clip_len - len(audio)
+        return np.pad(audio, (pad // 2, pad - pad // 2))
+
+
+def stop_recording():
+    """Abort a `record_voice` in progress, safe from any thread."""
+    sd.stop()
+
+
+def decode_audio(data, sr=VOICE_SAMPLERATE):
+    """Decode audio file bytes to a mono float32 array at `sr`.
+
+    WAV is parsed in memory, anything else (e.g. the webm/ogg of browser
+    recorders) is piped through ffmpeg. No temp file is written.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        file_sr, audio = scipy.io.wavfile.read(io.BytesIO(data))
+        if audio.dtype.kind in "iu":
+            # scale integer PCM to [-1, 1), 8 bit wav is unsigned
+            info = np.iinfo(audio.dtype)
+            audio = (audio.astype(np.float32) - (info.max + info.min + 1) / 2
+                    ) / ((info.max - info.min + 1) / 2)
+        audio = audio.astype(np.float32)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+        if file_sr != sr:
+            audio = librosa.resample(audio, orig_sr=file_sr, target_sr=sr)
+        return audio
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-f",
+        "f32le", "-ac", "1", "-ar",
+        str(sr), "pipe:1"
+    ]
+    try:
+        proc = subprocess.run(cmd,
+                              input=data,
+                              capture_output=True,
+                              check=False)
+    except FileNotFoundError as e:
+        raise ValueError("ffmpeg is needed to decode non-wav audio") from e
+    if proc.returncode != 0:
+        raise ValueError(f"Cannot decode audio: "
+                         f"{proc.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(proc.stdout, dtype=np.float32)
+
+
 def save_voice(data, fn):
     scipy.io.wavfile.write(fn, VOICE_SAMPLERATE, np.int16(data * 32767))
 
@@ -79,6 +315,36 @@ def make_spectrogram(audio_array, n_fft=2048, hop_length=512):
     return d
 
 
+class StreamingSTFT(object):
+    """The STFT of a stream, a column per `hop_length` samples as they come.
+
+    Magnitudes are in dB of full scale, clipped at `floor_db`: unlike
+    `make_spectrogram` there is no max to refer to until the stream ends.
+    """
+
+    def __init__(self, n_fft=512, hop_length=256, floor_db=-80.0):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.floor_db = floor_db
+        self.window = np.hanning(n_fft).astype(np.float32)
+        self.scale = 2 / self.window.sum()  # a full scale sine is 0 dB
+        self.pending = np.zeros(0, dtype=np.float32)
+
+    def feed(self, samples):
+        """Add samples, returns the new (n_fft // 2 + 1, n) columns."""
+        self.pending = np.concatenate(
+            [self.pending, np.asarray(samples, dtype=np.float32)])
+        n = (len(self.pending) - self.n_fft) // self.hop_length + 1
+        if n <= 0:
+            return np.zeros((self.n_fft // 2 + 1, 0), dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(
+            self.pending, self.n_fft)[:n * self.hop_length:self.hop_length]
+        spectrum = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        self.pending = self.pending[n * self.hop_length:]
+        db = 20 * np.log10(np.maximum(spectrum * self.scale, 1e-10))
+        return np.maximum(db, self.floor_db).T.astype(np.float32)
+
+
 def draw_spectrogram(ax, data, samplerate, title=True, xlabel=True):
     n_fft = 2048
     hop_length = 512
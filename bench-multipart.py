@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Compare the streaming multipart parser with the email module parser"""
+
+import argparse
+import io
+import os
+import statistics
+import time
+import tracemalloc
+import wave
+from email.parser import BytesParser
+from email.policy import default
+
+import multipart
+
+BOUNDARY = "----WebKitFormBoundary7MA4YWxkTrZu0gW"
+
+
+def make_form(secs, sr):
+    """A multipart form with a noise wav clip of `secs` in field audio."""
+    clip = io.BytesIO()
+    with wave.open(clip, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(os.urandom(int(secs * sr) * 2))
+    return (f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="audio"; '
+            f'filename="voice_cmd.wav"\r\n'
+            f"Content-Type: audio/wav\r\n\r\n").encode() + clip.getvalue() + (
+                f"\r\n--{BOUNDARY}--\r\n").encode()
+
+
+def parse_email(rfile, length):
+    """The parsing formerly done in `do_POST`."""
+    body = rfile.read(length)
+    content_type = f"multipart/form-data; boundary={BOUNDARY}"
+    msg = BytesParser(policy=default).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    for part in msg.iter_parts():
+        if part.get_param("name", header="content-disposition") == "audio":
+            return part.get_payload(decode=True)
+    return None
+
+
+def parse_stream(rfile, length):
+    return multipart.read_field(rfile, length, BOUNDARY, "audio", 64 << 20)
+
+
+def measure(parse, form, repeat):
+    times = []
+    for _ in range(repeat):
+        rfile = io.BytesIO(form)
+        t0 = time.perf_counter()
+        parse(rfile, len(form))
+        times.append(time.perf_counter() - t0)
+    rfile = io.BytesIO(form)
+    tracemalloc.start()
+    parse(rfile, len(form))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--secs",
+                        type=float,
+                        nargs="+",
+                        default=[1, 5, 10, 30],
+                        help="clip lengths (default: %(default)s)")
+    parser.add_argument("--sr",
+                        type=int,
+                        default=48000,
+                        help="clip sample rate (default: %(default)s)")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=5,
+                        help="runs to take the median of (default: "
+                        "%(default)s)")
+    args = parser.parse_args()
+    for secs in args.secs:
+        form = make_form(secs, args.sr)
+        assert parse_email(io.BytesIO(form), len(form)) == parse_stream(
+            io.BytesIO(form), len(form))
+        print(f">>> {secs:g}s clip, {len(form) / 1024:.0f}KiB upload")
+        for name, parse in (("email", parse_email), ("stream", parse_stream)):
+            latency, peak = measure(parse, form, args.repeat)
+            print(f"  {name:>6}: {latency * 1000:8.2f}ms, "
+                  f"peak {peak / 1024:8.0f}KiB "
+                  f"({peak / len(form):.1f}x upload)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Load test the control server on the simulated board"""
+
+import argparse
+import collections
+import contextlib
+import glob
+import http.client
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+import gpio_backend
+import server
+
+# endpoint -> weight of the mixed workload
+WORKLOAD = {
+    "page": 3,
+    "jog": 5,
+    "full": 1,
+    "region": 1,
+    "jobs": 2,
+    "metrics": 1,
+    "voice": 2,
+}
+JOGS = ("up", "down", "left", "right")
+# raw requests whose request line does not parse, and the expected status
+BAD_REQUESTS = (
+    (b"garbage\r\n\r\n", "400"),
+    (b"GET /" + b"a" * 70000 + b" HTTP/1.1\r\n\r\n", "414"),
+    (b"GET / HTTP/2.0\r\n\r\n", "505"),
+)
+
+
+def make_upload(fn):
+    """A multipart form with the wav file `fn` in field audio."""
+    boundary = uuid.uuid4().hex
+    with open(fn, "rb") as f:
+        audio = f.read()
+    body = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="audio"; '
+            f'filename="{os.path.basename(fn)}"\r\n'
+            f"Content-Type: audio/wav\r\n\r\n").encode() + audio + (
+                f"\r\n--{boundary}--\r\n").encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class Client(threading.Thread):
+    """A phone on the page, sending the mixed workload on one connection."""
+
+    def __init__(self, address, uploads, deadline, results, seed):
+        super().__init__(daemon=True)
+        self.address = address
+        self.uploads = uploads
+        self.deadline = deadline
+        self.results = results
+        self.random = random.Random(seed)
+        self.etag = None
+
+    def request(self, conn, endpoint):
+        headers = {"Accept-Encoding": "gzip"}
+        body = None
+        method = "GET"
+        if endpoint == "page":
+            path = "/"
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+        elif endpoint == "jog":
+            path = "/action/" + self.random.choice(JOGS)
+        elif endpoint == "full":
+            path = "/action/full"
+        elif endpoint == "region":
+            x, y = self.random.random() * 0.4, self.random.random() * 0.2
+            path = f"/action/region?rect={x:.2f},{y:.2f},{x+0.1},{y+0.1}"
+        elif endpoint == "jobs":
+            path = "/jobs"
+        elif endpoint == "metrics":
+            path = "/metrics"
+        else:
+            method = "POST"
+            path = "/action/voice_cmd"
+            body, headers["Content-Type"] = self.random.choice(self.uploads)
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if endpoint == "page":
+            self.etag = response.getheader("ETag", self.etag)
+        return response.status, response.will_close
+
+    def run(self):
+        endpoints = [e for e in WORKLOAD if e != "voice" or self.uploads]
+        weights = [WORKLOAD[e] for e in endpoints]
+        conn = http.client.HTTPConnection(*self.address, timeout=30)
+        while time.monotonic() < self.deadline:
+            endpoint = self.random.choices(endpoints, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                status, will_close = self.request(conn, endpoint)
+            except (OSError, http.client.HTTPException) as e:
+                status, will_close = type(e).__name__, True
+            self.results.append(
+                (endpoint, status, time.perf_counter() - t0, time.monotonic()))
+            if will_close:
+                conn.close()
+                conn = http.client.HTTPConnection(*self.address, timeout=30)
+        conn.close()
+
+
+def check_bad_requests(address):
+    """Send BAD_REQUESTS, returns those not counted with their status.
+
+    The status is read from the metrics, an error to a request line that
+    did not parse is sent without a status line, as HTTP/0.9.
+    """
+    failures = []
+    for raw, code in BAD_REQUESTS:
+        labels = {
+            "method": server.BAD_REQUEST,
+            "route": server.BAD_REQUEST,
+            "code": code
+        }
+        before = server.HTTP_REQUESTS.get(**labels)
+        with socket.create_connection(address, timeout=5) as sock:
+            sock.sendall(raw)
+            # the server counts the request before it closes
+            while sock.recv(4096):
+                pass
+        counted = server.HTTP_REQUESTS.get(**labels) - before
+        if counted != 1:
+            failures.append(f"{raw[:20]!r}...: counted {counted} times "
+                            f"as {code}")
+    return failures
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def report(results, elapsed):
+    by_endpoint = collections.defaultdict(list)
+    for endpoint, status, latency, _ in results:
+        by_endpoint[endpoint].append((status, latency))
+    print(f">>> {len(results)} requests in {elapsed:.1f}s, "
+          f"{len(results) / elapsed:.0f} req/s")
+    print(f"{'endpoint':>8} {'count':>6} {'req/s':>7} {'p50ms':>7} "
+          f"{'p90ms':>7} {'p99ms':>7} {'maxms':>7}  status")
+    for endpoint in WORKLOAD:
+        rows = by_endpoint.get(endpoint)
+        if not rows:
+            continue
+        latencies = [latency * 1000 for _, latency in rows]
+        codes = collections.Counter(str(status) for status, _ in rows)
+        codes = " ".join(f"{k}:{v}" for k, v in sorted(codes.items()))
+        print(f"{endpoint:>8} {len(rows):>6} {len(rows) / elapsed:>7.1f} "
+              f"{percentile(latencies, 50):>7.2f} "
+              f"{percentile(latencies, 90):>7.2f} "
+              f"{percentile(latencies, 99):>7.2f} "
+              f"{max(latencies):>7.2f}  {codes}")
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients",
+                        type=int,
+                        default=20,
+                        help="concurrent clients (default: %(default)s)")
+    parser.add_argument("--duration",
+                        type=float,
+                        default=10.0,
+                        help="secs to run (default: %(default)s)")
+    parser.add_argument("--data-dir",
+                        default=os.path.join(script_dir, "data"),
+                        help="voice clips to upload (default: %(default)s)")
+    parser.add_argument("--model-spec",
+                        help="voice model spec, to also run the recognizer")
+    parser.add_argument("--rate",
+                        type=float,
+                        help="actions/s per client IP, all the clients "
+                        "share one (default: the server's)")
+    parser.add_argument("--motor-spec",
+                        default=os.path.join(script_dir, "motor_spec.json"),
+                        help="motor spec file (default: %(default)s)")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="only check that malformed requests are "
+                        "answered and counted")
+    args = parser.parse_args()
+
+    with open(args.motor_spec, encoding="utf8") as f:
+        gpio = gpio_backend.SimBackend.from_motor_spec(json.load(f))
+    if args.model_spec:
+        server.load_voice_model(args.model_spec)
+    httpd, _ = server.build_server(("127.0.0.1", 0),
+                                   args.motor_spec,
+                                   args.model_spec,
+                                   gpio=gpio,
+                                   persist=False)
+    if args.rate is not None:
+        httpd.dispatcher.rate = args.rate
+        httpd.dispatcher.burst = max(1, args.rate)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    if args.check:
+        failures = check_bad_requests(httpd.server_address)
+        httpd.shutdown()
+        httpd.server_close()
+        if failures:
+            raise SystemExit("Bad requests check failed:\n  " +
+                             "\n  ".join(failures))
+        print(f">>> {len(BAD_REQUESTS)} bad requests answered and counted")
+        return
+
+    uploads = [
+        make_upload(fn)
+        for fn in sorted(glob.glob(os.path.join(args.data_dir, "*", "*.wav")))
+    ]
+    print(f">>> {args.clients} clients for {args.duration}s, "
+          f"{len(uploads)} voice clips")
+    results = []  # appending to a list is thread safe
+    t0 = time.monotonic()
+    clients = [
+        Client(httpd.server_address, uploads, t0 + args.duration, results, i)
+        for i in range(args.clients)
+    ]
+    # the action handlers print every action, until the worker is stopped
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.monotonic() - t0
+            stats = httpd.dispatcher.stats()
+            jobs = httpd.jobs.list()
+            httpd.shutdown()
+            httpd.server_close()
+            httpd.jobs.worker.join()
+    report(results, elapsed)
+    print(f">>> dispatch {stats}, {len(jobs)} jobs kept, "
+          f"simulated motion {gpio.monotonic():.0f}s")
+
+
+if __name__ == "__main__":
+    main()
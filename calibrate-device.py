@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # coding: utf8
+"""Calibrate the motors and write the result into the motor spec file"""
 
 import driver
+import gpio_backend
 import json
 import argparse
 
@@ -19,7 +21,7 @@ def calibrate(output_fn):
         print("=========== Calibrating motor y ===========")
         y_data = motor_y.calibrate(1000, devices["motor_y"]["length"])
         print("=========== Calibrating motor z ===========")
-        z_data = motor_z.calibrate(4000, devices["motor_y"]["length"])
+        z_data = motor_z.calibrate(4000, devices["motor_z"]["length"])
         if x_data["swap_bounds"]:
             pins = devices["motor_x"]["pins"]
             pins[-2], pins[-1] = pins[-1], pins[-2]
@@ -35,9 +37,61 @@ def calibrate(output_fn):
         json.dump(data, f, indent=2)
 
 
+def sweep(output_fn, freqs, simulate=False, sim_stall_freq=None):
+    """Measure the frequency to speed curve of the x and y motors.
+
+    Needs the directions and bounds from a previous `calibrate`, and runs
+    without any human input. The motor z has no end switch to time its
+    moves, it keeps its single point calibration.
+    """
+    with open(output_fn, "r", encoding="utf8") as f:
+        data = json.load(f)
+    if simulate:
+        center = {"x": 0.3, "y": 0.3}
+        sim = gpio_backend.SimBackend.from_motor_spec(data, center)
+        for axis in sim.axes.values():
+            axis.stall_freq = sim_stall_freq
+        gpio_backend.set_backend(sim)
+    with driver.GpioManager() as _:
+        devices = data["devices"]
+        for axis in ("x", "y"):
+            print(f"=========== Sweeping motor {axis} ===========")
+            device = devices[f"motor_{axis}"]
+            spec = data[f"motor_{axis}"]
+            motor = driver.BoundedStepperMotor(*device["pins"])
+            spec.update(
+                motor.calibrate_curve(freqs, device["length"],
+                                      spec["clockwise"]))
+            print(f">>> Curve: {spec['curve']}, "
+                  f"stall frequency: {spec['stall_freq']}")
+    if simulate:
+        return
+    with open(output_fn, "w", encoding="utf8") as f:
+        json.dump(data, f, indent=2)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("CONFIG_FILE", help="Config file name")
+    parser.add_argument("--sweep",
+                        action="store_true",
+                        help="only measure the speed curve of x and y")
+    parser.add_argument("--freqs",
+                        type=int,
+                        nargs="+",
+                        default=[500, 1000, 1500, 2000, 3000, 4000, 6000],
+                        help="PWM frequencies to sweep (default: %(default)s)")
+    parser.add_argument("--simulate",
+                        action="store_true",
+                        help="sweep on the simulator and write nothing")
+    parser.add_argument("--sim-stall-freq",
+                        type=int,
+                        help="frequency the simulated motors stall at")
     args = parser.parse_args()
 
-    calibrate(args.CONFIG_FILE)
+    if args.sweep:
+        sweep(args.CONFIG_FILE, args.freqs, args.simulate,
+              args.sim_stall_freq)
+    else:
+        calibrate(args.CONFIG_FILE)
+        sweep(args.CONFIG_FILE, args.freqs)
@@ -0,0 +1,644 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Motion routines of the smart blackboard, shared by the GUI and server"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import gpio_backend
+import metrics
+import path_planner
+import telemetry
+from driver import BoundedStepperMotor, StepperMotor, Pump
+from driver import CancelToken, MotionCancelled
+
+
+MOVE_SECONDS = metrics.histogram("motor_move_seconds",
+                                 "Duration of each motor move",
+                                 ["axis", "reason"])
+MOVE_BACKOFF = metrics.counter("motor_backoff_seconds_total",
+                               "Secs spent backing off the end switches",
+                               ["axis"])
+POSITION = metrics.gauge("carriage_position_meters",
+                         "Tracked carriage position, -1 when unknown",
+                         ["axis"])
+ROUTINE_SECONDS = metrics.histogram("routine_seconds",
+                                    "Duration of the motion routines",
+                                    ["routine"])
+
+
+def cancellable(routine):
+    """Run a motion routine under the controller's cancel token.
+
+    Routines run one at a time, a routine called from another thread waits
+    for the running one. Only the outermost routine resets the token, unless
+    it was armed, and swallows MotionCancelled, so a cancel unwinds nested
+    routines (e.g. `reset` inside `full_clean`).
+    """
+
+    @functools.wraps(routine)
+    def wrapper(self, *args, **kwargs):
+        with self.motion_lock:
+            if self._routine_depth == 0:
+                if self._armed:
+                    self._armed = False  # a stop since `arm` still counts
+                else:
+                    self.cancel_token.reset()
+            self._routine_depth += 1
+            t0 = self.gpio.monotonic()
+            try:
+                return routine(self, *args, **kwargs)
+            except MotionCancelled:
+                if self._routine_depth > 1:
+                    raise
+                logging.info("Routine %s cancelled", routine.__name__)
+            finally:
+                self._routine_depth -= 1
+                ROUTINE_SECONDS.observe(self.gpio.monotonic() - t0,
+                                        routine=routine.__name__)
+
+    return wrapper
+
+
+def speed_at(spec, freq):
+    """Carriage speed in m/s at a PWM frequency from a calibrated spec.
+
+    Interpolates the measured frequency to speed curve when the spec has
+    one, otherwise scales the single calibration point linearly.
+    """
+    curve = spec.get("curve")
+    if not curve:
+        return spec["speed"] * freq / spec["freq"]
+    if freq <= curve[0][0]:
+        return curve[0][1] * freq / curve[0][0]
+    for (f0, s0), (f1, s1) in zip(curve, curve[1:]):
+        if freq <= f1:
+            return s0 + (s1 - s0) * (freq - f0) / (f1 - f0)
+    return curve[-1][1] * freq / curve[-1][0]
+
+
+def format_spec(data):
+    """A motor spec as JSON laid out like the hand written file.
+
+    Lists of numbers stay on one line, so a rewrite only changes values.
+    """
+    text = json.dumps(data, indent=2)
+    text = re.sub(
+        r"\[([-+\d.eE,\s]+)\]", lambda m: "[ " + ", ".join(
+            v.strip() for v in m.group(1).split(",")) + " ]", text)
+    return text + "\n"
+
+
+class SpeedTracker(object):
+    """Corrects the calibrated motor speeds from the end switch hits.
+
+    Hitting an end switch anchors the carriage. Between anchors at opposite
+    ends the true displacement is known, and its ratio to the displacement
+    estimated from the speeds and move durations gives a correction. The
+    correction is smoothed by an exponential moving average with `alpha`.
+    Corrected speeds are written back into `spec_path` at most once every
+    `min_interval` secs.
+    """
+
+    def __init__(self,
+                 specs,
+                 lengths,
+                 spec_path=None,
+                 alpha=0.3,
+                 max_error=0.3,
+                 min_interval=300.0):
+        self.specs = specs
+        self.lengths = lengths
+        self.spec_path = spec_path
+        self.alpha = alpha
+        self.max_error = max_error
+        self.min_interval = min_interval
+        self.anchor = {}  # carriage position after the last switch hit
+        self.odometry = {}  # estimated displacement since the anchor
+        self.dirty = False
+        self.last_write = None
+
+    def backoff(self, axis):
+        """Distance a drive backs off after a switch hit (50 steps)."""
+        spec = self.specs[axis]
+        return 50 * spec["speed"] / spec["freq"]
+
+    def lost(self, axis):
+        self.anchor.pop(axis, None)
+        self.odometry.pop(axis, None)
+
+    def moved(self, axis, forward, freq, elapsed, contact=None):
+        """Account a move, `contact` is the limit position hit if any.
+
+        Returns the carriage position after the back-off on a hit.
+        """
+        if axis in self.odometry:
+            distance = speed_at(self.specs[axis], freq) * elapsed
+            self.odometry[axis] += distance if forward else -distance
+        if contact is None:
+            return None
+        if axis in self.anchor:
+            actual = contact - self.anchor[axis]
+            estimated = self.odometry[axis]
+            # only a span across the board tells much about the speed
+            if (abs(actual) >= self.lengths[axis] / 2 and
+                    actual * estimated > 0):
+                self.correct(axis, actual / estimated)
+        backoff = self.backoff(axis)
+        self.anchor[axis] = contact - backoff if forward else contact + backoff
+        self.odometry[axis] = 0.0
+        return self.anchor[axis]
+
+    def correct(self, axis, ratio):
+        if abs(ratio - 1) > self.max_error:
+            logging.warning("Ignore %s speed ratio %.3f, stalled or pushed?",
+                            axis, ratio)
+            return
+        factor = 1 + self.alpha * (ratio - 1)
+        spec = self.specs[axis]
+        spec["speed"] *= factor
+        for point in spec.get("curve", []):
+            point[1] *= factor
+        self.dirty = True
+        logging.info("Motor %s runs at %.3f of its speed, now %.5fm/s", axis,
+                     ratio, spec["speed"])
+        self.persist()
+
+    def persist(self, force=False):
+        """Write the corrected speeds, at most once per `min_interval`."""
+        if not self.spec_path or not self.dirty:
+            return
+        now = time.monotonic()
+        if (not force and self.last_write is not None and
+                now - self.last_write < self.min_interval):
+            return
+        try:
+            with open(self.spec_path, encoding="utf8") as f:
+                data = json.load(f)
+            for axis in self.lengths:
+                data[f"motor_{axis}"] = self.specs[axis]
+            tmp_fn = self.spec_path + ".tmp"
+            with open(tmp_fn, "w", encoding="utf8") as f:
+                f.write(format_spec(data))
+            os.replace(tmp_fn, self.spec_path)
+            self.dirty = False
+        except OSError as e:
+            # e.g. a read-only or full SD card, never stop the routine,
+            # try again after `min_interval`
+            logging.error("Cannot save the motor speeds to %s: %s",
+                          self.spec_path, e)
+        self.last_write = now
+
+
+class BlackboardController(object):
+    """Drives the x/y/z motors and the pump of the blackboard eraser."""
+
+    def __init__(self,
+                 motor_conf,
+                 gpio=None,
+                 spec_path=None,
+                 telemetry_file=None):
+        self.gpio = gpio or gpio_backend.get_backend()
+        self.telemetry = telemetry.Telemetry(log_file=telemetry_file)
+        # called as listener(event, data) on each move and its end
+        self.listeners = []
+        self.cancel_token = CancelToken()
+        # the motors, the pins and the routine state are not thread safe
+        self.motion_lock = threading.RLock()
+        self._routine_depth = 0
+        self._armed = False
+        devices = motor_conf["devices"]
+        self.pump = Pump(devices["pump"]["pin"], gpio=self.gpio)
+        self.motors = {}
+        self.specs = {}
+        self.motors["x"] = BoundedStepperMotor(*devices["motor_x"]["pins"],
+                                               gpio=self.gpio)
+        self.motors["y"] = BoundedStepperMotor(*devices["motor_y"]["pins"],
+                                               gpio=self.gpio)
+        self.motors["z"] = StepperMotor(*devices["motor_z"]["pins"],
+                                        gpio=self.gpio)
+        self.specs["x"] = motor_conf["motor_x"]
+        self.specs["y"] = motor_conf["motor_y"]
+        self.specs["z"] = motor_conf["motor_z"]
+        self.dx = 0.1  # 0.1m per step on x
+        self.dy = 0.1  # 0.1m per step on y
+        self.dz = 0.01  # 0.01m per step on z
+        self.width = devices["motor_x"]["length"]
+        self.height = devices["motor_y"]["length"]
+        self.eraser_width = devices.get("eraser", {}).get("width", self.dy)
+        self.last_clean = None
+        # carriage position in board coordinates, unknown until homed
+        self.position = {"x": None, "y": None}
+        self.speed_tracker = SpeedTracker(self.specs, {
+            "x": self.width,
+            "y": self.height
+        }, spec_path)
+
+    @classmethod
+    def from_file(cls, motor_spec, gpio=None, telemetry_file=None):
+        with open(motor_spec, encoding="utf8") as f:
+            motor_conf = json.load(f)
+        return cls(motor_conf,
+                   gpio=gpio,
+                   spec_path=motor_spec,
+                   telemetry_file=telemetry_file)
+
+    def flush(self):
+        """Persist the pending speed corrections now."""
+        self.speed_tracker.persist(force=True)
+
+    def drive_motor(self,
+                    motor,
+                    length,
+                    forward=True,
+                    speed_mul=1.0,
+                    homing=False):
+        """Drive `length` metres, a homing move expects an end switch hit."""
+        spec = self.specs[motor]
+        freq = spec["freq"] * speed_mul  # increase speed by increase freq
+        if spec.get("curve") and freq > spec["curve"][-1][0]:
+            # never go beyond the fastest measured (and not stalled) freq
+            logging.warning("Limit %s freq %.0fHz to %.0fHz", motor, freq,
+                            spec["curve"][-1][0])
+            freq = spec["curve"][-1][0]
+        speed = speed_at(spec, freq)
+        clockwise = spec["clockwise"]
+        if not forward:
+            clockwise = not clockwise
+        self._notify("move", {
+            "axis": motor,
+            "length": length,
+            "forward": forward,
+            "homing": homing
+        })
+        t0 = self.gpio.monotonic()
+        if getattr(self.gpio, "hardware_pulses", False):
+            # exact pulse counts, the calibrated spec gives metres per step
+            nsteps = round(length * spec["freq"] / spec["speed"])
+            result = self.motors[motor].drive_steps(nsteps,
+                                                    freq=freq,
+                                                    dc=0.5,
+                                                    clockwise=clockwise,
+                                                    cancel=self.cancel_token)
+        else:
+            duration = length / speed
+            result = self.motors[motor].drive(duration,
+                                              freq=freq,
+                                              dc=0.5,
+                                              clockwise=clockwise,
+                                              cancel=self.cancel_token)
+        # the time beyond the drive itself is spent backing off the switch
+        backoff = self.gpio.monotonic() - t0 - result.elapsed
+        expected = length
+        if homing and self.position.get(motor) is not None:
+            # the switch is due once the carriage crosses the board
+            limit = self.width if motor == "x" else self.height
+            pos = self.position[motor]
+            expected = limit - pos if forward else pos
+        self.telemetry.record(motor, expected, freq, expected / speed,
+                              result.elapsed, backoff, result.reason, homing)
+        MOVE_SECONDS.observe(result.elapsed, axis=motor, reason=result.reason)
+        MOVE_BACKOFF.inc(backoff, axis=motor)
+        self._track(motor, length, forward, freq, result, homing)
+        if motor in self.position:
+            pos = self.position[motor]
+            POSITION.set(-1 if pos is None else pos, axis=motor)
+        self._notify(
+            "collision" if result.reason == "collision" else "moved", {
+                "axis": motor,
+                "reason": result.reason,
+                "elapsed": result.elapsed,
+                "position": dict(self.position)
+            })
+        if result.reason == "cancelled":
+            raise MotionCancelled()
+        return result
+
+    def _notify(self, event, data):
+        for listener in self.listeners:
+            listener(event, data)
+
+    def _track(self, motor, length, forward, freq, result, homing=False):
+        if motor not in self.position:
+            return
+        limit = self.width if motor == "x" else self.height
+        if result.reason == "cancelled" or (homing and
+                                            result.reason != "collision"):
+            # a homing move that ends short of the switch stalled somewhere
+            self.speed_tracker.lost(motor)
+            self.position[motor] = None
+        elif result.reason == "collision":
+            contact = limit if forward else 0.0
+            # the drive backed off a little from the end switch
+            self.position[motor] = self.speed_tracker.moved(
+                motor, forward, freq, result.elapsed, contact)
+        else:
+            self.speed_tracker.moved(motor, forward, freq, result.elapsed)
+            if self.position[motor] is not None:
+                pos = self.position[motor] + (length if forward else -length)
+                self.position[motor] = min(max(pos, 0.0), limit)
+
+    def go(self, direction, nsteps, reverse=False, speed_mul=1.0,
+           homing=False):
+        if direction == "x":
+            self.drive_motor("x", self.dx * nsteps, not reverse, speed_mul,
+                             homing)
+        elif direction == "y":
+            self.drive_motor("y", self.dy * nsteps, not reverse, speed_mul,
+                             homing)
+        else:
+            self.drive_motor("z", self.dz * nsteps, not reverse, speed_mul)
+
+    def stop(self):
+        """Pre-empt the running motion routine, safe from any thread."""
+        self.cancel_token.cancel()
+
+    def arm(self):
+        """Reset the cancel token ahead of the next routine.
+
+        A stop from now on cancels that routine, even one that has not
+        started yet. For a caller that reports the routine running before
+        calling it, e.g. the server's job queue.
+        """
+        with self.motion_lock:
+            self.cancel_token.reset()
+            self._armed = True
+
+    def spray(self, duration=0.5):
+        self.pump.drive(duration, cancel=self.cancel_token)
+        self.cancel_token.check()
+
+    @cancellable
+    def reset(self):
+        self.motors["x"].hold()
+        self.motors["y"].hold()
+        self.motors["z"].hold()
+        # Go to left bottom corner and ready cleaner
+        self.go("x", 100, reverse=True, homing=True)
+        self.go("y", 100, reverse=True, homing=True)
+        self.go("z", 2)
+
+    @cancellable
+    def manual(self):
+        self.position = {"x": None, "y": None}  # carriage moves by hand
+        self.speed_tracker.lost("x")
+        self.speed_tracker.lost("y")
+        self.go("z", 2, reverse=True)
+        self.motors["x"].release()
+        self.motors["y"].release()
+        self.motors["z"].release()
+
+    @cancellable
+    def go_right(self):
+        self.go("x", 1)
+
+    @cancellable
+    def go_left(self):
+        self.go("x", 1, reverse=True)
+
+    @cancellable
+    def go_up(self):
+        self.go("y", 1)
+
+    @cancellable
+    def go_down(self):
+        self.go("y", 1, reverse=True)
+
+    def plan_full_clean(self, planner=path_planner.plan_serpentine):
+        return planner(self.width, self.height, self.eraser_width)
+
+    def estimate(self, plan):
+        speeds = {axis: spec["speed"] for axis, spec in self.specs.items()}
+        return path_planner.estimate_duration(plan, speeds)
+
+    def run_plan(self, plan):
+        """Drive the moves and sprays of a path_planner plan in order."""
+        pending = []
+        try:
+            for step in plan:
+                if isinstance(step, path_planner.Spray):
+                    if step.at is None:
+                        self.spray(step.duration)
+                    else:
+                        pending.append(step)
+                    continue
+                # overlapped sprays start on the way of the next move
+                speed = self.specs[step.axis]["speed"]
+                for spray in pending:
+                    self.pump.pulse(spray.duration, delay=spray.at / speed)
+                pending = []
+                if step.homing:
+                    # go on until the end switch, like `reset`
+                    self.go(step.axis,
+                            100,
+                            reverse=not step.forward,
+                            homing=True)
+                else:
+                    self.drive_motor(step.axis, step.length, step.forward)
+        except MotionCancelled:
+            self.pump.cancel_pulses()
+            raise
+
+    @cancellable
+    def full_clean(self):
+        self.reset()
+        plan = self.plan_full_clean()
+        estimated = self.estimate(plan)
+        t0 = self.gpio.monotonic()
+        self.run_plan(plan)
+        actual = self.gpio.monotonic() - t0
+        self.last_clean = {"estimated": estimated, "actual": actual}
+        logging.info("Full clean took %.1fs, estimated %.1fs", actual,
+                     estimated)
+
+    def plan_regions(self, rects):
+        speeds = {axis: spec["speed"] for axis, spec in self.specs.items()}
+        start = (self.position["x"], self.position["y"])
+        return path_planner.plan_regions(rects,
+                                         start,
+                                         self.width,
+                                         self.height,
+                                         self.eraser_width,
+                                         speeds=speeds)
+
+    @cancellable
+    def clean_regions(self, rects):
+        """Clean only the given (x0, y0, x1, y1) rectangles, in metres."""
+        if None in self.position.values():
+            self.reset()  # also lowers the eraser
+        if None in self.position.values():
+            raise RuntimeError("The carriage did not reach the end switches")
+        plan = self.plan_regions(rects)
+        estimated = self.estimate(plan)
+        t0 = self.gpio.monotonic()
+        self.run_plan(plan)
+        actual = self.gpio.monotonic() - t0
+        self.last_clean = {"estimated": estimated, "actual": actual}
+        logging.info("Cleaned %d regions in %.1fs, estimated %.1fs",
+                     len(rects), actual, estimated)
+
+
+def simulate(motor_spec,
+             routine,
+             position=None,
+             hardware_pulses=False,
+             telemetry_file=None):
+    """Run a controller routine on the simulated board in virtual time.
+
+    Returns the simulator and the controller. The simulator's `now` is the
+    duration of the routine and each axis keeps the corners of its path in
+    `path`.
+    """
+    with open(motor_spec, encoding="utf8") as f:
+        motor_conf = json.load(f)
+    sim = gpio_backend.SimBackend.from_motor_spec(motor_conf, position,
+                                                  hardware_pulses)
+    controller = BlackboardController(motor_conf,
+                                      gpio=sim,
+                                      telemetry_file=telemetry_file)
+    t0 = sim.monotonic()
+    getattr(controller, routine)()
+    logging.info("Simulated %s in %.2fs (virtual)", routine,
+                 sim.monotonic() - t0)
+    return sim, controller
+
+
+def testfullclean(motor_spec):
+    """Run full_clean on the simulator, returns what is off in its run.
+
+    Checks the duration against the estimate and the path: a serpentine
+    sweep of every row from the home corner, and the distance travelled.
+    """
+    failures = []
+    for hardware_pulses in (False, True):
+        sim, controller = simulate(motor_spec,
+                                   "full_clean", {
+                                       "x": 0.3,
+                                       "y": 0.3
+                                   },
+                                   hardware_pulses=hardware_pulses)
+        run = f"full_clean, hardware pulses {hardware_pulses}"
+
+        def check(ok, message):
+            if not ok:
+                failures.append(f"{run}: {message}")
+
+        plan = controller.plan_full_clean()
+        rows = path_planner.row_positions(controller.height,
+                                          controller.eraser_width)
+        # the sweep takes about its estimate, the homing before it less
+        clean = controller.last_clean
+        if clean is None:
+            check(False, "did not finish")
+            continue
+        check(
+            abs(clean["actual"] - clean["estimated"]) <
+            0.1 * clean["estimated"],
+            f"sweep took {clean['actual']:.2f}s, estimated "
+            f"{clean['estimated']:.2f}s")
+        check(clean["actual"] < sim.now < 1.5 * clean["actual"],
+              f"took {sim.now:.2f}s for a {clean['actual']:.2f}s sweep")
+        # a serpentine: from the home corner, one x stroke per row,
+        # alternating sides, then back to the home corner
+        x = sim.axes["x"]
+        sides = [
+            p > x.length / 2 for _, p in x.path
+            if p < 0.01 or p > x.length - 0.01
+        ]
+        sides = [s for i, s in enumerate(sides) if i == 0 or s != sides[i - 1]]
+        strokes = [
+            m.forward for m in plan
+            if isinstance(m, path_planner.Move) and m.axis == "x"
+        ]
+        check(sides == [False] + strokes,
+              f"x went to the sides {sides}, planned {[False] + strokes}")
+        check(
+            len(strokes) == len(rows) + (len(rows) % 2),
+            f"{len(strokes)} x strokes for {len(rows)} rows, not a "
+            f"serpentine")
+        # each row is wiped, within the back-off from the end switches
+        y_stops = [p for _, p in sim.axes["y"].path]
+        for row in rows:
+            check(
+                min(abs(p - row) for p in y_stops) < 0.01,
+                f"y never stopped at the row {row:.3f}m")
+        check(sim.axes["y"].position < 0.01,
+              f"ends at y {sim.axes['y'].position:.3f}m, not home")
+        # homing from the start, the plan, and the switch back-offs
+        moved = path_planner.travel(plan)
+        for axis, start in (("x", 0.3), ("y", 0.3)):
+            travelled = sim.axes[axis].travelled
+            check(
+                abs(travelled - start - moved[axis]) < 0.05,
+                f"{axis} travelled {travelled:.3f}m, expected "
+                f"{start + moved[axis]:.3f}m")
+        print(f"{run}: {sim.now:.2f}s, sweep {clean['actual']:.2f}s for "
+              f"{clean['estimated']:.2f}s estimated, x {x.travelled:.3f}m, "
+              f"y {sim.axes['y'].travelled:.3f}m, {len(sides)} x sides")
+    return failures
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("routine",
+                        nargs="?",
+                        default="full_clean",
+                        choices=("full_clean", "reset", "manual", "go_right",
+                                 "go_left", "go_up", "go_down"),
+                        help="routine to run on the simulated board "
+                        "(default: %(default)s)")
+    parser.add_argument("--start",
+                        type=float,
+                        nargs=2,
+                        default=(0.3, 0.3),
+                        metavar=("X", "Y"),
+                        help="start position in metres (default: 0.3 0.3)")
+    parser.add_argument("--hardware-pulses",
+                        action="store_true",
+                        help="simulate a hardware-timed pulse backend")
+    parser.add_argument("--motor-spec",
+                        default=os.path.join(script_dir, "motor_spec.json"),
+                        help="motor spec file (default: %(default)s)")
+    parser.add_argument("--telemetry",
+                        help="also write the move records into this file")
+    parser.add_argument("--check",
+                        action="store_true",
+                        help="check the duration and path of full_clean "
+                        "instead")
+    args = parser.parse_args()
+    if args.check:
+        failures = testfullclean(args.motor_spec)
+        if failures:
+            raise SystemExit("full_clean check failed:\n  " +
+                             "\n  ".join(failures))
+        print(">>> full_clean check passed")
+        return
+    sim, controller = simulate(args.motor_spec, args.routine, {
+        "x": args.start[0],
+        "y": args.start[1]
+    }, args.hardware_pulses, args.telemetry)
+    print(f"Duration: {sim.now:.2f}s")
+    for name, axis in sim.axes.items():
+        print(f"Axis {name}: travelled {axis.travelled:.3f}m, "
+              f"ends at {axis.position:.3f}m, {len(axis.path)} path corners")
+    for pin, intervals in sim.pumps.items():
+        on_time = sum((end or sim.now) - start for start, end in intervals)
+        print(f"Pump {pin}: {len(intervals)} sprays, {on_time:.2f}s on")
+    for axis, stats in sorted(controller.telemetry.summary().items()):
+        print(f"Motor {axis}: {stats['moves']} moves, "
+              f"{stats['collisions']} collisions, "
+              f"{stats['actual']:.2f}s driven for {stats['planned']:.2f}s "
+              f"planned, {stats['backoff']:.2f}s backing off")
+    for alert in controller.telemetry.alerts:
+        print(f"Alert {alert.axis} {alert.kind}: {alert.message}")
+
+
+if __name__ == "__main__":
+    main()
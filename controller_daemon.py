@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""The controller daemon, sharing the motors and the voice model over IPC
+
+One process owns the GPIO (motors and pump) and the voice model, the Qt GUI
+and the HTTP server connect to it as thin clients over a Unix socket.
+
+The protocol is one JSON object per line in both directions:
+
+  request  {"id": 1, "cmd": "go_up", "args": []}
+  reply    {"id": 1, "result": null} or {"id": 1, "error": "..."}
+  event    {"event": "moved", "data": {...}}
+
+Motion commands run one at a time, in the order they get the motion lock
+of the controller, `stop` pre-empts the running one. `arm` returns the
+count of stops so far, a motion request sent with it as "armed" is
+cancelled by any stop since, even one before the motion starts. Requests of a
+connection are handled concurrently, so a client can stop its own motion.
+Every connection gets the controller events. Audio goes base64 encoded:
+float32 samples for `predict`, file bytes for `recognize`.
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import socketserver
+import threading
+
+DEFAULT_SOCKET = "/tmp/blackboard-controller.sock"
+# the largest audio file to recognize, the server's max_upload
+MAX_AUDIO = 8 << 20
+# the largest request line, base64 makes the audio 4/3 larger
+MAX_MESSAGE = MAX_AUDIO * 4 // 3 + (64 << 10)
+
+MOTIONS = ("reset", "manual", "go_up", "go_down", "go_left", "go_right",
+           "full_clean", "clean_regions")
+
+
+class DaemonError(ValueError):
+    """A command failed in the daemon, e.g. on an undecodable upload.
+
+    A ValueError, as the same failures are when the model is local.
+    """
+
+
+def encode(message):
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _request_id(line):
+    """The id of a request line that cannot be handled, from its start."""
+    match = re.match(rb'\s*\{"id":\s*(\d+)', line)
+    return int(match.group(1)) if match else None
+
+
+def _jsonable(result):
+    result = dict(result)
+    # the model reports numpy floats
+    result["details"] = {k: float(v) for k, v in result["details"].items()}
+    return result
+
+
+class Connection(object):
+    """A client of the daemon, its messages go out on a writer thread."""
+
+    def __init__(self, sock, max_pending=256):
+        self.sock = sock
+        self.queue = queue.Queue(max_pending)
+        self.closed = False
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, message):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(encode(message))
+        except queue.Full:
+            logging.warning("Dropping a client too slow to read")
+            self.close()
+
+    def write_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            # ends the reader too
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ControllerDaemonHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        conn = Connection(self.request)
+        self.server.add(conn)
+        try:
+            while True:
+                line = self.rfile.readline(MAX_MESSAGE + 1)
+                if not line:
+                    break
+                if len(line) > MAX_MESSAGE:
+                    conn.send({
+                        "id": _request_id(line),
+                        "error": f"Message exceeds {MAX_MESSAGE} bytes"
+                    })
+                    # skip the rest of it, the connection stays usable
+                    while line and not line.endswith(b"\n"):
+                        line = self.rfile.readline(MAX_MESSAGE + 1)
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    conn.send({
+                        "id": _request_id(line),
+                        "error": "Bad message"
+                    })
+                    continue
+                threading.Thread(target=self.server.execute,
+                                 args=(conn, request),
+                                 daemon=True).start()
+        except OSError:
+            pass  # the client went away
+        finally:
+            self.server.remove(conn)
+            conn.close()
+
+
+class ControllerDaemon(socketserver.ThreadingUnixStreamServer):
+    """Serves a controller and a voice model to the clients of `path`."""
+
+    daemon_threads = True
+
+    def __init__(self, path, controller, model=None):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)  # left by a daemon that died
+            else:
+                raise RuntimeError(f"A daemon is already serving {path}")
+            finally:
+                probe.close()
+        self.controller = controller
+        self.model = model
+        # the tflite interpreter is not thread safe, the controller
+        # serializes the motions itself
+        self.model_lock = threading.Lock()
+        self.stops = 0  # stop commands so far, see `arm`
+        self.stops_lock = threading.Lock()
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        super().__init__(path, ControllerDaemonHandler)
+        controller.listeners.append(self.publish)
+
+    def add(self, conn):
+        with self.connections_lock:
+            self.connections.add(conn)
+
+    def remove(self, conn):
+        with self.connections_lock:
+            self.connections.discard(conn)
+
+    def publish(self, event, data):
+        with self.connections_lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.send({"event": event, "data": data})
+
+    def execute(self, conn, request):
+        reply = {"id": request.get("id")}
+        try:
+            reply["result"] = self.call(request.get("cmd"),
+                                        request.get("args", []), request)
+        except Exception as e:
+            logging.exception("Command %s failed", request.get("cmd"))
+            reply["error"] = f"{type(e).__name__}: {e}"
+        conn.send(reply)
+
+    def call(self, cmd, args, request):
+        if cmd in MOTIONS:
+            armed = request.get("armed")
+            if armed is None:
+                getattr(self.controller, cmd)(*args)
+                return None
+            with self.controller.motion_lock:
+                self.controller.arm()
+                if self.stops != armed:
+                    self.controller.stop()  # a stop since the client armed
+                getattr(self.controller, cmd)(*args)
+            return None
+        if cmd == "stop":
+            with self.stops_lock:
+                self.stops += 1
+            self.controller.stop()
+        elif cmd == "arm":
+            return self.stops
+        elif cmd == "flush":
+            self.controller.flush()
+        elif cmd == "status":
+            model = self.model and {
+                "sr": self.model.model_sr,
+                "duration": self.model.model_duration,
+                "labels": list(self.model.label_strs)
+            }
+            return {"position": self.controller.position, "model": model}
+        elif cmd in ("predict", "recognize"):
+            if self.model is None:
+                raise ValueError("The daemon has no voice model")
+            data = base64.b64decode(request["audio"])
+            with self.model_lock:
+                if cmd == "recognize":
+                    result = self.model.recognize(data)
+                else:
+                    import numpy as np
+                    samples = np.frombuffer(data, dtype="<f4")
+                    result = self.model.predict(samples, request["sr"])
+            return _jsonable(result)
+        else:
+            raise ValueError(f"Unknown command {cmd}")
+        return None
+
+    def server_close(self):
+        super().server_close()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class ControllerClient(object):
+    """The controller of a daemon, shared by any number of threads.
+
+    Has the motion methods of BlackboardController, each blocks until the
+    daemon has run it, and calls its `listeners` with the daemon's events
+    on a reader thread. A lost connection fails the calls in flight, the
+    next call connects again.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = path
+        self.listeners = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pending = {}  # request id -> [done event, reply]
+        self.armed = None  # the daemon's stop count at `arm`
+        self.sock = None
+        self.reader = None
+        self.closed = False
+        with self.lock:
+            self.connect()
+
+    def connect(self):
+        """Connect to the daemon, with the lock held."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise ConnectionError(
+                f"Cannot connect to the controller daemon at {self.path}: "
+                f"{e}") from e
+        self.sock = sock
+        self.reader = threading.Thread(target=self.read_loop,
+                                       args=(sock,),
+                                       daemon=True)
+        self.reader.start()
+
+    def call(self, cmd, *args, **fields):
+        waiter = [threading.Event(), None]
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Controller daemon client closed")
+            request_id = next(self.ids)
+            data = encode({
+                "id": request_id,
+                "cmd": cmd,
+                "args": list(args),
+                **fields
+            })
+            if len(data) > MAX_MESSAGE:
+                raise DaemonError(f"The {cmd} request of {len(data)} bytes "
+                                  f"exceeds {MAX_MESSAGE} bytes")
+            if self.sock is None:
+                self.connect()  # the daemon restarted or dropped us
+            self.pending[request_id] = waiter
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                del self.pending[request_id]
+                raise ConnectionError(
+                    f"Controller daemon connection lost: {e}") from e
+        waiter[0].wait()
+        reply = waiter[1]
+        if reply is None:
+            raise ConnectionError("Controller daemon connection lost")
+        if "error" in reply:
+            raise DaemonError(reply["error"])
+        return reply["result"]
+
+    def read_loop(self, sock):
+        try:
+            for line in sock.makefile("rb"):
+                message = json.loads(line)
+                if "event" in message:
+                    for listener in self.listeners:
+                        listener(message["event"], message["data"])
+                    continue
+                with self.lock:
+                    waiter = self.pending.pop(message.get("id"), None)
+                if waiter is None:
+                    logging.warning("Daemon: %s", message.get("error"))
+                    continue
+                waiter[1] = message
+                waiter[0].set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+                pending, self.pending = self.pending, {}
+            sock.close()
+            for waiter in pending.values():
+                waiter[0].set()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sock, reader = self.sock, self.reader
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if reader is not None:
+            reader.join()
+
+    def stop(self):
+        """Pre-empt the running motion routine, safe from any thread."""
+        self.call("stop")
+
+    def arm(self):
+        """A stop from now on cancels the next routine, see the daemon."""
+        self.armed = self.call("arm")
+
+    def motion(self, cmd, *args):
+        armed, self.armed = self.armed, None
+        if armed is None:
+            self.call(cmd, *args)
+        else:
+            self.call(cmd, *args, armed=armed)
+
+    def reset(self):
+        self.motion("reset")
+
+    def manual(self):
+        self.motion("manual")
+
+    def go_right(self):
+        self.motion("go_right")
+
+    def go_left(self):
+        self.motion("go_left")
+
+    def go_up(self):
+        self.motion("go_up")
+
+    def go_down(self):
+        self.motion("go_down")
+
+    def full_clean(self):
+        self.motion("full_clean")
+
+    def clean_regions(self, rects):
+        self.motion("clean_regions", [list(r) for r in rects])
+
+    def flush(self):
+        self.call("flush")
+
+    def voice_model(self):
+        """The daemon's voice model, or None if it has none."""
+        info = self.call("status")["model"]
+        return info and RemoteVoiceModel(self, info)
+
+
+class RemoteVoiceModel(object):
+    """The VoiceCmdModel interface, predicting in the daemon."""
+
+    def __init__(self, client, info):
+        self.client = client
+        self.model_sr = info["sr"]
+        self.model_duration = info["duration"]
+        self.label_strs = info["labels"]
+
+    def predict(self, voice, sr):
+        import numpy as np
+        data = np.asarray(voice, dtype="<f4").tobytes()
+        return self.client.call("predict",
+                                audio=base64.b64encode(data).decode("ascii"),
+                                sr=sr)
+
+    def recognize(self, data):
+        return self.client.call("recognize",
+                                audio=base64.b64encode(data).decode("ascii"))
+
+
+def load_model(model_spec):
+    from voice_model import VoiceCmdModel
+    with open(model_spec, encoding="utf8") as f:
+        model_conf = json.load(f)
+    model_fn = os.path.join(os.path.dirname(model_spec), model_conf["fn"])
+    return VoiceCmdModel(model_fn, model_conf["sr"], model_conf["duration"],
+                         model_conf["feature"], **model_conf["args"])
+
+
+def main():
+    import gpio_backend
+    from controller import BlackboardController
+    from driver import GpioManager
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket",
+                        default=DEFAULT_SOCKET,
+                        help="Unix socket to listen on (default: "
+                        "%(default)s)")
+    parser.add_argument("--motor-spec",
+                        default=os.path.join(script_dir, "motor_spec.json"),
+                        help="motor spec file (default: %(default)s)")
+    parser.add_argument("--model-spec",
+                        default=os.path.join(script_dir, "model_spec.json"),
+                        help="voice model spec file (default: %(default)s)")
+    parser.add_argument("--simulate",
+                        action="store_true",
+                        help="drive the simulated board")
+    parser.add_argument("--gpio",
+                        choices=("rpi", "pigpio"),
+                        help="GPIO backend, pigpio times the step pulses "
+                        "in hardware (default: the motor spec's backend, "
+                        "or rpi)")
+    parser.add_argument("--telemetry",
+                        help="log the motor moves into this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        model = load_model(args.model_spec)
+    except (ImportError, OSError) as e:
+        logging.warning("Voice commands disabled: %s", e)
+        model = None
+
+    with open(args.motor_spec, encoding="utf8") as f:
+        motor_conf = json.load(f)
+    if args.simulate:
+        gpio = gpio_backend.SimBackend.from_motor_spec(motor_conf)
+    else:
+        gpio = gpio_backend.create_backend(args.gpio, motor_conf)
+    with GpioManager(gpio) as manager:
+        controller = BlackboardController(
+            motor_conf,
+            gpio=manager.gpio,
+            spec_path=None if args.simulate else args.motor_spec,
+            telemetry_file=args.telemetry)
+        daemon = ControllerDaemon(args.socket, controller, model)
+        logging.info("Controller daemon listening on %s", args.socket)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        controller.stop()
+        daemon.server_close()
+        controller.flush()
+
+
+if __name__ == "__main__":
+    main()
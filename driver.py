@@ -1,30 +1,126 @@
 #!/usr/bin/env python3
 """Driver for stepper motors"""
 
+import collections
 import time
-from RPi import GPIO
+import threading
+import gpio_backend
 import logging
+import metrics
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s [%(levelname)s] -- %(message)s",
                     datefmt="%Y-%m-%d %H:%M:%S")
 
 
+# Motion loops poll end switches and cancel tokens at this interval, which
+# bounds the cancellation latency to about one tick.
+TICK = 0.01
+
+# Outcome of a single drive: "done", "collision" or "cancelled".
+MoveResult = collections.namedtuple("MoveResult", ["reason", "elapsed"])
+
+CANCEL_LATENCY = metrics.histogram(
+    "motion_cancel_latency_seconds",
+    "Delay from a cancel request to the halted PWM")
+PUMP_SPRAYS = metrics.counter("pump_sprays_total", "Sprays of the pump",
+                              ["mode"])
+PUMP_SECONDS = metrics.counter("pump_spray_seconds_total",
+                               "Secs the pump sprayed or was asked to",
+                               ["mode"])
+
+
+class MotionCancelled(Exception):
+    """Raised by multi-step routines when their cancel token is set."""
+
+
+class CancelToken(object):
+    """A thread-safe flag to pre-empt in-flight moves.
+
+    Motors poll the token every `TICK` and stop PWM as soon as it is set. The
+    delay from `cancel()` to the halted PWM is kept in `latencies`.
+    """
+
+    def __init__(self, history=100):
+        self._event = threading.Event()
+        self._cancelled_at = None
+        self.latencies = collections.deque(maxlen=history)
+
+    def cancel(self):
+        self._cancelled_at = time.monotonic()
+        self._event.set()
+
+    def reset(self):
+        self._event.clear()
+        self._cancelled_at = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise MotionCancelled()
+
+    def report_stop(self):
+        """Record the latency from `cancel()` to the PWM stop."""
+        if self._cancelled_at is None:
+            return None
+        latency = time.monotonic() - self._cancelled_at
+        self._cancelled_at = None  # only the first stop after cancel counts
+        self.latencies.append(latency)
+        CANCEL_LATENCY.observe(latency)
+        logging.info("Motion cancelled, PWM halted after %.1f ms",
+                     latency * 1e3)
+        return latency
+
+
+def play_pulses(gpio, pin, train, cancel=None, switch=None):
+    """Play a pulse train on a hardware-timed backend until it is done.
+
+    Stops early when the `switch` pin sees a rising edge or `cancel` is set.
+    Returns "done", "collision" or "cancelled".
+    """
+    deadline = gpio.monotonic() + gpio_backend.pulse_train_duration(train)
+    gpio.send_pulses(pin, train)
+    reason = "done"
+    while gpio.pulses_busy(pin):
+        gpio.sleep(min(TICK, max(deadline - gpio.monotonic(), 1e-3)))
+        if switch is not None and gpio.event_detected(switch):
+            reason = "collision"
+            break
+        if cancel is not None and cancel.cancelled:
+            reason = "cancelled"
+            break
+    gpio.stop_pulses(pin)
+    return reason
+
+
 class GpioManager(object):
 
+    def __init__(self, gpio=None):
+        self.gpio = gpio or gpio_backend.get_backend()
+
     def __enter__(self):
-        GPIO.setmode(GPIO.BCM)
+        self.gpio.setmode(self.gpio.BCM)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        GPIO.cleanup()
+        self.gpio.cleanup()
         return False
 
 
 class StepperMotor(object):
     """A simple stepper motor with 3 control signals."""
 
-    def __init__(self, pin_en, pin_dir, pin_stp, freq=1000, dc=0.5):
+    def __init__(self,
+                 pin_en,
+                 pin_dir,
+                 pin_stp,
+                 freq=1000,
+                 dc=0.5,
+                 gpio=None):
+        self.gpio = gpio or gpio_backend.get_backend()
         self.pins = [pin_en, pin_dir, pin_stp]
         self.default_freq = freq
         self.default_dc = dc
@@ -32,7 +128,7 @@ class StepperMotor(object):
 
     def reset(self):
         for p in self.pins:
-            GPIO.setup(p, GPIO.OUT, initial=GPIO.LOW)
+            self.gpio.setup(p, self.gpio.OUT, initial=self.gpio.LOW)
 
     def calibrate(self, freq, length):
         print(f">> Calibrating with PWM freq {freq}Hz for length {length}m <<")
@@ -46,13 +142,14 @@ class StepperMotor(object):
         self.release()
         input(">>> Place the object to the forward start and press enter.")
         self.hold()
-        GPIO.output(self.pins[0], GPIO.HIGH)
-        GPIO.output(self.pins[1], GPIO.HIGH if clockwise else GPIO.LOW)
-        p = GPIO.PWM(self.pins[2], freq)
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1],
+                         self.gpio.HIGH if clockwise else self.gpio.LOW)
+        p = self.gpio.PWM(self.pins[2], freq)
         p.start(0.5 * 100)  # GPIO.PWM use dc from 0 to 100
-        t0 = time.clock_gettime_ns(time.CLOCK_MONOTONIC) * 1e-9
+        t0 = self.gpio.monotonic()
         input(">>> Press enter when the object reaches the other end")
-        t1 = time.clock_gettime_ns(time.CLOCK_MONOTONIC) * 1e-9
+        t1 = self.gpio.monotonic()
         p.stop()
         return {
             "clockwise": clockwise,
@@ -60,25 +157,55 @@ class StepperMotor(object):
             "speed": length / (t1 - t0)
         }
 
-    def drive(self, duration, freq, dc, clockwise):
-        GPIO.output(self.pins[0], GPIO.HIGH)
-        GPIO.output(self.pins[1], GPIO.HIGH if clockwise else GPIO.LOW)
-        p = GPIO.PWM(self.pins[2], freq)
+    def drive(self, duration, freq, dc, clockwise, cancel=None):
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1],
+                         self.gpio.HIGH if clockwise else self.gpio.LOW)
+        p = self.gpio.PWM(self.pins[2], freq)
+        t0 = self.gpio.monotonic()
         p.start(dc * 100)  # GPIO.PWM use dc from 0 to 100
-        time.sleep(duration)
+        reason = "done"
+        while True:
+            remaining = duration - (self.gpio.monotonic() - t0)
+            if remaining <= 0:
+                break
+            if cancel is not None and cancel.cancelled:
+                reason = "cancelled"
+                break
+            self.gpio.sleep(min(TICK, remaining))
         p.stop()
-
-    def forward(self, duration, freq=500, dc=0.50):
-        self.drive(duration, freq, dc, True)
-
-    def backward(self, duration, freq=500, dc=0.50):
-        self.drive(duration, freq, dc, False)
+        if reason == "cancelled":
+            cancel.report_stop()
+        return MoveResult(reason, self.gpio.monotonic() - t0)
+
+    def drive_steps(self, nsteps, freq, dc, clockwise, cancel=None,
+                    ramp_steps=0):
+        """Emit exactly `nsteps` hardware-timed step pulses."""
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1],
+                         self.gpio.HIGH if clockwise else self.gpio.LOW)
+        train = gpio_backend.build_pulse_train(nsteps,
+                                               freq,
+                                               dc,
+                                               start_freq=freq / 4,
+                                               ramp_steps=ramp_steps)
+        t0 = self.gpio.monotonic()
+        reason = play_pulses(self.gpio, self.pins[2], train, cancel)
+        if reason == "cancelled":
+            cancel.report_stop()
+        return MoveResult(reason, self.gpio.monotonic() - t0)
+
+    def forward(self, duration, freq=500, dc=0.50, cancel=None):
+        return self.drive(duration, freq, dc, True, cancel)
+
+    def backward(self, duration, freq=500, dc=0.50, cancel=None):
+        return self.drive(duration, freq, dc, False, cancel)
 
     def release(self):
-        GPIO.output(self.pins[0], GPIO.LOW)
+        self.gpio.output(self.pins[0], self.gpio.LOW)
 
     def hold(self):
-        GPIO.output(self.pins[0], GPIO.HIGH)
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
 
 
 class BoundedStepperMotor(object):
@@ -91,7 +218,9 @@ class BoundedStepperMotor(object):
                  pin_b0,
                  pin_b1,
                  freq=1000,
-                 dc=0.5):
+                 dc=0.5,
+                 gpio=None):
+        self.gpio = gpio or gpio_backend.get_backend()
         self.pins = [pin_en, pin_dir, pin_stp]
         self.bounds = [pin_b0, pin_b1]
         self.default_freq = freq
@@ -104,24 +233,24 @@ class BoundedStepperMotor(object):
         self.release()
         input(">>> Place the object to the center and press enter")
         self.hold()
-        GPIO.output(self.pins[0], GPIO.HIGH)
-        GPIO.output(self.pins[1], GPIO.HIGH)
-        p = GPIO.PWM(self.pins[2], freq)
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1], self.gpio.HIGH)
+        p = self.gpio.PWM(self.pins[2], freq)
         k0, k1 = self.bounds
-        GPIO.add_event_detect(k0, GPIO.RISING)
-        GPIO.add_event_detect(k1, GPIO.RISING)
+        self.gpio.add_event_detect(k0, self.gpio.RISING)
+        self.gpio.add_event_detect(k1, self.gpio.RISING)
         p.start(0.5 * 100)  # GPIO.PWM use dc from 0 to 100
         print(">>> Press the correct collision detector within 5 secs")
         k0_pressed, k1_pressed = False, False
         for _ in range(5 * 100):
-            time.sleep(0.01)
-            k0_pressed = GPIO.event_detected(k0)
-            k1_pressed = GPIO.event_detected(k1)
+            self.gpio.sleep(0.01)
+            k0_pressed = self.gpio.event_detected(k0)
+            k1_pressed = self.gpio.event_detected(k1)
             if k0_pressed or k1_pressed:
                 break
         p.stop()
-        GPIO.remove_event_detect(k0)
-        GPIO.remove_event_detect(k1)
+        self.gpio.remove_event_detect(k0)
+        self.gpio.remove_event_detect(k1)
         ans = input(">>> Is the object going forward (1) or backward (0)? ")
         clockwise = int(ans) == 1  # shall motor go clockwise if move forward
         # self.drive expect that if go clockwise, k1 shall be pressed, swap if
@@ -135,9 +264,9 @@ class BoundedStepperMotor(object):
         trial_duration = 120  # an hour
         self.drive(trial_duration, freq, 0.5, not clockwise)
         print(">>> The motor will perform a full move forward.")
-        t0 = time.clock_gettime_ns(time.CLOCK_MONOTONIC) * 1e-9
+        t0 = self.gpio.monotonic()
         self.drive(trial_duration, freq, 0.5, clockwise)
-        t1 = time.clock_gettime_ns(time.CLOCK_MONOTONIC) * 1e-9
+        t1 = self.gpio.monotonic()
         return {
             "clockwise": clockwise,
             "freq": freq,
@@ -145,71 +274,238 @@ class BoundedStepperMotor(object):
             "swap_bounds": shall_swap
         }
 
+    def measure_speed(self, freq, length, clockwise, timeout, home_freq=None):
+        """Time a full end-switch to end-switch move at `freq`.
+
+        Returns the speed in m/s, or None if the far switch is not reached
+        within `timeout` secs, i.e. the motor stalled.
+        """
+        home_freq = home_freq or self.default_freq
+        result = self.drive(3600, home_freq, 0.5, not clockwise)
+        if result.reason != "collision":
+            raise RuntimeError("Cannot home the motor before measuring")
+        result = self.drive(timeout, freq, 0.5, clockwise)
+        if result.reason != "collision":
+            # drive back home at a safe speed for the next measurement
+            self.drive(3600, home_freq, 0.5, not clockwise)
+            return None
+        # the move starts 50 steps off the home switch, see `drive`
+        return length / (result.elapsed + 50 / freq)
+
+    def calibrate_curve(self, freqs, length, clockwise, tolerance=0.8):
+        """Sweep PWM frequencies and measure the speed at each of them.
+
+        The lowest frequency is the reference, a frequency whose speed falls
+        under `tolerance` of the linear extrapolation (lost steps) or which
+        never reaches the far switch is the stall frequency and ends the
+        sweep. Returns {"curve": [[freq, speed], ...], "stall_freq": f}.
+        """
+        freqs = sorted(freqs)
+        curve = []
+        stall_freq = None
+        step_length = None
+        for freq in freqs:
+            if step_length is None:
+                timeout = 3600
+            else:
+                timeout = 2 * length / (step_length * freq)
+            print(f">>> Measuring speed at {freq}Hz")
+            speed = self.measure_speed(freq, length, clockwise, timeout,
+                                       home_freq=freqs[0])
+            if speed is None or (step_length is not None and
+                                 speed < tolerance * step_length * freq):
+                print(f">>> Motor stalls at {freq}Hz")
+                stall_freq = freq
+                break
+            print(f">>> Speed at {freq}Hz: {speed:.4f}m/s")
+            if step_length is None:
+                step_length = speed / freq
+            curve.append([freq, speed])
+        return {"curve": curve, "stall_freq": stall_freq}
+
     def reset(self):
         for p in self.pins:
-            GPIO.setup(p, GPIO.OUT, initial=GPIO.LOW)
+            self.gpio.setup(p, self.gpio.OUT, initial=self.gpio.LOW)
         for p in self.bounds:
-            GPIO.setup(p, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-
-    def drive(self, duration, freq=None, dc=None, clockwise=True):
+            self.gpio.setup(p, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+
+    def drive(self,
+              duration,
+              freq=None,
+              dc=None,
+              clockwise=True,
+              cancel=None):
         real_freq = self.default_freq if freq is None else freq
         real_dc = dc if dc is not None else self.default_dc
-        GPIO.output(self.pins[0], GPIO.HIGH)
-        GPIO.output(self.pins[1], GPIO.HIGH if clockwise else GPIO.LOW)
-        p = GPIO.PWM(self.pins[2], real_freq)
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1],
+                         self.gpio.HIGH if clockwise else self.gpio.LOW)
+        p = self.gpio.PWM(self.pins[2], real_freq)
         d = self.bounds[1] if clockwise else self.bounds[0]
-        GPIO.add_event_detect(d, GPIO.RISING)
+        self.gpio.add_event_detect(d, self.gpio.RISING)
+        # already on the end switch, no rising edge would ever come
+        collision_detected = self.gpio.input(d) == self.gpio.HIGH
+        t0 = self.gpio.monotonic()
         p.start(real_dc * 100)  # GPIO.PWM use dc from 0 to 100
-        collision_detected = False
-        for _ in range(int(duration * 100)):
-            time.sleep(0.01)
-            if GPIO.event_detected(d):
+        cancelled = False
+        nticks = 0 if collision_detected else int(duration / TICK)
+        for _ in range(nticks):
+            self.gpio.sleep(TICK)
+            if self.gpio.event_detected(d):
                 collision_detected = True
                 break
+            if cancel is not None and cancel.cancelled:
+                cancelled = True
+                break
         p.stop()
-        GPIO.remove_event_detect(d)
+        elapsed = self.gpio.monotonic() - t0
+        self.gpio.remove_event_detect(d)
+        if cancelled:
+            cancel.report_stop()
+            return MoveResult("cancelled", elapsed)
         if collision_detected:
             # go backward a little bit to release collision detector
-            time.sleep(0.1)  # wait some time to avoid sudden acceleration.
-            GPIO.output(self.pins[0], GPIO.HIGH)
-            GPIO.output(self.pins[1], GPIO.LOW if clockwise else GPIO.HIGH)
-            p = GPIO.PWM(self.pins[2], real_freq)
+            # wait some time to avoid sudden acceleration.
+            self.gpio.sleep(0.1)
+            self.gpio.output(self.pins[0], self.gpio.HIGH)
+            self.gpio.output(self.pins[1],
+                             self.gpio.LOW if clockwise else self.gpio.HIGH)
+            p = self.gpio.PWM(self.pins[2], real_freq)
             p.start(real_dc * 100)
             # In our exp, run 0.1s with 1000hz goes 1cm. we want to move 0.05cm,
             # so the sleep time will be 0.1/2 * 1000/freq = 50 / freq
-            time.sleep(50 / real_freq)
+            self.gpio.sleep(50 / real_freq)
             p.stop()
-
-    def forward(self, duration=3600, freq=None, dc=None):
-        self.drive(duration, freq, dc, True)
-
-    def backward(self, duration=3600, freq=None, dc=None):
-        self.drive(duration, freq, dc, False)
+            return MoveResult("collision", elapsed)
+        return MoveResult("done", elapsed)
+
+    def drive_steps(self,
+                    nsteps,
+                    freq=None,
+                    dc=None,
+                    clockwise=True,
+                    cancel=None,
+                    ramp_steps=0):
+        """Emit exactly `nsteps` hardware-timed step pulses.
+
+        Like `drive`, stops and backs off when the end switch is hit.
+        """
+        real_freq = self.default_freq if freq is None else freq
+        real_dc = dc if dc is not None else self.default_dc
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
+        self.gpio.output(self.pins[1],
+                         self.gpio.HIGH if clockwise else self.gpio.LOW)
+        d = self.bounds[1] if clockwise else self.bounds[0]
+        self.gpio.add_event_detect(d, self.gpio.RISING)
+        train = gpio_backend.build_pulse_train(nsteps,
+                                               real_freq,
+                                               real_dc,
+                                               start_freq=real_freq / 4,
+                                               ramp_steps=ramp_steps)
+        t0 = self.gpio.monotonic()
+        if self.gpio.input(d) == self.gpio.HIGH:
+            reason = "collision"  # already on the end switch
+        else:
+            reason = play_pulses(self.gpio, self.pins[2], train, cancel, d)
+        elapsed = self.gpio.monotonic() - t0
+        self.gpio.remove_event_detect(d)
+        if reason == "cancelled":
+            cancel.report_stop()
+        elif reason == "collision":
+            # back off 50 steps, as `drive` does, to release the detector
+            self.gpio.sleep(0.1)
+            self.gpio.output(self.pins[1],
+                             self.gpio.LOW if clockwise else self.gpio.HIGH)
+            train = gpio_backend.build_pulse_train(50, real_freq, real_dc)
+            play_pulses(self.gpio, self.pins[2], train)
+        return MoveResult(reason, elapsed)
+
+    def forward(self, duration=3600, freq=None, dc=None, cancel=None):
+        return self.drive(duration, freq, dc, True, cancel)
+
+    def backward(self, duration=3600, freq=None, dc=None, cancel=None):
+        return self.drive(duration, freq, dc, False, cancel)
 
     def release(self):
-        GPIO.output(self.pins[0], GPIO.LOW)
+        self.gpio.output(self.pins[0], self.gpio.LOW)
 
     def hold(self):
-        GPIO.output(self.pins[0], GPIO.HIGH)
+        self.gpio.output(self.pins[0], self.gpio.HIGH)
 
 class Pump(object):
-    def __init__(self, pin):
+    def __init__(self, pin, gpio=None):
+        self.gpio = gpio or gpio_backend.get_backend()
         self.pin = pin
+        self.lock = threading.Lock()
+        self.timers = []
+        self.spray_until = 0.0
         self.reset()
 
     def reset(self):
-        GPIO.setup(self.pin, GPIO.OUT, initial=GPIO.LOW)
+        self.gpio.setup(self.pin, self.gpio.OUT, initial=self.gpio.LOW)
 
     def on(self):
-        GPIO.output(self.pin, GPIO.HIGH)
+        self.gpio.output(self.pin, self.gpio.HIGH)
 
     def off(self):
-        GPIO.output(self.pin, GPIO.LOW)
-
-    def drive(self, duration):
-        GPIO.output(self.pin, GPIO.HIGH)
-        time.sleep(duration)
-        GPIO.output(self.pin, GPIO.LOW)
+        self.gpio.output(self.pin, self.gpio.LOW)
+
+    def drive(self, duration, cancel=None):
+        self.gpio.output(self.pin, self.gpio.HIGH)
+        t0 = self.gpio.monotonic()
+        cancelled = False
+        while True:
+            remaining = duration - (self.gpio.monotonic() - t0)
+            if remaining <= 0:
+                break
+            if cancel is not None and cancel.cancelled:
+                cancelled = True
+                break
+            self.gpio.sleep(min(TICK, remaining))
+        self.gpio.output(self.pin, self.gpio.LOW)
+        PUMP_SPRAYS.inc(mode="blocking")
+        PUMP_SECONDS.inc(self.gpio.monotonic() - t0, mode="blocking")
+        if cancelled:
+            cancel.report_stop()
+
+    def pulse(self, duration, delay=0.0):
+        """Spray for `duration` secs after `delay` secs, without blocking.
+
+        The pulse runs on the backend timers, so it overlaps whatever the
+        caller drives meanwhile. Overlapping pulses merge into one spray.
+        """
+        start = self.gpio.monotonic() + delay
+        PUMP_SPRAYS.inc(mode="pulse")
+        PUMP_SECONDS.inc(duration, mode="pulse")
+
+        def spray_on():
+            with self.lock:
+                self.spray_until = max(self.spray_until, start + duration)
+                self.on()
+
+        def spray_off():
+            with self.lock:
+                # a later pulse may have extended the spray
+                if self.gpio.monotonic() >= self.spray_until - 1e-6:
+                    self.off()
+
+        with self.lock:
+            now = self.gpio.monotonic()
+            self.timers = [(due, t) for due, t in self.timers if due >= now]
+            self.timers.append((start, self.gpio.call_later(delay,
+                                                            spray_on)))
+            self.timers.append((start + duration,
+                                self.gpio.call_later(delay + duration,
+                                                     spray_off)))
+
+    def cancel_pulses(self):
+        """Drop the pending pulses and stop spraying now."""
+        with self.lock:
+            for _, timer in self.timers:
+                timer.cancel()
+            self.timers = []
+            self.spray_until = 0.0
+            self.off()
 
 
 def testx():
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""GPIO backends for the motor drivers.
+
+Drivers never import RPi.GPIO themselves, they talk to a backend exposing the
+same calls (`setup`, `output`, `PWM`, `add_event_detect`, ...) plus a clock
+(`monotonic`, `sleep`). `RPiBackend` forwards to the real pins, `SimBackend`
+simulates the blackboard carriages in virtual time so motion code can be run
+and benchmarked off the Pi.
+
+Every backend runs callbacks later on its own clock with `call_later`, so
+pump pulses can overlap carriage moves.
+
+Backends with `hardware_pulses` set can also play an exact number of step
+pulses with hardware timing (`send_pulses`), `PigpioBackend` does it with
+pigpio DMA waveforms so the step rate does not jitter under CPU load.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+HIGH = 1
+LOW = 0
+OUT = 0
+IN = 1
+BCM = 11
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+# `count` identical step periods, each `high_us` HIGH then `low_us` LOW.
+PulseSegment = collections.namedtuple("PulseSegment",
+                                      ["high_us", "low_us", "count"])
+
+_backend = None
+
+
+def get_backend():
+    """Return the process wide backend, RPi.GPIO unless set otherwise."""
+    global _backend
+    if _backend is None:
+        _backend = RPiBackend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+    return backend
+
+
+def create_backend(name=None, motor_conf=None):
+    """Create the backend `name`, "rpi" or "pigpio", as the process wide one.
+
+    Without a `name`, the "backend" of the motor spec `motor_conf` is used,
+    RPi.GPIO if it has none.
+    """
+    if name is None:
+        name = (motor_conf or {}).get("backend", "rpi")
+    if name == "rpi":
+        return set_backend(RPiBackend())
+    if name == "pigpio":
+        return set_backend(PigpioBackend())
+    raise ValueError(f"Unknown GPIO backend {name}")
+
+
+def build_pulse_train(nsteps,
+                      freq,
+                      dc=0.5,
+                      start_freq=None,
+                      ramp_steps=0,
+                      ramp_segments=8):
+    """Split a move of exactly `nsteps` step pulses into PulseSegments.
+
+    With `ramp_steps` the rate ramps linearly from `start_freq` to `freq`
+    over the first `ramp_steps` pulses and back down over the last ones, in
+    `ramp_segments` constant-rate stages each way. Periods are rounded to
+    whole microseconds, the pulse count is always exact.
+    """
+    if nsteps <= 0:
+        return []
+    ramp_steps = min(ramp_steps, nsteps // 2)
+    if start_freq is None or ramp_steps == 0:
+        start_freq, ramp_steps = freq, 0
+    ramp_segments = max(1, min(ramp_segments, ramp_steps))
+
+    def segment(f, count):
+        period = max(2, int(round(1e6 / f)))
+        high = min(period - 1, max(1, int(round(period * dc))))
+        return PulseSegment(high, period - high, count)
+
+    ramp = []
+    for i in range(ramp_segments if ramp_steps else 0):
+        count = ramp_steps // ramp_segments
+        count += 1 if i < ramp_steps % ramp_segments else 0
+        f = start_freq + (freq - start_freq) * (i + 0.5) / ramp_segments
+        ramp.append(segment(f, count))
+    train = ramp + [segment(freq, nsteps - 2 * ramp_steps)] + ramp[::-1]
+    return [seg for seg in train if seg.count > 0]
+
+
+def pulse_train_duration(train):
+    """Time in secs to play a pulse train."""
+    return sum((s.high_us + s.low_us) * s.count for s in train) * 1e-6
+
+
+class RPiBackend(object):
+    """Real pins through RPi.GPIO and the wall clock."""
+
+    hardware_pulses = False
+
+    def __init__(self):
+        from RPi import GPIO
+        self.GPIO = GPIO
+
+    def __getattr__(self, name):
+        # Constants and pin calls are forwarded to RPi.GPIO as is.
+        return getattr(self.GPIO, name)
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def call_later(self, delay, fn):
+        """Run `fn` after `delay` secs in a timer thread, can be cancelled."""
+        return _start_timer(delay, fn)
+
+
+def _start_timer(delay, fn):
+    timer = threading.Timer(max(0.0, delay), fn)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class PigpioPWM(object):
+    """`RPi.GPIO.PWM` compatible PWM generated by the pigpio daemon."""
+
+    def __init__(self, pi, pin, freq):
+        self.pi = pi
+        self.pin = pin
+        self.freq = freq
+
+    def start(self, dc):
+        self.pi.set_PWM_frequency(self.pin, int(self.freq))
+        self.pi.set_PWM_dutycycle(self.pin, int(dc * 255 / 100))
+
+    def ChangeFrequency(self, freq):  # pylint: disable=invalid-name
+        self.freq = freq
+        self.pi.set_PWM_frequency(self.pin, int(freq))
+
+    def ChangeDutyCycle(self, dc):  # pylint: disable=invalid-name
+        self.pi.set_PWM_dutycycle(self.pin, int(dc * 255 / 100))
+
+    def stop(self):
+        self.pi.set_PWM_dutycycle(self.pin, 0)
+
+
+class PigpioBackend(object):
+    """Real pins through the pigpio daemon, with DMA timed step pulses.
+
+    Requires `pigpiod` running on the Pi. Step pulse trains are built as
+    pigpio waveforms, one per segment, and chained with hardware loops so a
+    move of any length fits in a single `wave_chain`. pigpio plays one chain
+    at a time, which matches the controller moving one axis at a time.
+    """
+
+    HIGH = HIGH
+    LOW = LOW
+    OUT = OUT
+    IN = IN
+    BCM = BCM
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    hardware_pulses = True
+
+    def __init__(self, host="localhost", port=8888):
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi(host, port)
+        if not self.pi.connected:
+            raise RuntimeError(f"Cannot connect to pigpiod at {host}:{port}")
+        self.events = {}
+        self.waves = {}
+
+    def setmode(self, mode):
+        pass  # pigpio always uses BCM numbering
+
+    def cleanup(self):
+        for pin in list(self.waves):
+            self.stop_pulses(pin)
+        for pin in list(self.events):
+            self.remove_event_detect(pin)
+        self.pi.stop()
+
+    def setup(self, pin, mode, initial=LOW, pull_up_down=None):
+        if mode == OUT:
+            self.pi.set_mode(pin, self.pigpio.OUTPUT)
+            self.pi.write(pin, initial)
+        else:
+            self.pi.set_mode(pin, self.pigpio.INPUT)
+            pud = {
+                PUD_DOWN: self.pigpio.PUD_DOWN,
+                PUD_UP: self.pigpio.PUD_UP
+            }.get(pull_up_down, self.pigpio.PUD_OFF)
+            self.pi.set_pull_up_down(pin, pud)
+
+    def output(self, pin, level):
+        self.pi.write(pin, HIGH if level else LOW)
+
+    def input(self, pin):
+        return self.pi.read(pin)
+
+    def PWM(self, pin, freq):  # pylint: disable=invalid-name
+        return PigpioPWM(self.pi, pin, freq)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        pig_edge = {
+            RISING: self.pigpio.RISING_EDGE,
+            FALLING: self.pigpio.FALLING_EDGE,
+            BOTH: self.pigpio.EITHER_EDGE
+        }[edge]
+        event = [False, None]
+
+        def on_edge(gpio, level, tick):
+            event[0] = True
+            if callback is not None:
+                callback(gpio)
+
+        event[1] = self.pi.callback(pin, pig_edge, on_edge)
+        self.events[pin] = event
+
+    def remove_event_detect(self, pin):
+        event = self.events.pop(pin, None)
+        if event is not None:
+            event[1].cancel()
+
+    def event_detected(self, pin):
+        event = self.events.get(pin)
+        if event is None or not event[0]:
+            return False
+        event[0] = False
+        return True
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def call_later(self, delay, fn):
+        return _start_timer(delay, fn)
+
+    def send_pulses(self, pin, train):
+        """Start playing a pulse train on `pin`, returns immediately."""
+        self.stop_pulses(pin)
+        mask = 1 << pin
+        chain = []
+        wids = []
+        for seg in train:
+            self.pi.wave_add_generic([
+                self.pigpio.pulse(mask, 0, seg.high_us),
+                self.pigpio.pulse(0, mask, seg.low_us)
+            ])
+            wid = self.pi.wave_create()
+            wids.append(wid)
+            count = seg.count
+            while count > 0:
+                # loop the wave up to 65535 times per chain entry
+                n = min(count, 65535)
+                chain += [255, 0, wid, 255, 1, n & 0xff, n >> 8]
+                count -= n
+        self.waves[pin] = wids
+        self.pi.wave_chain(chain)
+
+    def pulses_busy(self, pin):
+        return pin in self.waves and bool(self.pi.wave_tx_busy())
+
+    def stop_pulses(self, pin):
+        wids = self.waves.pop(pin, None)
+        if wids is None:
+            return
+        self.pi.wave_tx_stop()
+        self.pi.write(pin, LOW)
+        for wid in wids:
+            self.pi.wave_delete(wid)
+
+
+class SimAxis(object):
+    """A carriage driven by one stepper, optionally stopped by end switches.
+
+    The position is in board coordinates, from 0 to `length` metres. Driving
+    with the direction pin at `forward_level` moves toward `length`. Each
+    step pulse moves the carriage by `step_length` metres. `bounds` are the
+    switch pins at position 0 and at `length`. Above `stall_freq` the motor
+    stalls and the carriage does not move.
+    """
+
+    def __init__(self,
+                 name,
+                 pin_en,
+                 pin_dir,
+                 pin_stp,
+                 length,
+                 step_length,
+                 bounds=None,
+                 forward_level=HIGH,
+                 position=0.0,
+                 stall_freq=None):
+        self.name = name
+        self.pin_en = pin_en
+        self.pin_dir = pin_dir
+        self.pin_stp = pin_stp
+        self.length = length
+        self.step_length = step_length
+        self.bounds = bounds
+        self.forward_level = forward_level
+        self.position = position
+        self.stall_freq = stall_freq
+        self.travelled = 0.0
+        self.velocity = 0.0
+        self.path = []
+
+
+class SimPWM(object):
+    """Stand-in for `RPi.GPIO.PWM` on a simulated pin."""
+
+    def __init__(self, sim, pin, freq):
+        self.sim = sim
+        self.pin = pin
+        self.freq = freq
+        self.dc = 0.0
+
+    def start(self, dc):
+        with self.sim.lock:
+            self.dc = dc
+            self.sim.pwms[self.pin] = self
+            self.sim._sync_paths()
+
+    def ChangeFrequency(self, freq):  # pylint: disable=invalid-name
+        with self.sim.lock:
+            self.freq = freq
+            self.sim._sync_paths()
+
+    def ChangeDutyCycle(self, dc):  # pylint: disable=invalid-name
+        with self.sim.lock:
+            self.dc = dc
+
+    def stop(self):
+        with self.sim.lock:
+            if self.sim.pwms.get(self.pin) is self:
+                del self.sim.pwms[self.pin]
+            self.sim._sync_paths()
+
+
+class SimTimer(object):
+    """A callback due at a virtual time, see `SimBackend.call_later`."""
+
+    def __init__(self, due, fn):
+        self.due = due
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimBackend(object):
+    """A deterministic virtual-time simulator of the blackboard.
+
+    `sleep` advances the virtual clock instantly and moves every enabled
+    carriage by `step_length` per pulse of its running PWM or pulse train. A
+    carriage stops at the board limits and raises the end switch there,
+    which fires the registered edge events. Pulses sent against a limit are
+    lost, as on the real belt. Timers from `call_later` fire when the clock
+    passes their due time. The backend is meant to be driven from one
+    thread, concurrent sleeps simply add up.
+    """
+
+    HIGH = HIGH
+    LOW = LOW
+    OUT = OUT
+    IN = IN
+    BCM = BCM
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    def __init__(self, hardware_pulses=False):
+        self.hardware_pulses = hardware_pulses
+        self.lock = threading.RLock()
+        self.now = 0.0
+        self.mode = None
+        self.levels = {}
+        self.pwms = {}
+        self.trains = {}
+        self.pulses_sent = collections.Counter()
+        self.timers = []
+        self._timer_seq = itertools.count()
+        self.events = {}
+        self.axes = {}
+        self.pumps = {}
+
+    @classmethod
+    def from_motor_spec(cls, conf, position=None, hardware_pulses=False):
+        """Build a simulated board from the content of `motor_spec.json`."""
+        sim = cls(hardware_pulses)
+        devices = conf["devices"]
+        position = position or {}
+        for axis in ("x", "y", "z"):
+            dev = devices[f"motor_{axis}"]
+            spec = conf[f"motor_{axis}"]
+            pins = dev["pins"]
+            forward_level = HIGH if spec["clockwise"] else LOW
+            bounds = None
+            if len(pins) == 5:
+                # the driver watches pins[4] when the dir pin is HIGH
+                if forward_level == HIGH:
+                    bounds = (pins[3], pins[4])
+                else:
+                    bounds = (pins[4], pins[3])
+            sim.add_axis(axis,
+                         *pins[:3],
+                         length=dev["length"],
+                         step_length=spec["speed"] / spec["freq"],
+                         bounds=bounds,
+                         forward_level=forward_level,
+                         position=position.get(axis, 0.0),
+                         stall_freq=spec.get("stall_freq"))
+        sim.add_pump(devices["pump"]["pin"])
+        return sim
+
+    def add_axis(self, name, *args, **kwargs):
+        axis = SimAxis(name, *args, **kwargs)
+        axis.path.append((self.now, axis.position))
+        self.axes[name] = axis
+        self._update_switches(axis)
+        return axis
+
+    def add_pump(self, pin):
+        """Record the (start, end) intervals the pump pin is held HIGH."""
+        self.pumps[pin] = []
+
+    # RPi.GPIO compatible interface
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def cleanup(self):
+        with self.lock:
+            self.pwms.clear()
+            self.trains.clear()
+            self.timers.clear()
+            self.events.clear()
+            for pin in list(self.levels):
+                if not self._is_switch(pin):
+                    self.output(pin, LOW)
+
+    def setup(self, pin, mode, initial=LOW, pull_up_down=None):
+        with self.lock:
+            if mode == OUT:
+                self.output(pin, initial)
+            elif pin not in self.levels:
+                self.levels[pin] = HIGH if pull_up_down == PUD_UP else LOW
+
+    def output(self, pin, level):
+        with self.lock:
+            level = HIGH if level else LOW
+            old = self.levels.get(pin, LOW)
+            self.levels[pin] = level
+            if pin in self.pumps and level != old:
+                if level == HIGH:
+                    self.pumps[pin].append([self.now, None])
+                elif self.pumps[pin]:
+                    self.pumps[pin][-1][1] = self.now
+            self._sync_paths()
+
+    def input(self, pin):
+        return self.levels.get(pin, LOW)
+
+    def PWM(self, pin, freq):  # pylint: disable=invalid-name
+        return SimPWM(self, pin, freq)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.events[pin] = [edge, False, callback]
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.events.pop(pin, None)
+
+    def event_detected(self, pin):
+        with self.lock:
+            event = self.events.get(pin)
+            if event is None or not event[1]:
+                return False
+            event[1] = False
+            return True
+
+    def send_pulses(self, pin, train):
+        with self.lock:
+            # each entry is [period in secs, pulses left in the segment]
+            self.trains[pin] = collections.deque(
+                [(s.high_us + s.low_us) * 1e-6, s.count] for s in train)
+            self._sync_paths()
+
+    def pulses_busy(self, pin):
+        return pin in self.trains
+
+    def stop_pulses(self, pin):
+        with self.lock:
+            if self.trains.pop(pin, None) is not None:
+                self._sync_paths()
+
+    # Virtual clock
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        with self.lock:
+            # like a real clock, time passes by at least one nanosecond
+            self.advance(max(1e-9, secs))
+
+    def call_later(self, delay, fn):
+        with self.lock:
+            timer = SimTimer(self.now + max(0.0, delay), fn)
+            heapq.heappush(self.timers, (timer.due, next(self._timer_seq),
+                                         timer))
+            return timer
+
+    def advance(self, secs):
+        """Move the virtual clock, stopping at every limit hit and timer."""
+        end = self.now + secs
+        self._fire_timers()
+        while self.now < end:
+            step = end - self.now
+            if self.timers:
+                step = min(step, self.timers[0][0] - self.now)
+            for axis in self.axes.values():
+                v = self.velocity(axis)
+                if v > 0:
+                    step = min(step, (axis.length - axis.position) / v)
+                elif v < 0:
+                    step = min(step, axis.position / -v)
+            for train in self.trains.values():
+                period, count = train[0]
+                step = min(step, period * count)
+            for axis in self.axes.values():
+                v = self.velocity(axis)
+                if v == 0:
+                    continue
+                new = min(max(axis.position + v * step, 0.0), axis.length)
+                axis.travelled += abs(new - axis.position)
+                axis.position = new
+            for pin in list(self.trains):
+                self._play_pulses(pin, step)
+            self.now = end if step == end - self.now else self.now + step
+            for axis in self.axes.values():
+                self._update_switches(axis)
+            self._sync_paths()
+            self._fire_timers()
+
+    def velocity(self, axis):
+        """Signed carriage speed in m/s from the current pin states."""
+        if self.levels.get(axis.pin_en, LOW) != HIGH:
+            return 0.0
+        train = self.trains.get(axis.pin_stp)
+        pwm = self.pwms.get(axis.pin_stp)
+        if train is not None:
+            freq = 1 / train[0][0]
+        elif pwm is None or pwm.dc <= 0 or pwm.freq <= 0:
+            return 0.0
+        else:
+            freq = pwm.freq
+        if axis.stall_freq is not None and freq >= axis.stall_freq:
+            return 0.0
+        speed = freq * axis.step_length
+        if self.levels.get(axis.pin_dir, LOW) != axis.forward_level:
+            speed = -speed
+        # the carriage stalls against the board limits
+        if (speed > 0 and axis.position >= axis.length or
+                speed < 0 and axis.position <= 0):
+            return 0.0
+        return speed
+
+    def position(self, name):
+        return self.axes[name].position
+
+    def _fire_timers(self):
+        while self.timers and self.timers[0][0] <= self.now + 1e-12:
+            _, _, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.fn()
+
+    def _play_pulses(self, pin, secs):
+        train = self.trains[pin]
+        period, count = train[0]
+        played = min(count, secs / period)
+        self.pulses_sent[pin] += played
+        if count - played < 1e-6:
+            # snap to whole pulses so the total count stays exact
+            self.pulses_sent[pin] = round(self.pulses_sent[pin])
+            train.popleft()
+        else:
+            train[0][1] = count - played
+        if not train:
+            del self.trains[pin]
+
+    def _is_switch(self, pin):
+        return any(a.bounds and pin in a.bounds for a in self.axes.values())
+
+    def _update_switches(self, axis):
+        if not axis.bounds:
+            return
+        eps = 1e-9
+        states = (axis.position <= eps, axis.position >= axis.length - eps)
+        for pin, pressed in zip(axis.bounds, states):
+            self._set_input(pin, HIGH if pressed else LOW)
+
+    def _set_input(self, pin, level):
+        old = self.levels.get(pin, LOW)
+        self.levels[pin] = level
+        event = self.events.get(pin)
+        if event is None or old == level:
+            return
+        edge = RISING if level == HIGH else FALLING
+        if event[0] in (edge, BOTH):
+            event[1] = True
+            if event[2] is not None:
+                event[2](pin)
+
+    def _sync_paths(self):
+        # keep only the corners of the path, where a velocity changes
+        for axis in self.axes.values():
+            v = self.velocity(axis)
+            if v != axis.velocity:
+                axis.velocity = v
+                if axis.path[-1] != (self.now, axis.position):
+                    axis.path.append((self.now, axis.position))
+
+
+def testpulses():
+    """Play pulse trains on the simulator and check the exact step counts."""
+    for nsteps, ramp_steps in ((1, 0), (999, 0), (10000, 300), (70001, 5000),
+                               (7, 100)):
+        train = build_pulse_train(nsteps,
+                                  4000,
+                                  start_freq=1000,
+                                  ramp_steps=ramp_steps)
+        assert sum(seg.count for seg in train) == nsteps
+        sim = SimBackend(hardware_pulses=True)
+        axis = sim.add_axis("x", 1, 2, 3, length=100.0, step_length=1e-4)
+        sim.output(1, HIGH)
+        sim.output(2, HIGH)
+        sim.send_pulses(3, train)
+        while sim.pulses_busy(3):
+            sim.sleep(0.01)
+        assert sim.pulses_sent[3] == nsteps
+        assert abs(axis.position - nsteps * 1e-4) < 1e-9
+        duration = pulse_train_duration(train)
+        assert sim.now - duration < 0.01
+        print(f"{nsteps} steps, ramp {ramp_steps}: {len(train)} segments, "
+              f"{duration:.4f}s, ends at {axis.position:.4f}m")
+
+
+if __name__ == "__main__":
+    testpulses()
@@ -2,30 +2,200 @@
 # coding: utf8
 """Main Application for smart blackboard"""
 
+import time
+
+# the startup profile starts here, before the imports
+_T0 = time.perf_counter()
+
 from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton
 from PyQt5.QtWidgets import QGridLayout, QWidget, QSizePolicy
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QStyle
 from PyQt5.QtGui import QFont
-from PyQt5.QtCore import QSize
-from RPi import GPIO
+from PyQt5.QtCore import QSize, QObject, QThread, QTimer
+from PyQt5.QtCore import pyqtSignal, pyqtSlot
 
-from driver import BoundedStepperMotor, StepperMotor, Pump
-from voice_model import VoiceCmdModel
-import audio_utils
+# voice_model and audio_utils (librosa, tflite...) are imported on the
+# model loader thread, after the window is up
+from controller import BlackboardController
+from controller_daemon import ControllerClient
+from driver import GpioManager
+import gpio_backend
+from startup_profile import StartupProfile
 
 import sys
 import os
 import json
 import argparse
-import time
+import contextlib
+import threading
+
+
+class MotionWorker(QObject):
+    """Runs the motion routines one at a time on its own QThread.
+
+    The GUI and the voice worker only queue routines, so they stay free to
+    stop the running one. A stop also drops the queued routines.
+    """
+
+    # routine, args, stop generation
+    requested = pyqtSignal(str, object, int)
+
+    def __init__(self, controller):
+        super().__init__()
+        self.controller = controller
+        self.lock = threading.Lock()
+        self.generation = 0  # bumped by each stop
+        self.requested.connect(self.execute)
+
+    def submit(self, routine, *args):
+        """Queue a controller routine, safe from any thread."""
+        with self.lock:
+            generation = self.generation
+        self.requested.emit(routine, args, generation)
+
+    def stop(self):
+        """Drop the queued routines and pre-empt the running one."""
+        with self.lock:
+            self.generation += 1
+        self.controller.stop()
+
+    @pyqtSlot(str, object, int)
+    def execute(self, routine, args, generation):
+        try:
+            with self.lock:
+                if generation != self.generation:
+                    return  # queued before a stop
+                # a stop from now on cancels the routine
+                self.controller.arm()
+            getattr(self.controller, routine)(*args)
+        except Exception as e:  # e.g. the daemon went away
+            print(f"Motion {routine} failed: {type(e).__name__}: {e}")
+
+
+class VoiceWorker(QObject):
+    """The record and predict loop, run on its own QThread.
+
+    Recognized commands call `actions`, which only queue the motions, so
+    it keeps listening while the motors run and "stop" can pre-empt them.
+    """
+
+    # button text, whether it is recording
+    status = pyqtSignal(str, bool)
+    # command, probability
+    recognized = pyqtSignal(str, float)
+    finished = pyqtSignal()
+
+    def __init__(self, model, device, duration, actions, confidence=0.8):
+        super().__init__()
+        self.model = model
+        self.device = device
+        self.duration = duration
+        self.actions = actions
+        self.confidence = confidence
+        self.stopped = threading.Event()
+
+    def stop(self):
+        """Stop listening, safe from any thread."""
+        import audio_utils
+        self.stopped.set()
+        audio_utils.stop_recording()
+
+    @pyqtSlot()
+    def run(self):
+        import audio_utils  # already loaded by the ModelLoader
+        try:
+            while not self.stopped.wait(0.2):
+                self.status.emit("请发令", True)
+                data = audio_utils.record_voice(self.device[0],
+                                                self.duration,
+                                                self.device[2],
+                                                downsample=False)
+                if self.stopped.is_set():
+                    break
+                self.status.emit("解析中", False)
+                result = self.model.predict(data, self.device[2])
+                print("Probability:")
+                for k, v in result["details"].items():
+                    print(f"  {k}: {v*100:.3f}%")
+                print(f"Voice command: {result['command']}")
+                cmd = result["command"]
+                self.recognized.emit(cmd, result["details"][cmd])
+                if result["details"][cmd] <= self.confidence:
+                    continue
+                if self.stopped.is_set():
+                    break
+                if cmd in self.actions:
+                    self.actions[cmd]()
+                if cmd == "stop":
+                    break
+        finally:
+            self.finished.emit()
+
+
+class ModelLoader(QObject):
+    """Loads the voice model and the input device, then warms them up."""
+
+    # model, input device
+    loaded = pyqtSignal(object, object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, model_spec, profile, client=None):
+        super().__init__()
+        self.model_spec = model_spec
+        self.profile = profile
+        self.client = client  # for the model of the controller daemon
+
+    @pyqtSlot()
+    def run(self):
+        try:
+            with self.profile.phase("import audio_utils"):
+                import audio_utils
+                import numpy as np
+            with self.profile.phase("select input device"):
+                device = audio_utils.select_input_device()[0]
+            if self.client is not None:
+                with self.profile.phase("load model"):
+                    model = self.client.voice_model()
+                if model is None:
+                    raise ValueError("The daemon has no voice model")
+            else:
+                with self.profile.phase("import voice_model"):
+                    from voice_model import VoiceCmdModel
+                with self.profile.phase("load model"):
+                    with open(self.model_spec, encoding="utf8") as f:
+                        model_conf = json.load(f)
+                    model = VoiceCmdModel(model_conf["fn"], model_conf["sr"],
+                                          model_conf["duration"],
+                                          model_conf["feature"],
+                                          **model_conf["args"])
+            with self.profile.phase("warm-up"):
+                # the first invoke allocates, not the first command's
+                silence = np.zeros(int(model.model_sr * model.model_duration),
+                                   dtype=np.float32)
+                model.predict(silence, model.model_sr)
+        except Exception as e:  # e.g. tflite or PortAudio, never abort Qt
+            self.failed.emit(f"{type(e).__name__}: {e}")
+            return
+        self.loaded.emit(model, device)
 
 
 class MainWindow(QMainWindow):
     """The main window"""
 
-    def __init__(self, motor_spec, model_spec, fullscreen=True):
+    def __init__(self,
+                 motor_spec,
+                 model_spec,
+                 fullscreen=True,
+                 telemetry_file=None,
+                 daemon=None,
+                 profile=None,
+                 profile_file=None,
+                 gpio=None):
         super().__init__()
+        self.profile = profile or StartupProfile()
+        self.profile_file = profile_file
+        self.starting = {"window", "voice"}
 
         self.setWindowTitle("智能黑板擦控制程序")
         if fullscreen:
@@ -100,143 +270,150 @@ class MainWindow(QMainWindow):
         widget.setLayout(layout)
         self.setCentralWidget(widget)
 
-        # initialize voice command model
-        with open(model_spec, encoding="utf8") as f:
-            model_conf = json.load(f)
-        self.model = VoiceCmdModel(model_conf["fn"], model_conf["sr"],
-                                   model_conf["duration"],
-                                   model_conf["feature"], **model_conf["args"])
-        self.voice_device = audio_utils.select_input_device()[0]
-        self.voice_duration = model_conf["duration"]
+        with self.profile.phase("init motors"):
+            if daemon is None:
+                self.controller = BlackboardController.from_file(
+                    motor_spec, gpio=gpio, telemetry_file=telemetry_file)
+            else:
+                # the daemon owns the motors and the model
+                self.controller = ControllerClient(daemon)
+        self.daemon = daemon
+        self.motion = MotionWorker(self.controller)
+        self.motion_thread = QThread(self)
+        self.motion.moveToThread(self.motion_thread)
+        self.motion_thread.start()
+        self.model = None
+        self.voice_device = None
+        self.voice_worker = None
+        self.voice_thread = None
+
+        # the voice button waits for the model, loaded in the background
+        self.buttons[8].setEnabled(False)
+        self.buttons[8].setText("加载中")
+        self.loader = ModelLoader(model_spec, self.profile,
+                                  None if daemon is None else self.controller)
+        self.loader_thread = QThread(self)
+        self.loader.moveToThread(self.loader_thread)
+        self.loader_thread.started.connect(self.loader.run)
+        self.loader.loaded.connect(self.model_loaded)
+        self.loader.failed.connect(self.model_failed)
+        self.loader.loaded.connect(self.loader_thread.quit)
+        self.loader.failed.connect(self.loader_thread.quit)
+        self.loader_thread.start()
+        # once the window is up
+        QTimer.singleShot(0, self.window_ready)
+
+    def window_ready(self):
+        self.profile.mark("window ready")
+        self.manual()  # on the motion thread
+        self.started("window")
+
+    def model_loaded(self, model, device):
+        self.model = model
+        self.voice_device = device
+        self.buttons[8].setEnabled(True)
+        self.buttons[8].setText("语音")
+        self.profile.mark("voice ready")
+        self.started("voice")
+
+    def model_failed(self, message):
+        print(f"Voice commands disabled: {message}")
+        self.buttons[8].setText("语音")
+        self.profile.mark("voice failed")
+        self.started("voice")
+
+    def started(self, part):
+        self.starting.discard(part)
+        if self.starting:
+            return
+        print(f">>> Ready in {self.profile.elapsed():.2f}s")
+        print(self.profile.report())
+        if self.profile_file:
+            self.profile.save(self.profile_file)
 
-        # initialize motors
-        with open(motor_spec, encoding="utf8") as f:
-            motor_conf = json.load(f)
-        devices = motor_conf["devices"]
-        self.pump = Pump(devices["pump"]["pin"])
-        self.motors = {}
-        self.specs = {}
-        self.motors["x"] = BoundedStepperMotor(*devices["motor_x"]["pins"])
-        self.motors["y"] = BoundedStepperMotor(*devices["motor_y"]["pins"])
-        self.motors["z"] = StepperMotor(*devices["motor_z"]["pins"])
-        self.specs["x"] = motor_conf["motor_x"]
-        self.specs["y"] = motor_conf["motor_y"]
-        self.specs["z"] = motor_conf["motor_z"]
-        self.dx = 0.1  # 0.1m per step on x
-        self.dy = 0.1  # 0.1m per step on y
-        self.dz = 0.01  # 0.01m per step on z
-        self.ny = int(devices["motor_x"]["length"] / self.dy)
-        self.manual()
-
-    def drive_motor(self, motor, length, forward=True, speed_mul=1.0):
-        speed = self.specs[motor]["speed"] * speed_mul  # increase speed
-        freq = self.specs[motor]["freq"] * speed_mul  # by increase freq
-        clockwise = self.specs[motor]["clockwise"]
-        if not forward:
-            clockwise = not clockwise
-        duration = length / speed
-        self.motors[motor].drive(duration,
-                                 freq=freq,
-                                 dc=0.5,
-                                 clockwise=clockwise)
-
-    def go(self, direction, nsteps, reverse=False, speed_mul=1.0):
-        if direction == "x":
-            self.drive_motor("x", self.dx * nsteps, not reverse, speed_mul)
-        elif direction == "y":
-            self.drive_motor("y", self.dy * nsteps, not reverse, speed_mul)
-        else:
-            self.drive_motor("z", self.dz * nsteps, not reverse, speed_mul)
+    def stop(self):
+        """Pre-empt the running motion routine, safe from any thread."""
+        self.motion.stop()
 
     def reset(self):
-        self.motors["x"].hold()
-        self.motors["y"].hold()
-        self.motors["z"].hold()
-        # Go to left bottom corner and ready cleaner
-        self.go("x", 100, reverse=True)
-        self.go("y", 100, reverse=True)
-        self.go("z", 2)
+        self.motion.submit("reset")
 
     def manual(self):
-        self.go("z", 2, reverse=True)
-        self.motors["x"].release()
-        self.motors["y"].release()
-        self.motors["z"].release()
+        self.motion.submit("manual")
 
     def go_right(self):
-        self.go("x", 1)
+        self.motion.submit("go_right")
 
     def go_left(self):
-        self.go("x", 1, reverse=True)
+        self.motion.submit("go_left")
 
     def go_up(self):
-        self.go("y", 1)
+        self.motion.submit("go_up")
 
     def go_down(self):
-        self.go("y", 1, reverse=True)
+        self.motion.submit("go_down")
 
     def full_clean(self):
-        self.reset()
-        for _ in range(self.ny):
-            self.pump.on()
-            time.sleep(0.5)
-            self.pump.off()
-            self.go("x", 100)
-            self.go("x", 100, reverse=True)
-            self.go("y", 1)
-        self.pump.on()
-        time.sleep(0.5)
-        self.pump.off()
-        self.go("x", 100)
-        self.go("x", 100, reverse=True)
-        self.go("y", 100, reverse=True)
+        self.motion.submit("full_clean")
+
+    def clean_regions(self, rects):
+        """Clean (x0, y0, x1, y1) rectangles of the board, in metres."""
+        self.motion.submit("clean_regions", rects)
 
     def voice_control(self):
-        try:
-            while True:
-                self.buttons[8].setIcon(
-                    QIcon(QApplication.style().standardIcon(
-                        QStyle.SP_MediaPause)))
-                self.buttons[8].setText("请发令")
-                self.buttons[8].repaint()
-                time.sleep(0.2)
-                data = audio_utils.record_voice(self.voice_device[0],
-                                                self.voice_duration,
-                                                self.voice_device[2],
-                                                downsample=False)
-                self.buttons[8].setIcon(
-                    QIcon(QApplication.style().standardIcon(
-                        QStyle.SP_MediaPlay)))
-                self.buttons[8].setText("解析中")
-                self.buttons[8].repaint()
-                result = self.model.predict(data, self.voice_device[2])
-                print("Probability:")
-                for k, v in result["details"].items():
-                    print(f"  {k}: {v*100:.3f}%")
-                print(f"Voice command: {result['command']}")
-                cmd = result["command"]
-                self.buttons[8].setText(self.cmd_cn[cmd])
-                self.buttons[8].repaint()
-                if result["details"][cmd] <= 0.8:
-                    continue
-                if cmd == "__noise__":
-                    continue
-                elif cmd == "go":
-                    self.full_clean()
-                elif cmd == "stop":
-                    self.buttons[8].setText("语音")
-                    self.buttons[8].repaint()
-                    break
-                elif cmd == "up":
-                    self.go_up()
-                elif cmd == "down":
-                    self.go_down()
-                elif cmd == "left":
-                    self.go_left()
-                elif cmd == "right":
-                    self.go_right()
-        except KeyboardInterrupt:
+        """Start listening for voice commands, or stop if listening."""
+        if self.voice_worker is not None:
+            self.voice_worker.stop()
             return
+        self.voice_worker = VoiceWorker(
+            self.model, self.voice_device, self.model.model_duration, {
+                "go": self.full_clean,
+                "up": self.go_up,
+                "down": self.go_down,
+                "left": self.go_left,
+                "right": self.go_right,
+                "stop": self.stop,
+            })
+        self.voice_thread = QThread(self)
+        self.voice_worker.moveToThread(self.voice_thread)
+        self.voice_thread.started.connect(self.voice_worker.run)
+        self.voice_worker.status.connect(self.show_voice_status)
+        self.voice_worker.recognized.connect(self.show_voice_command)
+        self.voice_worker.finished.connect(self.voice_finished)
+        self.voice_thread.start()
+
+    def show_voice_status(self, text, recording):
+        icon = QStyle.SP_MediaPause if recording else QStyle.SP_MediaPlay
+        self.buttons[8].setIcon(
+            QIcon(QApplication.style().standardIcon(icon)))
+        self.buttons[8].setText(text)
+
+    def show_voice_command(self, cmd, probability):
+        self.buttons[8].setText(self.cmd_cn[cmd])
+
+    def voice_finished(self):
+        self.voice_thread.quit()
+        self.voice_thread.wait()
+        self.voice_worker.deleteLater()
+        self.voice_worker = None
+        self.voice_thread = None
+        self.show_voice_status("语音", False)
+
+    def closeEvent(self, event):
+        self.loader_thread.quit()
+        self.loader_thread.wait()  # a model being loaded
+        if self.voice_worker is not None:
+            self.voice_worker.stop()
+        self.stop()
+        if self.voice_thread is not None:
+            self.voice_thread.quit()
+            self.voice_thread.wait()
+        self.motion_thread.quit()
+        self.motion_thread.wait()  # the cancelled routine unwinding
+        self.controller.flush()
+        if self.daemon is not None:
+            self.controller.close()
+        super().closeEvent(event)
 
 
 def main():
@@ -244,17 +421,39 @@ def main():
     parser.add_argument("--fullscreen",
                         action="store_true",
                         help="start app in fullscreen mode")
+    parser.add_argument("--telemetry",
+                        help="log the motor moves into this file")
+    parser.add_argument("--daemon",
+                        metavar="SOCKET",
+                        help="use the controller daemon on this socket, "
+                        "instead of driving the motors")
+    parser.add_argument("--gpio",
+                        choices=("rpi", "pigpio"),
+                        help="GPIO backend, pigpio times the step pulses "
+                        "in hardware (default: the motor spec's backend, "
+                        "or rpi)")
+    parser.add_argument("--startup-profile",
+                        metavar="FILE",
+                        help="append the startup profile to this file, "
+                        "see startup_profile.py")
     args = parser.parse_args()
 
+    profile = StartupProfile(_T0)
+    profile.mark("imports")
     SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-    GPIO.setmode(GPIO.BCM)
-    app = QApplication(sys.argv)
-    window = MainWindow(os.path.join(SCRIPT_DIR, "motor_spec.json"),
-                        os.path.join(SCRIPT_DIR, "model_spec.json"),
-                        args.fullscreen)
-    window.show()
-    ret_code = app.exec_()
-    GPIO.cleanup()
+    motor_spec = os.path.join(SCRIPT_DIR, "motor_spec.json")
+    gpio = None
+    if not args.daemon:
+        with open(motor_spec, encoding="utf8") as f:
+            gpio = gpio_backend.create_backend(args.gpio, json.load(f))
+    with contextlib.nullcontext() if args.daemon else GpioManager(gpio):
+        app = QApplication(sys.argv)
+        window = MainWindow(motor_spec,
+                            os.path.join(SCRIPT_DIR, "model_spec.json"),
+                            args.fullscreen, args.telemetry, args.daemon,
+                            profile, args.startup_profile, gpio)
+        window.show()
+        ret_code = app.exec_()
     sys.exit(ret_code)
 
 
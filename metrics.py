@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""In-process metrics in the Prometheus text format"""
+
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+# Bucket bounds in secs, from a tick of the motion loops to a full clean
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"'))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A metric family, its values are keyed by the label values."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        if not self.label_names and self.kind != "histogram":
+            self.values[()] = 0  # a single series exists from the start
+
+    def _key(self, labels):
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} needs labels {self.label_names}")
+        return tuple(labels[n] for n in self.label_names)
+
+    def samples(self):
+        """(suffix, label values, extra label, value) of each sample."""
+        with self.lock:
+            return [("", key, None, value)
+                    for key, value in sorted(self.values.items())]
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}"]
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels(self.label_names, key, extra)
+            lines.append(
+                f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read the value from `function()` at each collection."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [("", (), None, self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # counts per bucket, the last one for +Inf, then the sum
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(self.buckets) + 1) + [
+                    0.0
+                ]
+            entry[i] += 1
+            entry[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def samples(self):
+        result = []
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for key, entry in items:
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf, ), entry):
+                total += count
+                result.append(
+                    ("_bucket", key, ("le", _format_value(bound)), total))
+            result.append(("_sum", key, None, entry[-1]))
+            result.append(("_count", key, None, total))
+        return result
+
+
+class Registry(object):
+    """The metric families of a process, by name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get_or_create(self, cls, name, help, labels=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels,
+                                                  **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is a {metric.kind}")
+            return metric
+
+    def expose(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        return "\n".join(m.expose() for _, m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.get_or_create(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return REGISTRY.get_or_create(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.get_or_create(Histogram,
+                                  name,
+                                  help,
+                                  labels,
+                                  buckets=buckets)
+
+
+def expose():
+    """All metrics of the process in the Prometheus text format."""
+    return REGISTRY.expose()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Streaming parser of multipart/form-data uploads"""
+
+import email.message
+
+CHUNK_SIZE = 1 << 16
+MAX_HEADER_SIZE = 1 << 14
+
+
+class MultipartError(ValueError):
+    """A malformed or too large upload, `code` is the HTTP status."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.code = code
+
+
+class _Reader(object):
+    """Reads at most `length` bytes of `rfile` in chunks and scans them."""
+
+    def __init__(self, rfile, length, chunk_size=CHUNK_SIZE):
+        self.rfile = rfile
+        self.remaining = length
+        self.chunk_size = chunk_size
+        self.pending = bytearray()
+
+    def fill(self):
+        if self.remaining <= 0:
+            raise MultipartError("Truncated multipart body.")
+        data = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not data:
+            raise MultipartError("Truncated multipart body.")
+        self.remaining -= len(data)
+        self.pending += data
+
+    def drain(self):
+        """Discard the rest of the body, the connection may be reused."""
+        self.pending = bytearray()
+        while self.remaining > 0:
+            data = self.rfile.read(min(self.chunk_size, self.remaining))
+            if not data:
+                raise MultipartError("Truncated multipart body.")
+            self.remaining -= len(data)
+
+    def read_exact(self, n):
+        while len(self.pending) < n:
+            self.fill()
+        data = bytes(self.pending[:n])
+        del self.pending[:n]
+        return data
+
+    def read_until(self, sep, limit):
+        """Bytes up to `sep`, which is consumed, of at most `limit` bytes."""
+        start = 0
+        while True:
+            i = self.pending.find(sep, start)
+            if i >= 0:
+                data = bytes(self.pending[:i])
+                del self.pending[:i + len(sep)]
+                return data
+            if len(self.pending) > limit:
+                raise MultipartError("Multipart headers too large.")
+            # a separator may straddle the old and the new bytes
+            start = max(0, len(self.pending) - len(sep) + 1)
+            self.fill()
+
+    def scan_until(self, sep, sink=None):
+        """Pass the bytes up to `sep` to `sink`, without keeping them."""
+        while True:
+            i = self.pending.find(sep)
+            if i >= 0:
+                if sink is not None:
+                    sink(memoryview(self.pending)[:i])
+                del self.pending[:i + len(sep)]
+                return
+            keep = len(sep) - 1
+            if len(self.pending) > keep:
+                n = len(self.pending) - keep
+                if sink is not None:
+                    sink(memoryview(self.pending)[:n])
+                del self.pending[:n]
+            self.fill()
+
+
+def _part_name(headers):
+    msg = email.message.Message()
+    for line in headers.decode("latin-1").split("\r\n"):
+        key, sep, value = line.partition(":")
+        if not sep:
+            raise MultipartError("Bad multipart part header.")
+        msg[key.strip()] = value.strip()
+    if msg.get_content_disposition() != "form-data":
+        return None
+    return msg.get_param("name", header="content-disposition")
+
+
+def read_field(rfile, length, boundary, name, max_size,
+               chunk_size=CHUNK_SIZE):
+    """Read the field `name` of a multipart/form-data body of `length`.
+
+    The body is parsed as it streams from `rfile` in `chunk_size` reads,
+    the field is copied once into a buffer preallocated for the smaller of
+    `length` and `max_size`. Other fields are skipped. Returns the field as
+    a bytearray, raises MultipartError if the body is malformed, the field
+    is missing or larger than `max_size`.
+    """
+    if isinstance(boundary, str):
+        boundary = boundary.encode("latin-1")
+    if not 0 < len(boundary) <= 70:
+        raise MultipartError("Bad multipart boundary.")
+    delimiter = b"--" + boundary
+    reader = _Reader(rfile, length, chunk_size)
+    reader.read_until(delimiter, MAX_HEADER_SIZE)  # skip the preamble
+    while True:
+        tail = reader.read_exact(2)
+        if tail == b"--":
+            raise MultipartError(f'No "{name}" field in the form.')
+        if tail != b"\r\n":
+            raise MultipartError("Bad multipart delimiter.")
+        headers = reader.read_until(b"\r\n\r\n", MAX_HEADER_SIZE)
+        if _part_name(headers) != name:
+            reader.scan_until(b"\r\n" + delimiter)
+            continue
+        buf = bytearray(min(length, max_size))
+        view = memoryview(buf)
+        size = 0
+
+        def copy(data):
+            nonlocal size
+            if size + len(data) > len(buf):
+                raise MultipartError(
+                    f'Field "{name}" exceeds {max_size} bytes.', 413)
+            view[size:size + len(data)] = data
+            size += len(data)
+
+        reader.scan_until(b"\r\n" + delimiter, copy)
+        view.release()
+        del buf[size:]
+        reader.drain()  # the other fields and the epilogue
+        return buf
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Coverage path planning for cleaning the blackboard"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import math
+import os
+
+# Drive `axis` by `length` metres. A homing move goes on until the end switch,
+# `length` is then the distance expected before the switch is hit.
+Move = collections.namedtuple("Move", ["axis", "length", "forward", "homing"],
+                              defaults=[False])
+# Run the pump for `duration` secs. With `at` set, the spray starts once the
+# next move has gone `at` metres and overlaps it, otherwise it blocks before
+# the next move.
+Spray = collections.namedtuple("Spray", ["duration", "at"], defaults=[None])
+
+
+def row_positions(height, eraser_width):
+    """Y positions of the rows needed to cover [0, height]."""
+    nrows = int(height / eraser_width + 1e-9) + 1
+    rows = [min(i * eraser_width, height) for i in range(nrows)]
+    if rows[-1] < height - 1e-9:
+        rows.append(height)
+    return rows
+
+
+def plan_serpentine(width, height, eraser_width, spray=0.5, spray_at=0.0):
+    """Plan a boustrophedon sweep of the board from the home corner.
+
+    Each row is wiped by a single X stroke, alternating direction, and the
+    pump sprays `spray_at` metres into each stroke while the carriage moves.
+    The last row and its stroke go on to the end switches, so each clean
+    spans the board between switch hits, then homing moves return the
+    carriage to the home corner.
+    """
+    plan = []
+    y = 0.0
+    at_far_side = False
+    rows = row_positions(height, eraser_width)
+    for i, row in enumerate(rows):
+        last = i == len(rows) - 1
+        if row > y:
+            # the top row runs into the end switch to anchor the position
+            plan.append(Move("y", row - y, True, last and row >= height))
+            y = row
+        if spray > 0:
+            plan.append(Spray(spray, spray_at))
+        plan.append(Move("x", width, not at_far_side, last))
+        at_far_side = not at_far_side
+    if at_far_side:
+        plan.append(Move("x", width, False, True))
+    plan.append(Move("y", y, False, True))
+    return plan
+
+
+def plan_rows(width, height, eraser_width, spray=0.5):
+    """Plan the original sweep, an X stroke and a full X return per row.
+
+    The pump sprays before each row while the carriage waits.
+    """
+    plan = []
+    y = 0.0
+    for row in row_positions(height, eraser_width):
+        if row > y:
+            plan.append(Move("y", row - y, True))
+            y = row
+        if spray > 0:
+            plan.append(Spray(spray))
+        plan.append(Move("x", width, True))
+        plan.append(Move("x", width, False, True))
+    plan.append(Move("y", y, False, True))
+    return plan
+
+
+def clip_rect(rect, width, height):
+    """Normalize an (x0, y0, x1, y1) rectangle and clip it to the board."""
+    if not all(math.isfinite(v) for v in rect):
+        raise ValueError(f"Rect {rect} has a non-finite coordinate")
+    x0, y0, x1, y1 = rect
+    x0, x1 = sorted((min(max(x0, 0.0), width), min(max(x1, 0.0), width)))
+    y0, y1 = sorted((min(max(y0, 0.0), height), min(max(y1, 0.0), height)))
+    return (x0, y0, x1, y1)
+
+
+def region_tour(rect, eraser_width, corner):
+    """Waypoints of a serpentine sweep of `rect` from one of its corners.
+
+    `corner` is (right, top): which x side and which y side to start from.
+    Returns the list of (start, end) points of the row strokes.
+    """
+    x0, y0, x1, y1 = rect
+    xs = (x1, x0) if corner[0] else (x0, x1)
+    rows = [y0 + r for r in row_positions(y1 - y0, eraser_width)]
+    if corner[1]:
+        rows.reverse()
+    strokes = []
+    for i, y in enumerate(rows):
+        a, b = xs if i % 2 == 0 else xs[::-1]
+        strokes.append(((a, y), (b, y)))
+    return strokes
+
+
+def _moves_between(p, q):
+    moves = []
+    for axis, a, b in (("x", p[0], q[0]), ("y", p[1], q[1])):
+        if abs(b - a) > 1e-9:
+            moves.append(Move(axis, abs(b - a), b > a))
+    return moves
+
+
+def _order_regions(rects, start, eraser_width, cost):
+    """Choose the order and start corner of each region to sweep.
+
+    Every ordering is tried for a few regions, the nearest next region is
+    taken greedily for more. Returns the stroke lists in sweep order.
+    """
+    corners = list(itertools.product((False, True), repeat=2))
+    tours = [[region_tour(r, eraser_width, c) for c in corners] for r in rects]
+
+    def tour_cost(pos, strokes):
+        return cost(pos, strokes[0][0])
+
+    if len(rects) <= 4:
+        best = None
+        for order in itertools.permutations(range(len(rects))):
+            for choice in itertools.product(range(len(corners)),
+                                            repeat=len(rects)):
+                pos, total, sweep = start, 0.0, []
+                for i, c in zip(order, choice):
+                    strokes = tours[i][c]
+                    total += tour_cost(pos, strokes)
+                    pos = strokes[-1][1]
+                    sweep.append(strokes)
+                if best is None or total < best[0]:
+                    best = (total, sweep)
+        return best[1]
+    pos, sweep, left = start, [], set(range(len(rects)))
+    while left:
+        i, strokes = min(((i, t) for i in left for t in tours[i]),
+                         key=lambda it: tour_cost(pos, it[1]))
+        left.remove(i)
+        sweep.append(strokes)
+        pos = strokes[-1][1]
+    return sweep
+
+
+def plan_regions(rects,
+                 start,
+                 width,
+                 height,
+                 eraser_width,
+                 spray=0.5,
+                 spray_at=0.0,
+                 speeds=None):
+    """Plan the sweep of one or more rectangles in board coordinates.
+
+    Rectangles are (x0, y0, x1, y1) in metres from the home corner, clipped
+    to the board. Each is swept as a serpentine, regions are visited in the
+    order and from the corners that minimize the travel time between them
+    given the axis `speeds`. The carriage stays where the last stroke ends.
+    """
+    speeds = speeds or {"x": 1.0, "y": 1.0}
+
+    def cost(p, q):
+        # the axes move one after the other
+        return abs(q[0] - p[0]) / speeds["x"] + abs(q[1] - p[1]) / speeds["y"]
+
+    rects = [clip_rect(r, width, height) for r in rects]
+    plan = []
+    pos = start
+    for strokes in _order_regions(rects, start, eraser_width, cost):
+        for a, b in strokes:
+            plan += _moves_between(pos, a)
+            if spray > 0:
+                plan.append(Spray(spray, spray_at))
+            plan += _moves_between(a, b)
+            pos = b
+    return plan
+
+
+def estimate_duration(plan, speeds):
+    """Estimated secs to run a plan given the speed (m/s) of each axis."""
+    total = 0.0
+    for step in plan:
+        if isinstance(step, Spray):
+            if step.at is None:  # overlapped sprays cost nothing
+                total += step.duration
+        else:
+            total += step.length / speeds[step.axis]
+    return total
+
+
+def travel(plan):
+    """Total distance driven by each axis in a plan."""
+    result = collections.Counter()
+    for step in plan:
+        if isinstance(step, Move):
+            result[step.axis] += step.length
+    return result
+
+
+def main():
+    # import the planner by name so plans share types with the controller
+    import gpio_backend
+    import path_planner
+    from controller import BlackboardController
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--motor-spec",
+                        default=os.path.join(script_dir, "motor_spec.json"),
+                        help="motor spec file (default: %(default)s)")
+    args = parser.parse_args()
+    with open(args.motor_spec, encoding="utf8") as f:
+        motor_conf = json.load(f)
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ("plan_rows", "plan_serpentine"):
+        sim = gpio_backend.SimBackend.from_motor_spec(motor_conf)
+        controller = BlackboardController(motor_conf, gpio=sim)
+        plan = controller.plan_full_clean(getattr(path_planner, name))
+        estimated = controller.estimate(plan)
+        t0 = sim.monotonic()
+        controller.run_plan(plan)
+        actual = sim.monotonic() - t0
+        moved = path_planner.travel(plan)
+        print(f"{name}: {len(plan)} steps, x {moved['x']:.2f}m, "
+              f"y {moved['y']:.2f}m, estimated {estimated:.2f}s, "
+              f"simulated {actual:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,106 @@
 
 import os
 import argparse
+import queue
+import threading
 import tkinter as tk
 import tkinter.font as tkFont
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg as FigureCanvas
 import audio_utils
 
 
+class LiveView(object):
+    """A rolling waveform and spectrogram, updated in place by blitting.
+
+    Only the line and the image are redrawn, over a saved background, and
+    the STFT columns are computed once each as the audio arrives.
+    """
+
+    def __init__(self,
+                 figure,
+                 canvas,
+                 ax_wave,
+                 ax_spec,
+                 sr,
+                 window=3.0,
+                 fmax=8000,
+                 points=1000):
+        self.figure = figure
+        self.canvas = canvas
+        self.ax_wave = ax_wave
+        self.ax_spec = ax_spec
+        self.points = points
+        self.samples = np.zeros(int(sr * window) // points * points,
+                                dtype=np.float32)
+        hop = round(sr * 0.016)
+        self.stft = audio_utils.StreamingSTFT(2 * hop, hop)
+        rows = int(fmax * 2 * hop / sr) + 1
+        self.image = np.full((rows, int(sr * window) // hop),
+                             self.stft.floor_db,
+                             dtype=np.float32)
+
+        ax_wave.clear()
+        ax_spec.clear()
+        # the min and max of each point's samples, an envelope
+        self.line, = ax_wave.plot(np.linspace(0, window, 2 * points),
+                                  np.zeros(2 * points),
+                                  linewidth=0.8,
+                                  animated=True)
+        ax_wave.set_xlim(0, window)
+        ax_wave.set_ylim(-1, 1)
+        ax_wave.set_ylabel("Amplitude")
+        self.im = ax_spec.imshow(self.image,
+                                 aspect="auto",
+                                 origin="lower",
+                                 cmap="cool",
+                                 extent=[0, window, 0, rows * sr / (2 * hop)],
+                                 vmin=self.stft.floor_db,
+                                 vmax=0,
+                                 animated=True)
+        ax_spec.set_xlabel("Time (s)")
+        ax_spec.set_ylabel("Frequency (Hz)")
+        self.background = None
+        # a full draw, e.g. on resize, renews the background
+        self.draw_cid = canvas.mpl_connect("draw_event", self.on_draw)
+        canvas.draw()
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        self.ax_wave.draw_artist(self.line)
+        self.ax_spec.draw_artist(self.im)
+
+    def feed(self, samples):
+        n = min(len(samples), len(self.samples))
+        self.samples = np.roll(self.samples, -n)
+        self.samples[-n:] = samples[-n:]
+        columns = self.stft.feed(samples)[:self.image.shape[0]]
+        n = min(columns.shape[1], self.image.shape[1])
+        if n:
+            self.image = np.roll(self.image, -n, axis=1)
+            self.image[:, -n:] = columns[:, -n:]
+
+    def redraw(self):
+        if self.background is None:
+            return
+        buckets = self.samples.reshape(self.points, -1)
+        envelope = np.empty(2 * self.points, dtype=np.float32)
+        envelope[0::2] = buckets.min(axis=1)
+        envelope[1::2] = buckets.max(axis=1)
+        self.line.set_ydata(envelope)
+        self.im.set_data(self.image)
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.figure.bbox)
+
+    def close(self):
+        self.canvas.mpl_disconnect(self.draw_cid)
+
+
 class AudioRecorderApp:
     """A simple app to record audio into wav file"""
 
@@ -34,6 +127,14 @@ class AudioRecorderApp:
                                      command=self.save_audio)
         self.save_button.pack()
 
+        self.session_button = tk.Button(master,
+                                        text="Live Session",
+                                        command=self.toggle_session)
+        self.session_button.pack()
+        self.session = None  # the stop event of the running session
+        self.live_view = None
+        self.blocks = queue.Queue()
+
         self.input_dev_info = audio_utils.select_input_device()[0]
         self.audio_data = None
         self.input_dev = self.input_dev_info[0]
@@ -57,6 +158,49 @@ class AudioRecorderApp:
                                      title=False)
         self.canvas.draw()
 
+    def toggle_session(self):
+        """Start or stop saving each utterance, with a live preview."""
+        if self.session is not None:
+            self.session.set()
+            return
+        self.session = threading.Event()
+        self.live_view = LiveView(self.figure, self.canvas, self.ax1,
+                                  self.ax2, self.recording_rate)
+        self.session_button.config(text="Stop Session")
+        self.record_button.config(state=tk.DISABLED)
+        self.save_button.config(state=tk.DISABLED)
+        threading.Thread(target=self.run_session,
+                         args=(self.session, ),
+                         daemon=True).start()
+        self.master.after(33, self.update_live_view)
+
+    def run_session(self, stop):
+        # the tk widgets are left to the main thread, see update_live_view
+        record_session(self.duration,
+                       self.outdir,
+                       stop=stop,
+                       on_block=self.blocks.put)
+        self.blocks.put(None)
+
+    def update_live_view(self):
+        """Show the audio received so far, about 30 times a second."""
+        while True:
+            try:
+                samples = self.blocks.get_nowait()
+            except queue.Empty:
+                break
+            if samples is None:
+                self.live_view.close()
+                self.live_view = None
+                self.session = None
+                self.session_button.config(text="Live Session")
+                self.record_button.config(state=tk.NORMAL)
+                self.save_button.config(state=tk.NORMAL)
+                return
+            self.live_view.feed(samples)
+        self.live_view.redraw()
+        self.master.after(33, self.update_live_view)
+
     def save_audio(self):
         """Save the recorded audio data to a file."""
         if self.audio_data is None:
@@ -67,6 +211,85 @@ class AudioRecorderApp:
         print(f"Audio data saved to {outfn}")
 
 
+class ClipWriter(threading.Thread):
+    """Saves the clips into `outdir`, off the audio thread."""
+
+    def __init__(self, outdir):
+        super().__init__(daemon=True)
+        self.outdir = outdir
+        self.queue = queue.Queue()
+        self.saved = 0
+
+    def save(self, clip):
+        self.queue.put(clip)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            clip = self.queue.get()
+            if clip is None:
+                return
+            outfn = audio_utils.make_filename(self.outdir)
+            audio_utils.save_voice(clip, outfn)
+            self.saved += 1
+            print(f"Clip {self.saved} saved to {outfn}")
+
+
+def record_session(duration,
+                   outdir,
+                   input_fn=None,
+                   threshold_db=12.0,
+                   stop=None,
+                   on_block=None):
+    """Save each utterance spoken, or found in the wav `input_fn`.
+
+    Runs until the `stop` event is set, Ctrl-C or the end of the input.
+    `on_block(samples)` sees the audio as it arrives, e.g. to preview it.
+    """
+    if input_fn is not None:
+        with open(input_fn, "rb") as f:
+            audio = audio_utils.decode_audio(f.read())
+        sr = audio_utils.VOICE_SAMPLERATE
+        block = int(sr * 0.1)
+        blocks = (audio[i:i + block] for i in range(0, len(audio), block))
+        print(f">>> Segmenting {len(audio) / sr:.1f}s of {input_fn}")
+    else:
+        dev = audio_utils.select_input_device()[0]
+        sr = dev[2]
+        blocks = audio_utils.stream_voice(dev[0], sr)
+        print(f">>> Listening on device {dev[0]} at {sr}Hz, say the "
+              f"commands with a pause between, Ctrl-C to end")
+    segmenter = audio_utils.UtteranceSegmenter(sr,
+                                               duration,
+                                               threshold_db=threshold_db)
+    writer = ClipWriter(outdir)
+    writer.start()
+
+    def save(clips):
+        for clip in clips:
+            if sr != audio_utils.VOICE_SAMPLERATE:
+                clip = audio_utils.resample_voice(clip, sr)
+            writer.save(clip)
+
+    try:
+        for samples in blocks:
+            if stop is not None and stop.is_set():
+                break
+            if on_block is not None:
+                on_block(samples)
+            save(segmenter.feed(samples))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        blocks.close()  # ends the input stream
+    save(segmenter.flush())
+    writer.close()
+    print(f">>> {writer.saved} clips saved to {outdir}")
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("duration",
@@ -77,8 +300,24 @@ def main():
                         type=float,
                         default=1.0,
                         help="UI scaling factor (default: 1.0)")
+    parser.add_argument("--session",
+                        action="store_true",
+                        help="record hands-free, saving each utterance")
+    parser.add_argument("--input",
+                        help="segment this long recording instead of the "
+                        "microphone, implies --session")
+    parser.add_argument("--threshold-db",
+                        type=float,
+                        default=12.0,
+                        help="utterance energy over the noise floor "
+                        "(default: %(default)s)")
     args = parser.parse_args()
 
+    if args.session or args.input:
+        record_session(args.duration, args.outdir, args.input,
+                       args.threshold_db)
+        return
+
     root = tk.Tk()
     if args.ui_scale_factor > 1.0:
         scale = args.ui_scale_factor
@@ -1,54 +1,611 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
 import email
+import email.message
+import gzip
+import hashlib
 import http.server
+import itertools
 import json
+import logging
+import math
+import os
+import queue
 import threading
+import time
 import urllib.parse
-from email.parser import BytesParser
-from email.policy import default
 from functools import partial
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 
+import metrics
+import multipart
+import websocket_utils
+
+
+# Voice labels that name a different action, and the least probability of a
+# label to act on it, as in the GUI
+VOICE_ACTIONS = {'go': 'full'}
+VOICE_CONFIDENCE = 0.8
+
+# the method and route of a request whose request line did not parse
+BAD_REQUEST = '<bad-request>'
+HTTP_REQUESTS = metrics.counter('http_requests_total', 'HTTP requests',
+                                ['method', 'route', 'code'])
+HTTP_SECONDS = metrics.histogram('http_request_seconds',
+                                 'Time to handle an HTTP request',
+                                 ['method', 'route'])
+DISPATCHED = metrics.counter('server_dispatch_total',
+                             'Actions by dispatch outcome', ['outcome'])
+EVENTS_DROPPED = metrics.counter('server_event_clients_dropped_total',
+                                 'Event stream clients dropped as too slow')
+
+_voice_models = {}
+_voice_models_lock = threading.Lock()
+
+
+def load_voice_model(model_spec):
+    """The VoiceCmdModel of a model spec file, loaded once per process."""
+    with _voice_models_lock:
+        if model_spec not in _voice_models:
+            # heavy imports, only for servers that recognize voice
+            from voice_model import VoiceCmdModel
+            with open(model_spec, encoding='utf8') as f:
+                model_conf = json.load(f)
+            model_fn = os.path.join(os.path.dirname(model_spec),
+                                    model_conf['fn'])
+            _voice_models[model_spec] = VoiceCmdModel(
+                model_fn, model_conf['sr'], model_conf['duration'],
+                model_conf['feature'], **model_conf['args'])
+        return _voice_models[model_spec]
+
+
+class EventSubscriber(object):
+    """The bounded queue of encoded events of one `/events` client."""
+
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+
+class EventHub(object):
+    """Fans out server-sent events from any thread to the `/events` clients.
+
+    Each event is encoded once and put on every client's bounded queue. A
+    client too slow to drain its queue is dropped rather than slowing down
+    the producer. New clients first get the last event of each kind.
+    """
+
+    def __init__(self, queue_size=100):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.queue_size = queue_size
+        self.ids = itertools.count(1)
+        self.last = collections.OrderedDict()
+
+    def subscribe(self):
+        subscriber = EventSubscriber(self.queue_size)
+        with self.lock:
+            for message in list(self.last.values())[-self.queue_size:]:
+                subscriber.queue.put_nowait(message)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, event, data):
+        with self.lock:
+            message = (f'id: {next(self.ids)}\nevent: {event}\n'
+                       f'data: {json.dumps(data)}\n\n').encode('utf-8')
+            self.last[event] = message
+            self.last.move_to_end(event)
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.queue.put_nowait(message)
+                except queue.Full:
+                    # its full queue wakes it up to see the flag and quit
+                    subscriber.dropped = True
+                    self.subscribers.discard(subscriber)
+                    EVENTS_DROPPED.inc()
+
+    def close(self):
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.dropped = True
+                try:
+                    subscriber.queue.put_nowait(None)
+                except queue.Full:
+                    pass
+            self.subscribers.clear()
+
+
+class JobQueue(object):
+    """Runs submitted actions one at a time on a single motion worker.
+
+    Request threads only enqueue and return, so they never wait for the
+    motors. Finished jobs are kept for `/jobs/<id>` up to `history` jobs.
+    Each status change is passed to `listener(event, job)` if given. `arm`
+    is called before a job becomes running, so a stop from then on cancels
+    it, see BlackboardController.arm.
+    """
+
+    def __init__(self, history=100, listener=None, arm=None):
+        self.listener = listener
+        self.arm = arm
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.jobs = collections.OrderedDict()
+        self.history = history
+        self.ids = itertools.count(1)
+        self.current = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, action, handler, *args):
+        job = {
+            'id': next(self.ids),
+            'action': action,
+            'status': 'queued',
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'error': None,
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        self.notify(job)
+        self.queue.put((job, handler, args))
+        return dict(job)
+
+    def notify(self, job):
+        if self.listener is not None:
+            self.listener('job', dict(job))
+
+    def replace_queued(self, actions):
+        """Mark the queued jobs of `actions` replaced, returns how many."""
+        changed = []
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] == 'queued' and job['action'] in actions:
+                    job['status'] = 'replaced'
+                    changed.append(dict(job))
+        for job in changed:
+            self.notify(job)
+        return len(changed)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def cancel(self):
+        """Mark the running job stopped and drop the queued ones."""
+        changed = []
+        with self.lock:
+            if self.current is not None:
+                self.current['status'] = 'stopping'
+                changed.append(dict(self.current))
+            for job in self.jobs.values():
+                if job['status'] == 'queued':
+                    job['status'] = 'cancelled'
+                    changed.append(dict(job))
+        for job in changed:
+            self.notify(job)
+
+    def close(self):
+        self.cancel()
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            job, handler, args = item
+            with self.lock:
+                if job['status'] != 'queued':  # cancelled or replaced
+                    continue
+                if self.arm is not None:
+                    self.arm()
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self.current = job
+            self.notify(job)
+            status, error = 'done', None
+            try:
+                if handler is not None:
+                    handler(*args)
+            except Exception as e:
+                logging.exception('Job %d (%s) failed', job['id'],
+                                  job['action'])
+                status, error = 'failed', str(e)
+            with self.lock:
+                if job['status'] == 'stopping' and status == 'done':
+                    status = 'cancelled'
+                job['status'] = status
+                job['error'] = error
+                job['finished'] = time.time()
+                self.current = None
+            self.notify(job)
+
+
+class RateLimited(Exception):
+    """A client sent actions faster than its token bucket allows."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Too many actions, retry in {retry_after:.1f}s.')
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Allows `rate` actions per sec on average and bursts of `burst`."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Take a token, returns 0 or the secs until one is available."""
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Dispatcher(object):
+    """Filters actions from the clients before they reach the job queue.
+
+    - An action repeating the last one (same arguments) within its
+      `debounce` secs returns the job already submitted.
+    - A jog replaces any jog still queued, the latest one wins.
+    - Each client has a token bucket of `rate` actions per sec.
+
+    Stop is never filtered. The outcomes are counted in DISPATCHED.
+    """
+
+    JOGS = ('up', 'down', 'left', 'right')
+    # secs within which a repeated action is the same request
+    DEBOUNCE = {'full': 2.0, 'reset': 2.0, 'manual': 1.0, 'region': 1.0}
+    DEFAULT_DEBOUNCE = 0.2
+
+    def __init__(self, jobs, rate=2.0, burst=5, max_clients=1000):
+        self.jobs = jobs
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.last = {}  # action -> (args, time, job id)
+
+    def submit(self, client, action, handler, *args):
+        """Submit or filter an action, returns its job with a `dispatch`.
+
+        `dispatch` is "queued", "replaced" (it replaced queued jogs) or
+        "debounced" (the job is an earlier one). Raises RateLimited.
+        """
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(action)
+            window = self.DEBOUNCE.get(action, self.DEFAULT_DEBOUNCE)
+            if last is not None and last[0] == args and now - last[1] < window:
+                job = self.jobs.get(last[2])
+                if job is not None and job['status'] in ('queued', 'running'):
+                    DISPATCHED.inc(outcome='debounced')
+                    job['dispatch'] = 'debounced'
+                    return job
+            retry_after = self._bucket(client, now).take(now)
+            if retry_after > 0:
+                DISPATCHED.inc(outcome='limited')
+                raise RateLimited(retry_after)
+            replaced = 0
+            if action in self.JOGS:
+                replaced = self.jobs.replace_queued(self.JOGS)
+                if replaced:
+                    DISPATCHED.inc(replaced, outcome='replaced')
+            job = self.jobs.submit(action, handler, *args)
+            self.last[action] = (args, now, job['id'])
+            DISPATCHED.inc(outcome='accepted')
+        job['dispatch'] = 'replaced' if replaced else 'queued'
+        return job
+
+    def _bucket(self, client, now):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.max_clients:
+                # forget the clients whose buckets have refilled
+                self.buckets = {
+                    c: b
+                    for c, b in self.buckets.items()
+                    if b.tokens + (now - b.updated) * b.rate < b.burst
+                }
+            bucket = self.buckets[client] = TokenBucket(
+                self.rate, self.burst, now)
+        return bucket
+
+    def stats(self):
+        return {key[0]: value for _, key, _, value in DISPATCHED.samples()}
+
+
+class ControlServer(ThreadingHTTPServer):
+    """A threaded HTTP server with the motion job queue of its handlers."""
+
+    daemon_threads = True
+
+    def __init__(self,
+                 server_address,
+                 handler_class,
+                 jobs=None,
+                 model_spec=None,
+                 model=None,
+                 arm=None):
+        self.events = EventHub()
+        self.jobs = jobs or JobQueue(listener=self.events.publish, arm=arm)
+        self.dispatcher = Dispatcher(self.jobs)
+        metrics.gauge('server_jobs_queued',
+                      'Motion jobs waiting for the worker').set_function(
+                          self.jobs.queue.qsize)
+        metrics.gauge('server_event_clients',
+                      'Connected event stream clients').set_function(
+                          lambda: len(self.events.subscribers))
+        self.model_spec = model_spec
+        self.model = model  # e.g. the controller daemon's
+        # the tflite interpreter must not run on two threads at once
+        self.voice_lock = threading.Lock()
+        super().__init__(server_address, handler_class)
+
+    def voice_model(self):
+        if self.model is not None:
+            return self.model
+        if self.model_spec is None:
+            return None
+        return load_voice_model(self.model_spec)
+
+    def server_close(self):
+        self.jobs.close()
+        self.events.close()
+        super().server_close()
+
+
+def accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header allows gzip, by its q-values."""
+    qualities = {}
+    for coding in (accept_encoding or '').split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            qualities[name.lower()] = q
+    q = qualities.get('gzip', qualities.get('x-gzip', qualities.get('*', 0)))
+    return q > 0
+
+
+class StaticPage(object):
+    """A page encoded once, with its gzip variant and their ETags."""
+
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gz"'
+
+    def matches(self, if_none_match):
+        """Whether the client's If-None-Match has a variant of the page."""
+        if not if_none_match:
+            return False
+        tags = {tag.strip() for tag in if_none_match.split(',')}
+        tags = {tag[2:] if tag.startswith('W/') else tag for tag in tags}
+        return '*' in tags or bool(tags & {self.etag, self.gzip_etag})
+
 
 class ControlServerHandler(BaseHTTPRequestHandler):
 
+    # Persistent connections, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, without TCP_NODELAY the body
+    # waits for the client's delayed ACK (~40ms) on a reused connection
+    disable_nagle_algorithm = True
+    # The control page, rendered once by `prepare_page`
+    page = None
+
+    # Largest voice command recording accepted, and the room allowed for the
+    # rest of the multipart form around it
+    max_upload = 8 << 20
+    max_form_overhead = 64 << 10
+
     def __init__(self, action_handlers, *args, **kwargs):
         self.actions = {}
         for action in ("up", "down", "left", "right", "full", "reset",
-                       "manual"):
+                       "manual", "stop", "region"):
             self.actions[action] = action_handlers.get(action, None)
         super().__init__(*args, **kwargs)
 
     # Define action methods
     def on_up(self):
         print("Action: up")
-        # Implement your 'up' action here
+        return self.submit('up')
 
     def on_down(self):
         print("Action: down")
-        # Implement your 'down' action here
+        return self.submit('down')
 
     def on_left(self):
         print("Action: left")
-        # Implement your 'left' action here
+        return self.submit('left')
 
     def on_right(self):
         print("Action: right")
-        # Implement your 'right' action here
+        return self.submit('right')
 
     def on_full(self):
         print("Action: full")
-        # Implement your 'full' action here
+        return self.submit('full')
 
     def on_reset(self):
         print("Action: reset")
-        # Implement your 'reset' action here
+        return self.submit('reset')
 
     def on_manual(self):
         print("Action: manual")
-        # Implement your 'manual' action here
+        return self.submit('manual')
+
+    def on_region(self):
+        # /action/region?rect=x0,y0,x1,y1&rect=... in metres from home
+        rects = []
+        for value in self.query.get('rect', []):
+            try:
+                rect = tuple(float(v) for v in value.split(','))
+            except ValueError:
+                rect = ()
+            if len(rect) != 4 or not all(math.isfinite(v) for v in rect):
+                raise ValueError(f'Bad rect "{value}", expect x0,y0,x1,y1.')
+            rects.append(rect)
+        if not rects:
+            raise ValueError('No rect given.')
+        print(f"Action: region {rects}")
+        return self.submit('region', rects)
+
+    def on_stop(self):
+        print("Action: stop")
+        # Pre-empt the running motion and drop the queued ones, must return
+        # within a tick
+        self.server.jobs.cancel()
+        self.run_handler("stop")
+
+    def run_handler(self, action):
+        handler = self.actions.get(action)
+        if handler is not None:
+            handler()
+
+    def submit(self, action, *args):
+        """Queue an action on the motion worker, returns the job."""
+        return self.server.dispatcher.submit(self.client_address[0], action,
+                                             self.actions.get(action), *args)
+
+    def handle_one_request(self):
+        self.status_code = None
+        t0 = time.perf_counter()
+        super().handle_one_request()
+        if self.status_code is None:
+            return  # no request, the connection closed
+        route = self.route()
+        # a request line that fails to parse has no command
+        method = self.command or BAD_REQUEST
+        HTTP_SECONDS.observe(time.perf_counter() - t0,
+                             method=method,
+                             route=route)
+        HTTP_REQUESTS.inc(method=method,
+                          route=route,
+                          code=str(self.status_code))
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def route(self):
+        """The path of a request with its variable parts folded."""
+        path = getattr(self, 'path', None)
+        if path is None:
+            return BAD_REQUEST  # the request line did not parse
+        path = urllib.parse.urlparse(path).path
+        if path in ('/', '/index.html'):
+            return '/'
+        if path in ('/metrics', '/events', '/ws/voice', '/jobs'):
+            return path
+        if path.startswith('/jobs/'):
+            return '/jobs/<id>'
+        if path.startswith('/action/'):
+            action = path[len('/action/'):]
+            if action in self.actions or action in ('voice_cmd', 'exit'):
+                return path
+            return '/action/<unknown>'
+        return '<unknown>'
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, response):
+        self.send_body(code,
+                       json.dumps(response).encode('utf-8'),
+                       'application/json')
+
+    def send_limited(self, e):
+        response = json.dumps({'status': 'error', 'message': str(e)})
+        self.send_response(429)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.send_header('Retry-After', str(max(1, round(e.retry_after))))
+        self.end_headers()
+        self.wfile.write(response.encode('utf-8'))
+
+    def reject(self, code, message):
+        """Answer an error before the request body is read."""
+        self.close_connection = True  # the body is left unread
+        self.send_json(code, {'status': 'error', 'message': message})
+
+    @classmethod
+    def prepare_page(cls):
+        if cls.page is None:
+            cls.page = StaticPage(cls.generate_html().encode('utf-8'),
+                                  'text/html; charset=utf-8')
+        return cls.page
+
+    def serve_page(self):
+        page = self.prepare_page()
+        use_gzip = accepts_gzip(self.headers.get('Accept-Encoding'))
+        etag = page.gzip_etag if use_gzip else page.etag
+        if page.matches(self.headers.get('If-None-Match')):
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.send_page_headers(etag)
+            self.end_headers()
+            return
+        body = page.gzip_body if use_gzip else page.body
+        self.send_response(200)
+        self.send_header('Content-type', page.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_page_headers(etag)
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page_headers(self, etag):
+        """The validator and cache headers of the page, 200 or 304."""
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')  # revalidate by ETag
+        self.send_header('Vary', 'Accept-Encoding')
+
+    def send_job(self, job, message, **extra):
+        response = {'status': 'accepted', 'message': message, 'job': job}
+        response.update(extra)
+        self.send_json(202, response)
 
     def on_voice_cmd(self):
         # This method is handled in do_POST
@@ -56,12 +613,12 @@ class ControlServerHandler(BaseHTTPRequestHandler):
 
     def on_exit(self):
         print("Action: exit - shutting down server.")
+        # Stop any running motion instead of waiting for it to finish
+        self.on_stop()
         # Respond to the client before shutting down
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
+        self.close_connection = True
         response = {'status': 'success', 'message': 'Server is shutting down.'}
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+        self.send_json(200, response)
         # Shutdown the server in a separate thread to avoid blocking
         threading.Thread(target=self.server.shutdown).start()
 
@@ -69,180 +626,301 @@ class ControlServerHandler(BaseHTTPRequestHandler):
         # Parse the URL path
         parsed_path = urllib.parse.urlparse(self.path)
         path = parsed_path.path
+        self.query = urllib.parse.parse_qs(parsed_path.query)
 
         if path in ['/', '/index.html']:
             # Serve the HTML page with buttons and AJAX functionality
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            html_content = self.generate_html()
-            self.wfile.write(html_content.encode('utf-8'))
+            self.serve_page()
+        elif path == '/ws/voice':
+            self.serve_voice_stream()
+        elif path == '/events':
+            self.serve_events()
+        elif path == '/metrics':
+            self.send_body(200,
+                           metrics.expose().encode('utf-8'),
+                           'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/jobs':
+            self.send_json(
+                200, {
+                    'status': 'success',
+                    'jobs': self.server.jobs.list(),
+                    'dispatch': self.server.dispatcher.stats()
+                })
+        elif path.startswith('/jobs/'):
+            job_id = path.split('/jobs/')[1]
+            job = None
+            if job_id.isdigit():
+                job = self.server.jobs.get(int(job_id))
+            if job is None:
+                self.send_json(404, {
+                    'status': 'error',
+                    'message': f'Job "{job_id}" not found.'
+                })
+            else:
+                self.send_json(200, {'status': 'success', 'job': job})
         elif path.startswith('/action/'):
             # Extract the action from the URL
             action = path.split('/action/')[1]
             # Map the action to the corresponding method
             action_method = getattr(self, f'on_{action}', None)
             if action_method and callable(action_method):
-                action_method()
+                try:
+                    job = action_method()
+                except ValueError as e:
+                    self.send_json(400, {'status': 'error', 'message': str(e)})
+                    return
+                except RateLimited as e:
+                    self.send_limited(e)
+                    return
+                if job is not None:
+                    # Motion runs on the worker, poll /jobs/<id> for it
+                    self.send_job(job, f'Action "{action}" queued.')
                 # For 'exit', the response is already sent in the method
-                if action != 'exit':
+                elif action != 'exit':
                     # Prepare a JSON response
                     response = {
                         'status': 'success',
                         'message': f'Action "{action}" executed successfully.'
                     }
-                    response_bytes = json.dumps(response).encode('utf-8')
-                    self.send_response(200)
-                    self.send_header('Content-type', 'application/json')
-                    self.send_header('Content-Length',
-                                     str(len(response_bytes)))
-                    self.end_headers()
-                    self.wfile.write(response_bytes)
+                    self.send_json(200, response)
             else:
                 # Action not found
                 response = {
                     'status': 'error',
                     'message': f'Action "{action}" not found.'
                 }
-                response_bytes = json.dumps(response).encode('utf-8')
-                self.send_response(404)
-                self.send_header('Content-type', 'application/json')
-                self.send_header('Content-Length', str(len(response_bytes)))
-                self.end_headers()
-                self.wfile.write(response_bytes)
+                self.send_json(404, response)
         else:
             # Path not found
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Page not found.')
+            self.send_body(404, b'Page not found.', 'text/plain')
 
     def do_POST(self):
         # Handle POST requests for /action/voice_cmd
         parsed_path = urllib.parse.urlparse(self.path)
         path = parsed_path.path
+        self.query = urllib.parse.parse_qs(parsed_path.query)
 
         if path == '/action/voice_cmd':
+            self.timing = {}
+            t0 = time.perf_counter()
             # Parse the form data posted
             content_type = self.headers.get('Content-Type')
             if not content_type:
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(b'Content-Type header missing.')
+                self.reject(400, 'Content-Type header missing.')
                 return
 
             # Parse multipart/form-data using the email module
-            ctype, pdict = urllib.parse.parse_header(content_type)
+            header = email.message.Message()
+            header['Content-Type'] = content_type
+            ctype = header.get_content_type()
             if ctype != 'multipart/form-data':
-                self.send_response(400)
-                self.end_headers()
-                response = {
-                    'status': 'error',
-                    'message': 'Content-Type must be multipart/form-data.'
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                self.reject(400, 'Content-Type must be multipart/form-data.')
                 return
 
-            boundary = pdict.get('boundary')
+            boundary = header.get_param('boundary')
             if not boundary:
-                self.send_response(400)
-                self.end_headers()
-                response = {
-                    'status': 'error',
-                    'message': 'Boundary not found in Content-Type.'
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                self.reject(400, 'Boundary not found in Content-Type.')
                 return
 
-            # Read the form data
-            content_length = int(self.headers.get('Content-Length', 0))
-            body = self.rfile.read(content_length)
-
-            # Parse the multipart data
-            parser = BytesParser(policy=default)
-            msg = parser.parsebytes(body)
-
-            # Extract the audio file
-            audio_data = None
-            for part in msg.iter_parts():
-                if part.get_content_disposition(
-                ) == 'form-data' and part.get_param('name') == 'audio':
-                    audio_data = part.get_payload(decode=True)
-                    break
+            # Reject what cannot fit before reading any of the body
+            content_length = self.headers.get('Content-Length')
+            if not content_length or not content_length.isdigit():
+                self.reject(411, 'Content-Length header missing.')
+                return
+            content_length = int(content_length)
+            if content_length > self.max_upload + self.max_form_overhead:
+                self.reject(413, f'Upload exceeds {self.max_upload} bytes.')
+                return
 
-            if not audio_data:
-                self.send_response(400)
-                self.end_headers()
-                response = {
-                    'status': 'error',
-                    'message': 'No audio data received.'
-                }
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+            # Stream the audio file out of the multipart data
+            try:
+                audio_data = multipart.read_field(self.rfile, content_length,
+                                                  boundary, 'audio',
+                                                  self.max_upload)
+            except multipart.MultipartError as e:
+                self.reject(e.code, str(e))
                 return
 
+            self.timing['upload_ms'] = (time.perf_counter() - t0) * 1000
             # Process the audio data to determine the command
-            command = self.parse_voice_command(audio_data)
+            try:
+                command = self.parse_voice_command(audio_data)
+            except ValueError as e:
+                self.send_json(400, {
+                    'status': 'error',
+                    'message': str(e),
+                    'timing': self.timing
+                })
+                return
+            self.timing['total_ms'] = (time.perf_counter() - t0) * 1000
 
             if command and hasattr(self, f'on_{command}'):
                 # Execute the corresponding action
                 action_method = getattr(self, f'on_{command}')
                 if callable(action_method):
-                    action_method()
+                    try:
+                        job = action_method()
+                    except RateLimited as e:
+                        self.send_limited(e)
+                        return
+                    if job is not None:
+                        self.send_job(job,
+                                      f'Voice command "{command}" queued.',
+                                      timing=self.timing)
+                        return
                     response = {
                         'status':
                         'success',
                         'message':
                         f'Voice command "{command}" executed successfully.'
                     }
-                    self.send_response(200)
+                    code = 200
                 else:
                     response = {
                         'status': 'error',
                         'message': f'Action "{command}" is not callable.'
                     }
-                    self.send_response(400)
+                    code = 400
             else:
                 # Unrecognized or missing command
                 response = {
                     'status': 'error',
                     'message': f'Unrecognized voice command "{command}".'
                 }
-                self.send_response(400)
+                code = 400
+            response['timing'] = self.timing
 
             # Send JSON response
-            response_bytes = json.dumps(response).encode('utf-8')
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Content-Length', str(len(response_bytes)))
-            self.end_headers()
-            self.wfile.write(response_bytes)
+            self.send_json(code, response)
         else:
             # Path not found for POST
-            self.send_response(404)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Page not found.')
+            self.close_connection = True  # the body is left unread
+            self.send_body(404, b'Page not found.', 'text/plain')
 
     def parse_voice_command(self, audio_data):
+        """Recognize the action of an uploaded voice command recording.
+
+        Returns the action name, or None for noise or an unsure prediction.
+        The decode and predict times in ms go into `self.timing`.
         """
-        Placeholder function to parse audio data and extract the voice command.
-        Implement this function using a speech recognition library or external API.
+        model = self.server.voice_model()
+        if model is None:
+            raise ValueError('Voice commands are not enabled.')
+        with self.server.voice_lock:
+            result = model.recognize(audio_data)
+        self.timing.update(result['timing'])
+        command = result['command']
+        probability = float(result['details'][command])
+        print(f"Voice command: {command} ({probability*100:.1f}%)")
+        self.server.events.publish('voice', {
+            'command': command,
+            'probability': probability
+        })
+        if command == '__noise__' or probability <= VOICE_CONFIDENCE:
+            return None
+        return VOICE_ACTIONS.get(command, command)
+
+    def serve_events(self):
+        """Stream the server events to the client until it goes away."""
+        # the stream has no length, it ends with the connection
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        subscriber = self.server.events.subscribe()
+        try:
+            while True:
+                try:
+                    message = subscriber.queue.get(timeout=15)
+                except queue.Empty:
+                    message = b': keepalive\n\n'  # detects gone clients
+                if message is None or subscriber.dropped:
+                    break
+                self.wfile.write(message)
+                self.wfile.flush()
+        except OSError:
+            pass  # the client went away
+        finally:
+            self.server.events.unsubscribe(subscriber)
+
+    def serve_voice_stream(self):
+        """Recognize commands in live audio sent over a WebSocket.
+
+        The client sends a text message {"sr": rate} first, then binary
+        messages of mono int16 little endian samples. Each recognized
+        command runs its action and is pushed back as a JSON text message.
         """
-        # Example: Using an external API or library to convert audio_data to text
-        # For demonstration, we'll simulate this by returning a fixed command
-        # In reality, you would process 'audio_data' to get the actual command
-        print("Received audio data for voice command processing.")
-        # TODO: Replace with actual audio processing
-        # Example return value:
-        # return "up"
+        model = self.server.voice_model()
+        if model is None:
+            self.send_json(503, {
+                'status': 'error',
+                'message': 'Voice commands are not enabled.'
+            })
+            return
+        ws = websocket_utils.accept(self)
+        if ws is None:
+            return
+        # needs numpy, only for voice commands
+        import numpy as np
+        from voice_model import StreamRecognizer
+        recognizer = None
+        try:
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                opcode, payload = message
+                if opcode == websocket_utils.OP_TEXT:
+                    sr = int(json.loads(payload)['sr'])
+                    recognizer = StreamRecognizer(model,
+                                                  sr,
+                                                  confidence=VOICE_CONFIDENCE,
+                                                  lock=self.server.voice_lock)
+                    ws.send_text(json.dumps({'status': 'ready', 'sr': sr}))
+                    continue
+                if recognizer is None:
+                    raise websocket_utils.WebSocketError(
+                        'Send {"sr": rate} before the audio.')
+                samples = np.frombuffer(payload, dtype='<i2')
+                t0 = time.perf_counter()
+                for result in recognizer.feed(samples / np.float32(32768)):
+                    result['timing'] = {
+                        'predict_ms': (time.perf_counter() - t0) * 1000
+                    }
+                    ws.send_text(json.dumps(self.run_voice_command(result)))
+        except websocket_utils.WebSocketError as e:
+            ws.close(e.code, str(e))
+        except (KeyError, ValueError) as e:
+            ws.close(websocket_utils.CLOSE_PROTOCOL_ERROR, str(e))
+        except (EOFError, OSError):
+            pass  # the client went away
 
-        # Simulated command for demonstration purposes
-        return "up"  # Replace with actual parsed command
+    def run_voice_command(self, result):
+        """Run the action of a recognized command, returns the message."""
+        print(f"Voice command: {result['command']} "
+              f"({result['probability']*100:.1f}%)")
+        self.server.events.publish('voice', {
+            'command': result['command'],
+            'probability': result['probability']
+        })
+        action = VOICE_ACTIONS.get(result['command'], result['command'])
+        action_method = getattr(self, f'on_{action}', None)
+        try:
+            job = action_method() if action_method is not None else None
+        except RateLimited as e:
+            result.update(status='error', action=action, message=str(e))
+            return result
+        result.update(status='success', action=action, job=job)
+        return result
 
     def log_message(self, format, *args):
         # Override to disable console logging
         return
 
-    def generate_html(self):
+    @classmethod
+    def generate_html(cls):
         # Define the buttons in the specified 3x3 grid layout
         buttons = [
             ('重置', '/action/reset'),
@@ -273,11 +951,12 @@ class ControlServerHandler(BaseHTTPRequestHandler):
         html_buttons = ""
         for button in grid_positions:
             label, endpoint = button
-            if label.lower() == 'voice':
-                # Special handling for Voice Command button
+            if endpoint == '/action/voice_cmd':
+                # Special handling for Voice Command button, it records and
+                # posts the audio
                 html_buttons += f"""
                 <div class="grid-item">
-                    <button id="btn-{label.lower()}">{label}</button>
+                    <button id="btn-voice">{label}</button>
                 </div>
                 """
             else:
@@ -318,6 +997,16 @@ class ControlServerHandler(BaseHTTPRequestHandler):
                     height: 120px;
                     cursor: pointer;
                 }}
+                button.live {{
+                    width: 400px;
+                    height: 60px;
+                    margin-bottom: 20px;
+                }}
+                .status {{
+                    font-size: 14px;
+                    color: #666;
+                    margin-top: 10px;
+                }}
                 #response {{
                     font-size: 18px;
                     color: #333;
@@ -329,9 +1018,53 @@ class ControlServerHandler(BaseHTTPRequestHandler):
             <div class="grid-container">
                 {html_buttons}
             </div>
+            <div><button id="btn-live" class="live">实时语音</button></div>
             <div id="response">无操作</div>
+            <div id="state" class="status"></div>
+            <div id="voice" class="status"></div>
 
             <script>
+                // Show the response of an action
+                function showResponse(data) {{
+                    const output = document.getElementById('response');
+                    if (data.status === 'success' || data.status === 'accepted') {{
+                        output.innerText = data.message;
+                    }} else {{
+                        output.innerText = 'Error: ' + data.message;
+                    }}
+                }}
+
+                // Follow the jobs, motion and voice commands pushed by the
+                // server
+                const events = new EventSource('/events');
+                events.addEventListener('job', event => {{
+                    const job = JSON.parse(event.data);
+                    document.getElementById('response').innerText =
+                        'Job ' + job.id + ' (' + job.action + '): ' + job.status;
+                }});
+                events.addEventListener('move', event => {{
+                    const move = JSON.parse(event.data);
+                    document.getElementById('state').innerText =
+                        move.axis.toUpperCase() + (move.forward ? ' +' : ' -') +
+                        (move.homing ? ' homing' : move.length.toFixed(3) + 'm');
+                }});
+                const showPosition = event => {{
+                    const moved = JSON.parse(event.data);
+                    const pos = moved.position;
+                    const fmt = v => v === null ? '?' : v.toFixed(3);
+                    document.getElementById('state').innerText =
+                        'X ' + fmt(pos.x) + 'm, Y ' + fmt(pos.y) + 'm' +
+                        (moved.reason === 'done' ? '' : ' (' + moved.reason + ')');
+                }};
+                events.addEventListener('moved', showPosition);
+                events.addEventListener('collision', showPosition);
+                events.addEventListener('voice', event => {{
+                    const voice = JSON.parse(event.data);
+                    document.getElementById('voice').innerText =
+                        'Heard "' + voice.command + '" (' +
+                        (voice.probability * 100).toFixed(1) + '%)';
+                }});
+
                 // Function to handle button clicks for standard actions
                 function handleButtonClick(event) {{
                     const button = event.target;
@@ -340,13 +1073,7 @@ class ControlServerHandler(BaseHTTPRequestHandler):
 
                     fetch(endpoint)
                         .then(response => response.json())
-                        .then(data => {{
-                            if (data.status === 'success') {{
-                                document.getElementById('response').innerText = data.message;
-                            }} else {{
-                                document.getElementById('response').innerText = 'Error: ' + data.message;
-                            }}
-                        }})
+                        .then(showResponse)
                         .catch(error => {{
                             document.getElementById('response').innerText = 'Fetch error: ' + error;
                         }});
@@ -397,13 +1124,7 @@ class ControlServerHandler(BaseHTTPRequestHandler):
                                     body: formData
                                 }})
                                 .then(response => response.json())
-                                .then(data => {{
-                                    if (data.status === 'success') {{
-                                        document.getElementById('response').innerText = data.message;
-                                    }} else {{
-                                        document.getElementById('response').innerText = 'Error: ' + data.message;
-                                    }}
-                                }})
+                                .then(showResponse)
                                 .catch(error => {{
                                     document.getElementById('response').innerText = 'Fetch error: ' + error;
                                 }});
@@ -420,6 +1141,74 @@ class ControlServerHandler(BaseHTTPRequestHandler):
                             console.error(err);
                         }});
                 }});
+
+                // Live Voice Button Handling, streams 16 bit PCM to the
+                // server which pushes back the recognized commands
+                const liveButton = document.getElementById('btn-live');
+                let live = null;
+
+                liveButton.addEventListener('click', () => {{
+                    if (live) {{
+                        live.stop();
+                        return;
+                    }}
+                    navigator.mediaDevices.getUserMedia({{ audio: true }})
+                        .then(stream => {{
+                            const output = document.getElementById('response');
+                            const context = new AudioContext();
+                            const source = context.createMediaStreamSource(stream);
+                            const processor = context.createScriptProcessor(4096, 1, 1);
+                            const scheme = location.protocol === 'https:' ? 'wss://' : 'ws://';
+                            const ws = new WebSocket(scheme + location.host + '/ws/voice');
+                            ws.binaryType = 'arraybuffer';
+
+                            live = {{
+                                stop: () => {{
+                                    processor.disconnect();
+                                    source.disconnect();
+                                    stream.getTracks().forEach(track => track.stop());
+                                    context.close();
+                                    ws.close();
+                                    live = null;
+                                    liveButton.innerText = '实时语音';
+                                }}
+                            }};
+                            liveButton.innerText = '停止监听';
+
+                            ws.onopen = () => ws.send(JSON.stringify({{ sr: context.sampleRate }}));
+                            ws.onmessage = event => {{
+                                const data = JSON.parse(event.data);
+                                if (data.command) {{
+                                    output.innerText = 'Voice command "' + data.command + '" (' +
+                                        (data.probability * 100).toFixed(1) + '%)';
+                                }} else {{
+                                    output.innerText = 'Listening at ' + data.sr + 'Hz';
+                                }}
+                            }};
+                            ws.onclose = event => {{
+                                if (event.reason) {{
+                                    output.innerText = 'Error: ' + event.reason;
+                                }}
+                                if (live) live.stop();
+                            }};
+
+                            processor.onaudioprocess = event => {{
+                                if (ws.readyState !== WebSocket.OPEN) return;
+                                const input = event.inputBuffer.getChannelData(0);
+                                const pcm = new Int16Array(input.length);
+                                for (let i = 0; i < input.length; i++) {{
+                                    pcm[i] = Math.max(-1, Math.min(1, input[i])) * 32767;
+                                }}
+                                ws.send(pcm.buffer);
+                            }};
+                            source.connect(processor);
+                            processor.connect(context.destination);
+                        }})
+                        .catch(err => {{
+                            alert('Microphone access denied.');
+                            console.error(err);
+                        }});
+                }});
             </script>
         </body>
         </html>
@@ -427,14 +1216,123 @@ class ControlServerHandler(BaseHTTPRequestHandler):
         return html_page
 
 
-if __name__ == '__main__':
-    port = 8000
-    server_address = ('0.0.0.0', port)
-    handler_class = partial(ControlServerHandler, {})
-    httpd = HTTPServer(server_address, handler_class)
-    print(f"Server running on http://0.0.0.0:{port}/")
+def controller_handlers(controller):
+    return {
+        'up': controller.go_up,
+        'down': controller.go_down,
+        'left': controller.go_left,
+        'right': controller.go_right,
+        'full': controller.full_clean,
+        'reset': controller.reset,
+        'manual': controller.manual,
+        'region': controller.clean_regions,
+        'stop': controller.stop,
+    }
+
+
+def make_server(server_address, controller, model_spec=None, model=None):
+    """A ControlServer driving `controller`, local or a ControllerClient."""
+    handler_class = partial(ControlServerHandler,
+                            controller_handlers(controller))
+    httpd = ControlServer(server_address,
+                          handler_class,
+                          model_spec=model_spec,
+                          model=model,
+                          arm=controller.arm)
+    controller.listeners.append(httpd.events.publish)
+    ControlServerHandler.prepare_page()
+    return httpd
+
+
+def build_server(server_address,
+                 motor_spec,
+                 model_spec=None,
+                 gpio=None,
+                 persist=True):
+    """A ControlServer and the controller it drives on `gpio`.
+
+    With `persist`, the controller writes its speed corrections back into
+    `motor_spec`; a simulated board should not.
+    """
+    from controller import BlackboardController
+
+    with open(motor_spec, encoding='utf8') as f:
+        motor_conf = json.load(f)
+    spec_path = motor_spec if persist else None
+    controller = BlackboardController(motor_conf,
+                                      gpio=gpio,
+                                      spec_path=spec_path)
+    return make_server(server_address, controller, model_spec), controller
+
+
+def serve(httpd, controller):
+    """Serve until interrupted, then stop the motion and shut down."""
+    host, port = httpd.server_address[:2]
+    print(f"Server running on http://{host}:{port}/")
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down the server.")
-        httpd.server_close()
+    controller.stop()
+    httpd.server_close()
+    controller.flush()
+
+
+if __name__ == '__main__':
+    import gpio_backend
+    from driver import GpioManager
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000, help='port')
+    parser.add_argument('--motor-spec',
+                        default=os.path.join(script_dir, 'motor_spec.json'),
+                        help='motor spec file (default: %(default)s)')
+    parser.add_argument('--simulate',
+                        action='store_true',
+                        help='drive the simulated board')
+    parser.add_argument('--gpio',
+                        choices=('rpi', 'pigpio'),
+                        help="GPIO backend, pigpio times the step pulses "
+                        "in hardware (default: the motor spec's backend, "
+                        "or rpi)")
+    parser.add_argument('--model-spec',
+                        default=os.path.join(script_dir, 'model_spec.json'),
+                        help='voice model spec file (default: %(default)s)')
+    parser.add_argument('--daemon',
+                        metavar='SOCKET',
+                        help='use the controller daemon on this socket, '
+                        'instead of driving the motors')
+    args = parser.parse_args()
+
+    if args.daemon:
+        from controller_daemon import ControllerClient
+        controller = ControllerClient(args.daemon)
+        model = controller.voice_model()
+        if model is None:
+            print("Voice commands disabled: the daemon has no model")
+        serve(make_server(('0.0.0.0', args.port), controller, model=model),
+              controller)
+        controller.close()
+        raise SystemExit(0)
+
+    model_spec = args.model_spec
+    try:
+        load_voice_model(model_spec)  # once, before the first request
+    except (ImportError, OSError) as e:
+        print(f"Voice commands disabled: {e}")
+        model_spec = None
+
+    with open(args.motor_spec, encoding='utf8') as f:
+        motor_conf = json.load(f)
+    if args.simulate:
+        gpio = gpio_backend.SimBackend.from_motor_spec(motor_conf)
+    else:
+        gpio = gpio_backend.create_backend(args.gpio, motor_conf)
+    with GpioManager(gpio) as manager:
+        httpd, controller = build_server(('0.0.0.0', args.port),
+                                         args.motor_spec,
+                                         model_spec,
+                                         gpio=manager.gpio,
+                                         persist=not args.simulate)
+        serve(httpd, controller)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Startup phase timing, and the trend of the boots logged to a file"""
+
+import argparse
+import contextlib
+import json
+import statistics
+import threading
+import time
+
+
+class StartupProfile(object):
+    """Times the startup phases of a process from `t0` (perf_counter).
+
+    Phases may run on several threads. `mark` records a milestone, e.g.
+    the window shown, as a phase of no duration.
+    """
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.lock = threading.Lock()
+        self.phases = []  # (name, start, secs), start since t0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, t, time.perf_counter() - t)
+
+    def mark(self, name):
+        self.add(name, time.perf_counter(), 0.0)
+
+    def add(self, name, t, secs):
+        with self.lock:
+            self.phases.append((name, t - self.t0, secs))
+
+    def elapsed(self):
+        return time.perf_counter() - self.t0
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = [">>> Startup profile:"]
+        for name, start, secs in phases:
+            took = f"{secs * 1000:8.1f}ms" if secs else " " * 10
+            lines.append(f"  {start * 1000:8.1f}ms {took}  {name}")
+        return "\n".join(lines)
+
+    def save(self, fn):
+        """Append this boot as a JSON line to `fn`, to track the trend."""
+        with self.lock:
+            phases = {name: [start, secs] for name, start, secs in self.phases}
+        with open(fn, "a", encoding="utf8") as f:
+            f.write(json.dumps({"time": time.time(), "phases": phases}) + "\n")
+
+
+def read_log(fn):
+    with open(fn, encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _median(boots, name, i):
+    values = [b["phases"][name][i] for b in boots if name in b["phases"]]
+    return statistics.median(values) * 1000 if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("log_file", help="startup profile log file")
+    parser.add_argument("--last",
+                        type=int,
+                        default=10,
+                        help="boots to compare with the earlier ones "
+                        "(default: %(default)s)")
+    args = parser.parse_args()
+    boots = read_log(args.log_file)
+    recent, earlier = boots[-args.last:], boots[:-args.last]
+    print(f">>> {len(boots)} boots, median of the last {len(recent)} "
+          f"vs the {len(earlier)} before")
+    names = {}
+    for boot in boots:
+        for name, (start, secs) in boot["phases"].items():
+            names.setdefault(name, start)
+    for name in sorted(names, key=names.get):
+        # the time of the milestones, the duration of the other phases
+        i = 1 if any(b["phases"].get(name, (0, 0))[1] for b in boots) else 0
+        now = _median(recent, name, i)
+        if now is None:
+            continue
+        before = _median(earlier, name, i)
+        change = "" if before is None else f" ({now - before:+.1f}ms)"
+        print(f"  {name:>24}: {now:8.1f}ms{change}")
+
+
+if __name__ == "__main__":
+    main()
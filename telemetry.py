@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Per-move motion telemetry with stall and overrun alerts"""
+
+import argparse
+import collections
+import json
+import logging
+import logging.handlers
+import time
+
+# One drive of a motor. `planned` is the duration asked for the length at
+# `freq`, `actual` the time the motor ran and `backoff` the extra time spent
+# backing off an end switch. `reason` is the MoveResult reason.
+MoveRecord = collections.namedtuple("MoveRecord", [
+    "time", "axis", "length", "freq", "planned", "actual", "backoff",
+    "homing", "collision", "reason"
+])
+# `kind` is "stall", "overrun" or "early_hit".
+Alert = collections.namedtuple("Alert", ["time", "kind", "axis", "message"])
+
+
+class Telemetry(object):
+    """Keeps the latest move records in memory and optionally in a file.
+
+    Records go to a ring of `history` entries and, with `log_file` set, as
+    JSON lines into a file rotated at `max_bytes` with `backup_count` old
+    files kept. Each record is checked for:
+
+    - stall: a homing move ran out without hitting its end switch,
+    - overrun: a move took `tolerance` longer than planned,
+    - early_hit: a plain move hit an end switch `tolerance` before its end,
+      so the tracked position was wrong.
+    """
+
+    def __init__(self,
+                 history=1000,
+                 log_file=None,
+                 max_bytes=1 << 20,
+                 backup_count=3,
+                 tolerance=0.2,
+                 slack=0.05):
+        self.records = collections.deque(maxlen=history)
+        self.alerts = collections.deque(maxlen=history)
+        self.tolerance = tolerance
+        self.slack = slack  # secs of polling overhead allowed on any move
+        self.logger = None
+        if log_file:
+            handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            # a logger of its own, the records never reach the console
+            self.logger = logging.getLogger(f"telemetry.{id(self)}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
+
+    def record(self,
+               axis,
+               length,
+               freq,
+               planned,
+               actual,
+               backoff,
+               reason,
+               homing=False):
+        rec = MoveRecord(time.time(), axis, length, freq, planned, actual,
+                         backoff, homing, reason == "collision", reason)
+        self.records.append(rec)
+        if self.logger is not None:
+            self.logger.info(json.dumps(rec._asdict()))
+        for kind, message in self.check(rec):
+            alert = Alert(rec.time, kind, axis, message)
+            self.alerts.append(alert)
+            logging.warning("Motor %s %s: %s", axis, kind, message)
+            if self.logger is not None:
+                self.logger.info(json.dumps({"alert": alert._asdict()}))
+        return rec
+
+    def check(self, rec):
+        """Alerts (kind, message) derived from a single record."""
+        alerts = []
+        late = rec.planned * (1 + self.tolerance) + self.slack
+        early = rec.planned * (1 - self.tolerance) - self.slack
+        if rec.homing and rec.reason == "done":
+            alerts.append(("stall", f"no end switch hit in {rec.actual:.2f}s "
+                           f"over {rec.length:.3f}m"))
+        if rec.reason == "done" and rec.actual > late:
+            alerts.append(("overrun", f"took {rec.actual:.2f}s, "
+                           f"planned {rec.planned:.2f}s"))
+        if not rec.homing and rec.collision and rec.actual < early:
+            alerts.append(("early_hit", f"end switch hit after "
+                           f"{rec.actual:.2f}s, planned {rec.planned:.2f}s"))
+        return alerts
+
+    def summary(self):
+        """Counts and timings per axis over the records in memory."""
+        result = {}
+        for rec in self.records:
+            stats = result.setdefault(
+                rec.axis, {
+                    "moves": 0,
+                    "collisions": 0,
+                    "cancelled": 0,
+                    "planned": 0.0,
+                    "actual": 0.0,
+                    "backoff": 0.0,
+                })
+            stats["moves"] += 1
+            stats["collisions"] += rec.collision
+            stats["cancelled"] += rec.reason == "cancelled"
+            stats["planned"] += rec.planned
+            stats["actual"] += rec.actual
+            stats["backoff"] += rec.backoff
+        for alert in self.alerts:
+            stats = result.get(alert.axis)
+            if stats is not None:
+                stats[alert.kind] = stats.get(alert.kind, 0) + 1
+        return result
+
+
+def read_log(log_file):
+    """Load the records and alerts of a telemetry file."""
+    records, alerts = [], []
+    with open(log_file, encoding="utf8") as f:
+        for line in f:
+            data = json.loads(line)
+            if "alert" in data:
+                alerts.append(Alert(**data["alert"]))
+            else:
+                records.append(MoveRecord(**data))
+    return records, alerts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("LOG_FILE", help="telemetry file to summarize")
+    args = parser.parse_args()
+    records, alerts = read_log(args.LOG_FILE)
+    telemetry = Telemetry(history=max(len(records), len(alerts), 1))
+    telemetry.records.extend(records)
+    telemetry.alerts.extend(alerts)
+    for axis, stats in sorted(telemetry.summary().items()):
+        print(f">>> Motor {axis}: {json.dumps(stats)}")
+    for alert in alerts:
+        print(f">>> {time.ctime(alert.time)} {alert.axis} {alert.kind}: "
+              f"{alert.message}")
+
+
+if __name__ == "__main__":
+    main()
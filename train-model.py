@@ -7,6 +7,7 @@ import json
 import audio_utils
 import numpy as np
 import os
+import voice_dataset
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"  # disable tf console logging
 # pylint: disable=wrong-import-position
@@ -88,17 +89,11 @@ def load_dataset(data_dir,
                  feature="mfcc",
                  **kwargs):
     """Load the audio files and convert them into a dataset of shape (batch,
-    height, width, channel)"""
-    train_ds, val_ds = tf.keras.utils.audio_dataset_from_directory(
-        directory=data_dir,
-        validation_split=0.1,
-        seed=0,
-        batch_size=1,  # use batch size 1 for easy datasize calc.
-        output_sequence_length=sr * duration,
-        subset="both")
-    # first, we save all the label strings, since the dataset uses their indexes
-    # as the labels.
-    label_strs = train_ds.class_names
+    height, width, channel)
+
+    `data_dir` is a directory of labelled wav files, or one packed by
+    voice_dataset.py whose clips are read from memory-mapped shards.
+    """
 
     def make_feature(data):
         if feature == "mfcc":
@@ -106,22 +101,46 @@ def load_dataset(data_dir,
         else:
             return audio_utils.make_spectrogram(data)
 
-    def make_dataset(ds):
-        nitems = ds.cardinality().numpy()
+    def make_dataset(clips, nitems):
         labels = np.zeros(nitems)
-        for f, _ in ds.take(1):
-            sample_feature = make_feature(f.numpy()[0, :, 0])
-            shape = sample_feature.shape
-            features = np.zeros((nitems, shape[0], shape[1]))
-        for i, (f, l) in enumerate(ds):
-            features[i] = make_feature(f.numpy()[0, :, 0])
-            labels[i] = l.numpy()[0]
+        features = None
+        for i, (data, label) in enumerate(clips):
+            f = make_feature(data)
+            if features is None:
+                features = np.zeros((nitems, f.shape[0], f.shape[1]))
+            features[i] = f
+            labels[i] = label
         features = np.expand_dims(features, axis=-1)  # add a last channel dim
         result = tf.data.Dataset.from_tensor_slices((features, labels))
         return result.batch(batch_size)
 
-    train_ds = make_dataset(train_ds)
-    val_ds = make_dataset(val_ds)
+    if voice_dataset.is_packed(data_dir):
+        packed = voice_dataset.PackedDataset(data_dir)
+        if packed.sr != sr or packed.length != int(sr * duration):
+            raise ValueError(f"{data_dir} is packed at {packed.sr}Hz for "
+                             f"{packed.duration}s clips")
+        train_ds = make_dataset(packed.clips("train"),
+                                len(packed.indices("train")))
+        val_ds = make_dataset(packed.clips("val"), len(packed.indices("val")))
+        return (train_ds, val_ds, packed.labels)
+
+    train_ds, val_ds = tf.keras.utils.audio_dataset_from_directory(
+        directory=data_dir,
+        validation_split=0.1,
+        seed=0,
+        batch_size=1,  # use batch size 1 for easy datasize calc.
+        output_sequence_length=sr * duration,
+        subset="both")
+    # first, we save all the label strings, since the dataset uses their indexes
+    # as the labels.
+    label_strs = train_ds.class_names
+
+    def tf_clips(ds):
+        for f, l in ds:
+            yield f.numpy()[0, :, 0], l.numpy()[0]
+
+    train_ds = make_dataset(tf_clips(train_ds), train_ds.cardinality().numpy())
+    val_ds = make_dataset(tf_clips(val_ds), val_ds.cardinality().numpy())
 
     return (train_ds, val_ds, label_strs)
 
@@ -163,7 +182,9 @@ def train_voice_model(data_dir, model_fn, audio_sr, audio_duration, model_name,
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("data_dir", help="data directory")
+    parser.add_argument("data_dir",
+                        help="data directory, or a packed one (see "
+                        "voice_dataset.py)")
     parser.add_argument("model_fn", help="file to save model into")
     parser.add_argument("--audio-sr",
                         default=audio_utils.VOICE_SAMPLERATE,
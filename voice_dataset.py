@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Packed voice clip datasets, memory-mapped instead of one wav per clip
+
+A labelled directory, ours (data/<label>/NNNN.wav) or the Speech Commands
+layout (<label>/<speaker>_nohash_<n>.wav with validation_list.txt and
+testing_list.txt), is packed into:
+
+  index.json         sample rate, clip length, labels, shards, files
+  shard-NNNN.npy     int16 clips, (count, length) each
+  labels.npy         label id of each clip
+  splits.npy         TRAIN, VAL or TEST of each clip
+
+The shards are plain .npy files, opened with np.load(mmap_mode="r") so a
+clip is a view of the page cache, not a file to open and parse.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import numpy as np
+
+TRAIN, VAL, TEST = 0, 1, 2
+SPLITS = {"train": TRAIN, "val": VAL, "test": TEST}
+INDEX = "index.json"
+
+
+def is_packed(path):
+    return os.path.isfile(os.path.join(path, INDEX))
+
+
+def find_clips(data_dir):
+    """The (relative path, label) of the wav clips of a labelled directory.
+
+    Directories starting with "_", e.g. _background_noise_ of Speech
+    Commands, are not labels.
+    """
+    clips = []
+    for label in sorted(os.listdir(data_dir)):
+        label_dir = os.path.join(data_dir, label)
+        if label.startswith("_") or not os.path.isdir(label_dir):
+            continue
+        for fn in sorted(os.listdir(label_dir)):
+            if fn.lower().endswith(".wav"):
+                clips.append((f"{label}/{fn}", label))
+    return clips
+
+
+def assign_splits(data_dir, files, val=0.1, test=0.0):
+    """The split of each file.
+
+    Uses the validation and testing lists of Speech Commands if present,
+    otherwise a hash of the file name, so a clip stays in its split when
+    more are recorded and the directory is packed again.
+    """
+    lists = {}
+    for split, fn in ((VAL, "validation_list.txt"),
+                      (TEST, "testing_list.txt")):
+        path = os.path.join(data_dir, fn)
+        if os.path.isfile(path):
+            with open(path, encoding="utf8") as f:
+                lists.update((line.strip(), split) for line in f)
+    splits = np.full(len(files), TRAIN, dtype=np.uint8)
+    for i, fn in enumerate(files):
+        if lists:
+            splits[i] = lists.get(fn, TRAIN)
+            continue
+        digest = hashlib.sha1(fn.encode("utf-8")).digest()
+        x = int.from_bytes(digest[:4], "big") / 2**32
+        if x < test:
+            splits[i] = TEST
+        elif x < test + val:
+            splits[i] = VAL
+    return splits
+
+
+def load_clip(path, sr, length, peak=None):
+    """A wav file as int16 mono at `sr`, cut or zero padded to `length`.
+
+    Any sample format is scaled to [-1, 1) first. `peak` scales the clip
+    to that peak amplitude, the model does not do it at inference though.
+    """
+    import audio_utils  # librosa, in the pool workers only
+    with open(path, "rb") as f:
+        voice = audio_utils.decode_audio(f.read(), sr)
+    # as VoiceCmdModel.predict fits a recording
+    voice = np.pad(voice[:length], (0, max(0, length - len(voice))))
+    if peak is not None:
+        top = np.max(np.abs(voice))
+        if top > 0:
+            voice = voice * (peak / top)
+    return np.clip(np.round(voice * 32768), -32768, 32767).astype(np.int16)
+
+
+def pack(data_dir,
+         out_dir,
+         sr=16000,
+         duration=1.0,
+         shard_size=8192,
+         val=0.1,
+         test=0.0,
+         peak=None,
+         workers=None):
+    """Pack the clips of `data_dir` into `out_dir`, returns the index.
+
+    The clips are decoded, resampled and normalized on `workers`
+    processes, and written in order into the memory-mapped shards.
+    """
+    clips = find_clips(data_dir)
+    if not clips:
+        raise ValueError(f"No labelled wav clips in {data_dir}")
+    files = [fn for fn, _ in clips]
+    labels = sorted({label for _, label in clips})
+    label_ids = np.array([labels.index(label) for _, label in clips],
+                         dtype=np.int16)
+    splits = assign_splits(data_dir, files, val, test)
+    length = int(sr * duration)
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    for start in range(0, len(files), shard_size):
+        count = min(shard_size, len(files) - start)
+        shards.append({"fn": f"shard-{len(shards):04d}.npy", "count": count})
+    paths = [os.path.join(data_dir, fn) for fn in files]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = pool.map(load_clip,
+                           paths, [sr] * len(paths), [length] * len(paths),
+                           [peak] * len(paths),
+                           chunksize=32)
+        for shard in shards:
+            array = np.lib.format.open_memmap(os.path.join(
+                out_dir, shard["fn"]),
+                mode="w+",
+                dtype=np.int16,
+                shape=(shard["count"], length))
+            for i in range(shard["count"]):
+                array[i] = next(results)
+            array.flush()
+            del array
+    np.save(os.path.join(out_dir, "labels.npy"), label_ids)
+    np.save(os.path.join(out_dir, "splits.npy"), splits)
+    index = {
+        "sr": sr,
+        "duration": duration,
+        "length": length,
+        "peak": peak,
+        "labels": labels,
+        "shards": shards,
+        "files": files
+    }
+    # written last, a pack cut short has no index
+    with open(os.path.join(out_dir, INDEX), "w", encoding="utf8") as f:
+        json.dump(index, f)
+    return index
+
+
+class PackedDataset(object):
+    """A packed dataset, its clips are views of memory-mapped shards."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, INDEX), encoding="utf8") as f:
+            self.index = json.load(f)
+        self.sr = self.index["sr"]
+        self.duration = self.index["duration"]
+        self.length = self.index["length"]
+        self.labels = self.index["labels"]
+        self.files = self.index["files"]
+        self.shards = [
+            np.load(os.path.join(path, shard["fn"]), mmap_mode="r")
+            for shard in self.index["shards"]
+        ]
+        self.offsets = np.cumsum([0] + [len(s) for s in self.shards])
+        self.label_ids = np.load(os.path.join(path, "labels.npy"))
+        self.splits = np.load(os.path.join(path, "splits.npy"))
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, i):
+        """The int16 samples of clip `i`, without a copy."""
+        shard = int(np.searchsorted(self.offsets, i, side="right")) - 1
+        return self.shards[shard][i - self.offsets[shard]]
+
+    def indices(self, split=None):
+        if split is None:
+            return np.arange(len(self))
+        return np.flatnonzero(self.splits == SPLITS.get(split, split))
+
+    def clips(self, split=None):
+        """Yield the (float32 samples, label id) of the clips of `split`."""
+        for i in self.indices(split):
+            yield self[i] / np.float32(32768), int(self.label_ids[i])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("data_dir", help="labelled directory of wav clips")
+    parser.add_argument("out_dir", help="directory to pack into")
+    parser.add_argument("--sr",
+                        type=int,
+                        default=16000,
+                        help="sample rate (default: %(default)s)")
+    parser.add_argument("--duration",
+                        type=float,
+                        default=1.0,
+                        help="clip secs (default: %(default)s)")
+    parser.add_argument("--shard-size",
+                        type=int,
+                        default=8192,
+                        help="clips per shard (default: %(default)s)")
+    parser.add_argument("--val",
+                        type=float,
+                        default=0.1,
+                        help="validation fraction, without Speech Commands "
+                        "lists (default: %(default)s)")
+    parser.add_argument("--test",
+                        type=float,
+                        default=0.0,
+                        help="test fraction, likewise (default: %(default)s)")
+    parser.add_argument("--peak",
+                        type=float,
+                        help="normalize the clips to this peak amplitude")
+    parser.add_argument("--workers",
+                        type=int,
+                        help="packing processes (default: one per CPU)")
+    args = parser.parse_args()
+    index = pack(args.data_dir, args.out_dir, args.sr, args.duration,
+                 args.shard_size, args.val, args.test, args.peak,
+                 args.workers)
+    splits = np.load(os.path.join(args.out_dir, "splits.npy"))
+    counts = {name: int(np.sum(splits == v)) for name, v in SPLITS.items()}
+    print(f">>> Packed {len(index['files'])} clips of {len(index['labels'])} "
+          f"labels into {len(index['shards'])} shards, {counts}")
+
+
+if __name__ == "__main__":
+    main()
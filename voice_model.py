@@ -7,6 +7,7 @@ import numpy as np
 import json
 import audio_utils
 import argparse
+import metrics
 import time
 import re
 
@@ -16,6 +17,14 @@ except ImportError:
     import tensorflow.lite as tflite
 
 
+PREDICT_SECONDS = metrics.histogram("voice_predict_seconds",
+                                    "Time of each voice prediction stage",
+                                    ["stage"])
+PREDICTIONS = metrics.counter("voice_predictions_total",
+                              "Voice predictions by predicted label",
+                              ["command"])
+
+
 class VoiceCmdModel(object):
     """A voice command predication model based on mfcc"""
 
@@ -46,27 +55,120 @@ class VoiceCmdModel(object):
 
     def predict(self, voice, sr):
         # preprocess the voice data to match the original model sr and length
-        if sr != self.model_sr:
-            voice = librosa.resample(voice,
-                                     orig_sr=sr,
-                                     target_sr=self.model_sr)
-        n_datapoints = int(self.model_sr * self.model_duration)
-        voice = np.pad(voice[:n_datapoints],
-                       (0, max(0, n_datapoints - len(voice))),
-                       "constant",
-                       constant_values=(0.0, ))
-        feature = self.make_feature(voice)
-        feature = np.expand_dims(feature, axis=-1)  # add extra channel
-
-        self.model.set_tensor(self.input_details[0]["index"],
-                              np.array([feature], dtype=np.float32))
-        self.model.invoke()  # Run inference
-        predictions = self.model.get_tensor(self.output_details[0]["index"])[0]
+        with PREDICT_SECONDS.time(stage="resample"):
+            if sr != self.model_sr:
+                if self.model_sr == audio_utils.VOICE_SAMPLERATE:
+                    # decimates the preferred multiples of 16kHz
+                    voice = audio_utils.resample_voice(voice, sr)
+                else:
+                    voice = librosa.resample(voice,
+                                             orig_sr=sr,
+                                             target_sr=self.model_sr)
+        with PREDICT_SECONDS.time(stage="feature"):
+            n_datapoints = int(self.model_sr * self.model_duration)
+            voice = np.pad(voice[:n_datapoints],
+                           (0, max(0, n_datapoints - len(voice))),
+                           "constant",
+                           constant_values=(0.0, ))
+            feature = self.make_feature(voice)
+            feature = np.expand_dims(feature, axis=-1)  # add extra channel
+
+        with PREDICT_SECONDS.time(stage="inference"):
+            self.model.set_tensor(self.input_details[0]["index"],
+                                  np.array([feature], dtype=np.float32))
+            self.model.invoke()  # Run inference
+            predictions = self.model.get_tensor(
+                self.output_details[0]["index"])[0]
 
         probability = dict(zip(self.label_strs, predictions))
         predicted_label = self.label_strs[np.argmax(predictions)]
+        PREDICTIONS.inc(command=predicted_label)
         return {"command": predicted_label, "details": probability}
 
+    def recognize(self, data):
+        """Predict the command of an audio file's bytes (wav, webm...).
+
+        The result has the decode and predict times in ms under "timing".
+        """
+        t0 = time.perf_counter()
+        voice = audio_utils.decode_audio(data, self.model_sr)
+        t1 = time.perf_counter()
+        result = self.predict(voice, self.model_sr)
+        result["timing"] = {
+            "decode_ms": (t1 - t0) * 1000,
+            "predict_ms": (time.perf_counter() - t1) * 1000
+        }
+        return result
+
+
+class StreamRecognizer(object):
+    """Recognize voice commands in a continuous audio stream.
+
+    The last `duration` secs of the stream (as the model is trained on) are
+    predicted every `hop` secs. A command is reported when its probability
+    exceeds `confidence`, and the same command is not reported again within
+    `refractory` secs, as the window slides over it several times.
+    """
+
+    def __init__(self,
+                 model,
+                 sr,
+                 hop=0.25,
+                 confidence=0.8,
+                 refractory=1.0,
+                 lock=None):
+        self.model = model
+        self.sr = sr
+        self.window = np.zeros(int(sr * model.model_duration),
+                               dtype=np.float32)
+        self.hop = int(sr * hop)
+        self.confidence = confidence
+        self.refractory = int(sr * refractory)
+        self.lock = lock  # to share one model among threads
+        self.received = 0  # samples fed so far
+        self.next_predict = len(self.window)
+        self.last = (None, -self.refractory)  # last command and its sample
+
+    def feed(self, samples):
+        """Add float32 samples, returns the list of new command results."""
+        results = []
+        while len(samples) > 0:
+            # slide the window up to the next prediction point at most
+            n = min(len(samples), self.next_predict - self.received)
+            n = min(n, len(self.window))
+            self.window = np.roll(self.window, -n)
+            self.window[-n:] = samples[:n]
+            samples = samples[n:]
+            self.received += n
+            if self.received < self.next_predict:
+                continue
+            self.next_predict += self.hop
+            result = self.predict()
+            if result is not None:
+                results.append(result)
+        return results
+
+    def predict(self):
+        if self.lock is not None:
+            with self.lock:
+                result = self.model.predict(self.window, self.sr)
+        else:
+            result = self.model.predict(self.window, self.sr)
+        command = result["command"]
+        probability = float(result["details"][command])
+        if command == "__noise__" or probability <= self.confidence:
+            return None
+        last_command, last_at = self.last
+        if (command == last_command and
+                self.received - last_at < self.refractory):
+            return None
+        self.last = (command, self.received)
+        return {
+            "command": command,
+            "probability": probability,
+            "at": self.received / self.sr
+        }
+
 
 def loop_predict(model_fn, sr, duration, feature, **kwargs):
     dev_infos = audio_utils.select_input_device()
@@ -103,6 +205,38 @@ def loop_predict(model_fn, sr, duration, feature, **kwargs):
         return
 
 
+def evaluate(model, data_dir, split="val"):
+    """Accuracy of `model` over a split of a packed dataset.
+
+    Clips are read from the memory-mapped shards. Labels the model does
+    not know are skipped; the "noise" directory is the "__noise__" label.
+    """
+    import voice_dataset
+    packed = voice_dataset.PackedDataset(data_dir)
+    names = [
+        name if name in model.label_strs else f"__{name}__"
+        for name in packed.labels
+    ]
+    counts = {}  # label -> [correct, total]
+    skipped = 0
+    for data, label in packed.clips(split):
+        name = names[label]
+        if name not in model.label_strs:
+            skipped += 1
+            continue
+        result = model.predict(data, packed.sr)
+        count = counts.setdefault(name, [0, 0])
+        count[0] += result["command"] == name
+        count[1] += 1
+    correct = sum(c for c, _ in counts.values())
+    total = sum(n for _, n in counts.values())
+    print(f">>> {split}: {correct}/{total} correct "
+          f"({correct / max(total, 1) * 100:.1f}%), {skipped} clips of "
+          f"unknown labels skipped")
+    for name, (c, n) in sorted(counts.items()):
+        print(f"  {name:>10}: {c}/{n} ({c / n * 100:.1f}%)")
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("model_fn", help="pretrained model file")
@@ -122,7 +256,23 @@ def main():
                         default=20,
                         type=int,
                         help="number of mfcc (only for mfcc feature)")
+    parser.add_argument("--evaluate",
+                        metavar="PACKED_DIR",
+                        help="evaluate on a packed dataset instead of "
+                        "listening")
+    parser.add_argument("--split",
+                        default="val",
+                        choices=("train", "val", "test"),
+                        help="split to evaluate (default: %(default)s)")
     args = parser.parse_args()
+    if args.evaluate:
+        model = VoiceCmdModel(args.model_fn,
+                              args.sr,
+                              args.duration,
+                              args.feature,
+                              n_mfcc=args.n_mfcc)
+        evaluate(model, args.evaluate, args.split)
+        return
     loop_predict(args.model_fn,
                  args.sr,
                  args.duration,
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# coding: utf8
+"""Minimal server side WebSocket (RFC 6455) over http.server handlers"""
+
+import base64
+import hashlib
+import struct
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+
+class WebSocketError(Exception):
+    """A protocol violation, `code` is the close status to send."""
+
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+def is_upgrade(headers):
+    return (headers.get("Upgrade", "").lower() == "websocket" and
+            "upgrade" in headers.get("Connection", "").lower())
+
+
+def accept(handler):
+    """Answer the upgrade request of a BaseHTTPRequestHandler.
+
+    Returns a WebSocket on the handler's connection, or None after an
+    error response if the request is not a valid upgrade.
+    """
+    key = handler.headers.get("Sec-WebSocket-Key")
+    if not is_upgrade(handler.headers) or not key:
+        handler.send_error(400, "Expected a WebSocket upgrade")
+        return None
+    digest = hashlib.sha1((key.strip() + GUID).encode("ascii")).digest()
+    handler.protocol_version = "HTTP/1.1"  # browsers reject a 1.0 upgrade
+    handler.send_response(101, "Switching Protocols")
+    handler.send_header("Upgrade", "websocket")
+    handler.send_header("Connection", "Upgrade")
+    handler.send_header("Sec-WebSocket-Accept",
+                        base64.b64encode(digest).decode("ascii"))
+    handler.end_headers()
+    handler.wfile.flush()
+    handler.close_connection = True  # no HTTP after the socket closes
+    return WebSocket(handler.rfile, handler.wfile)
+
+
+def _unmask(data, mask):
+    # xor as one big integer, much faster than byte by byte
+    n = len(data)
+    key = (mask * (n // 4 + 1))[:n]
+    value = int.from_bytes(data, "little") ^ int.from_bytes(key, "little")
+    return value.to_bytes(n, "little")
+
+
+class WebSocket(object):
+    """Messages over an upgraded connection, for one reader thread."""
+
+    def __init__(self, rfile, wfile, max_size=1 << 20):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.max_size = max_size
+        self.closed = False
+
+    def _read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise EOFError("WebSocket connection lost")
+        return data
+
+    def _read_frame(self):
+        b0, b1 = self._read_exact(2)
+        fin, opcode = b0 & 0x80, b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length, = struct.unpack("!H", self._read_exact(2))
+        elif length == 127:
+            length, = struct.unpack("!Q", self._read_exact(8))
+        if not b1 & 0x80:
+            raise WebSocketError("Client frames must be masked")
+        if length > self.max_size:
+            raise WebSocketError("Frame too large", CLOSE_TOO_BIG)
+        mask = self._read_exact(4)
+        return fin, opcode, _unmask(self._read_exact(length), mask)
+
+    def receive(self):
+        """The next (opcode, payload) text or binary message.
+
+        Pings are answered on the way. Returns None once the peer closed.
+        """
+        message, message_op = [], None
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == OP_CLOSE:
+                if not self.closed:
+                    self.send(OP_CLOSE, payload[:2])
+                    self.closed = True
+                return None
+            if opcode == OP_PING:
+                self.send(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CONTINUATION:
+                if message_op is None:
+                    raise WebSocketError("Continuation without a message")
+            elif opcode in (OP_TEXT, OP_BINARY):
+                if message_op is not None:
+                    raise WebSocketError("Interleaved messages")
+                message_op = opcode
+            else:
+                raise WebSocketError(f"Bad opcode {opcode}")
+            message.append(payload)
+            if sum(len(m) for m in message) > self.max_size:
+                raise WebSocketError("Message too large", CLOSE_TOO_BIG)
+            if fin:
+                return message_op, b"".join(message)
+
+    def send(self, opcode, payload=b""):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def send_text(self, text):
+        self.send(OP_TEXT, text)
+
+    def close(self, code=CLOSE_NORMAL, reason=""):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send(OP_CLOSE, struct.pack("!H", code) + reason.encode())
+        except OSError:
+            pass